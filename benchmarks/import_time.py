@@ -0,0 +1,96 @@
+"""
+NAME
+    import_time.py
+
+DESCRIPTION
+    Cold-start time of the validator and solver entry points
+    ============================================================
+
+    Every entry point is imported in a fresh interpreter, as a process-pool
+    worker would, and the import time, the process wall time and the heavy
+    optional packages it loaded are reported. The "heavy dependencies" row
+    imports matplotlib, sklearn, lightgbm and pulp up front, which is the tax
+    the lazy imports avoid.
+
+    Usage:
+        python benchmarks/import_time.py --repeat 5
+
+PACKAGE LIST
+    numpy
+"""
+
+## Libraries
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+
+HEAVY_PACKAGES = ["matplotlib", "sklearn", "scipy", "lightgbm", "pulp"]
+
+ENTRY_POINTS = {
+  "validator": "from test_constraint import constraintsTest",
+  "scorer": "from scorer import score_batch",
+  "flow solver": "from network_flow import BiomassDemandSupplyFlow, PelletDemandSupplyFlow",
+  "lp solver": "from optimization_model import BiomassDemandSupply",
+  "depot locator": "from depot_locator import DepotLocator",
+  "refinery locator": "from refinery_locator import RefineryLocator",
+  "forecast": "from forecast_model import forecast_horizon",
+  "pipeline cli": "import pipeline",
+  "heavy dependencies": "import matplotlib.pyplot, sklearn.cluster, lightgbm, pulp",
+}
+
+PROBE = """
+import sys, time, json
+sys.path.insert(0, {src!r})
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"import": elapsed, "loaded": [x for x in {heavy!r} if x in sys.modules]}}))
+"""
+
+
+def cold_start(statement):
+  """
+  Import time, process wall time and heavy packages loaded by `statement` in a new interpreter.
+  """
+  code = PROBE.format(src = SRC_DIR, statement = statement, heavy = HEAVY_PACKAGES)
+  start = time.perf_counter()
+  output = subprocess.run([sys.executable, "-c", code], capture_output = True, text = True, check = True).stdout
+  wall = time.perf_counter() - start
+
+  result = json.loads(output.strip().splitlines()[-1])
+  result["wall"] = wall
+  return result
+
+
+def main():
+  parser = argparse.ArgumentParser(description = "Cold-start time of the src entry points.")
+  parser.add_argument("--repeat", type = int, default = 5, help = "Fresh interpreters per entry point.")
+  parser.add_argument("--output", default = None, help = "Optional json file of the results.")
+  args = parser.parse_args()
+
+  # Warm the OS file cache so the first entry point is not penalised
+  cold_start("import pandas")
+
+  results = {}
+  print(f"{'entry point':>20} | {'import (s)':>10} | {'process (s)':>11} | heavy packages loaded")
+  for name, statement in ENTRY_POINTS.items():
+    runs = [cold_start(statement) for _ in range(args.repeat)]
+    results[name] = {"import": float(np.median([x["import"] for x in runs])),
+                     "wall": float(np.median([x["wall"] for x in runs])),
+                     "loaded": runs[0]["loaded"]}
+    print(f"{name:>20} | {results[name]['import']:10.3f} | {results[name]['wall']:11.3f} | "
+          f"{', '.join(results[name]['loaded']) or '-'}")
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent = 2)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,365 @@
+"""
+NAME
+    run_benchmarks.py
+
+DESCRIPTION
+    Wall time and peak memory of the pipeline stages at several scales
+    ============================================================
+
+    Synthetic instances (benchmarks/synthetic.py) are generated once per size
+    in the work directory: the biomass history and, up to --dense-limit sites,
+    the dense haversine DistanceStore. Larger instances read their distances
+    from HaversineDistances, and BiomassDemandSupply gets the 5 nearest
+    depots of every site (KNearestDistances) instead of the dense columns.
+
+    Every stage runs in a fresh spawned process: its inputs are prepared
+    first (not timed), then the stage call alone is timed. The process peak
+    RSS is read before and after the call, so "peak_rss_mb" is the memory
+    high-water mark of the stage and "rss_before_mb" what its inputs took.
+    The depots and refineries found by a stage are saved for the next ones.
+
+    The results are written to a json file with the git commit, so two runs
+    can be compared with --compare: a stage slower (or bigger) than the old
+    run by more than --tolerance (and --min-delta) is reported as a
+    regression and the exit status is 1. With --repeat every stage is run
+    several times and the fastest run is kept.
+
+    Usage:
+        python benchmarks/run_benchmarks.py --sizes 2400 10000 50000 --output bench.json
+        python benchmarks/run_benchmarks.py --sizes 2400 --compare bench.json
+
+PACKAGE LIST
+    numpy
+    pandas
+"""
+
+## Libraries
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import contextlib
+import subprocess
+import traceback
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT_DIR, "src"))
+sys.path.append(os.path.join(ROOT_DIR, "benchmarks"))
+
+from synthetic import synthetic_history, write_distance_store
+
+STAGES = ["create_train_data", "cluster_data", "DepotLocator", "RefineryLocator",
+          "BiomassDemandSupply", "constraintsTest"]
+
+YEARS = ["2018", "2019"]
+SUBMISSION_COLUMNS = ['year', 'data_type', 'source_index', 'destination_index', 'value']
+
+
+def _peak_rss_mb():
+  """
+  Peak resident memory of this process in MB.
+  """
+  # On Linux ru_maxrss survives exec, so a spawned process would report the peak of
+  # its parent; the high-water mark of /proc is reset with the address space
+  try:
+    with open("/proc/self/status") as f:
+      for line in f:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1]) / 1024
+  except OSError:
+    pass
+
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def prepare_instance(n_sites, work_dir, dense_limit, seed = 0):
+  """
+  Generate (once) the history and, when dense, the distance store of an instance.
+
+  Returns:
+    str: The instance directory.
+  """
+  instance_dir = os.path.join(work_dir, f"sites_{n_sites}_seed_{seed}")
+  history_path = os.path.join(instance_dir, "Biomass_History.csv")
+  store_path = os.path.join(instance_dir, "distances.npy")
+
+  if not os.path.exists(history_path):
+    os.makedirs(instance_dir, exist_ok = True)
+    synthetic_history(n_sites, seed = seed).to_csv(history_path, index = False)
+  if n_sites <= dense_limit and not os.path.exists(store_path):
+    write_distance_store(pd.read_csv(history_path), store_path)
+
+  return instance_dir
+
+
+def _load(instance_dir):
+  """
+  History with the forecast years and the distance provider of an instance.
+  """
+  from distance_store import DistanceStore
+  from distance_provider import HaversineDistances
+
+  history = pd.read_csv(os.path.join(instance_dir, "Biomass_History.csv")).drop(["Index"], axis = 1)
+  # The last two years stand in for the forecast, the stages only need the columns
+  demand = history.copy()
+  demand[YEARS[0]], demand[YEARS[1]] = history["2016"], history["2017"]
+
+  store_path = os.path.join(instance_dir, "distances.npy")
+  if os.path.exists(store_path):
+    distances = DistanceStore(store_path)
+  else:
+    distances = HaversineDistances(history["Latitude"], history["Longitude"])
+
+  return history, demand, distances
+
+
+def _depots(instance_dir, demand):
+  from depot_locator import DepotLocator
+
+  path = os.path.join(instance_dir, "depots.csv")
+  if not os.path.exists(path):
+    with contextlib.redirect_stdout(io.StringIO()):
+      DepotLocator(demand.copy(), years = YEARS).to_csv(path, index = False)
+  return pd.read_csv(path)
+
+
+def _refineries(instance_dir, demand, depots, distances, options):
+  from refinery_locator import RefineryLocator
+
+  path = os.path.join(instance_dir, "refineries.csv")
+  if not os.path.exists(path):
+    with contextlib.redirect_stdout(io.StringIO()):
+      refineries, _ = RefineryLocator(demand, depots, distances, YEARS, method = options["refinery_method"],
+                                      n_candidates = options["n_candidates"], time_limit = options["time_limit"])
+    refineries.to_csv(path, index = False)
+  return pd.read_csv(path)
+
+
+def _depot_distances(history, depots, distances, dense):
+  """
+  Site -> depot distances given to BiomassDemandSupply: dense, or the 5 nearest depots.
+  """
+  from distance_provider import KNearestDistances
+
+  depots_idx = depots["source_index"].to_numpy()
+  if not dense:
+    distances = KNearestDistances.build(history["Latitude"], history["Longitude"], k = 5, candidates = depots_idx)
+  return distances.iloc[:, depots_idx]
+
+
+def _setup(stage, instance_dir, options):
+  """
+  Prepare the inputs of `stage` and return the call to time, and a function of its
+  result giving the saved outputs and extra information.
+  """
+  from utils import create_train_data, cluster_data
+  from depot_locator import DepotLocator
+  from refinery_locator import RefineryLocator
+  from optimization_model import BiomassDemandSupply
+  from test_constraint import constraintsTest
+
+  history, demand, distances = _load(instance_dir)
+  dense = os.path.exists(os.path.join(instance_dir, "distances.npy"))
+
+  if stage == "create_train_data":
+    return (lambda: create_train_data(history, window_size = options["window_size"]),
+            lambda train: {"rows": len(train)})
+
+  if stage == "cluster_data":
+    return (lambda: cluster_data(history, n_clusters = 4),
+            lambda clusters: {"clusters": int(len(np.unique(clusters)))})
+
+  if stage == "DepotLocator":
+    def finish(depots):
+      depots.to_csv(os.path.join(instance_dir, "depots.csv"), index = False)
+      return {"depots": len(depots)}
+    return (lambda: DepotLocator(demand.copy(), years = YEARS), finish)
+
+  depots = _depots(instance_dir, demand)
+
+  if stage == "RefineryLocator":
+    def finish(result):
+      result[0].to_csv(os.path.join(instance_dir, "refineries.csv"), index = False)
+      return {"refineries": len(result[0])}
+    return (lambda: RefineryLocator(demand, depots, distances, YEARS, method = options["refinery_method"],
+                                    n_candidates = options["n_candidates"], time_limit = options["time_limit"]),
+            finish)
+
+  if stage == "BiomassDemandSupply":
+    depot_distances = _depot_distances(history, depots, distances, dense)
+    return (lambda: BiomassDemandSupply(demand, depot_distances, int(YEARS[0])),
+            lambda flows: {"arcs": "dense" if dense else "5-nearest",
+                           "rows": None if flows is None else len(flows)})
+
+  if stage == "constraintsTest":
+    from network_flow import BiomassDemandSupplyFlow, PelletDemandSupplyFlow
+
+    refineries = _refineries(instance_dir, demand, depots, distances, options)
+    depot_distances = _depot_distances(history, depots, distances, dense)
+    solution = [depots[SUBMISSION_COLUMNS], refineries[SUBMISSION_COLUMNS]]
+    for year in [int(x) for x in YEARS]:
+      biomass = BiomassDemandSupplyFlow(demand, depot_distances, year)
+      solution += [biomass[SUBMISSION_COLUMNS], PelletDemandSupplyFlow(biomass, refineries, distances, year)[SUBMISSION_COLUMNS]]
+      solution.append(pd.DataFrame({"year": year, "data_type": "biomass_forecast",
+                                    "source_index": np.arange(len(demand)), "destination_index": np.nan,
+                                    "value": demand[f"{year}"].to_numpy()}))
+    solution = pd.concat(solution, ignore_index = True)
+
+    return (lambda: constraintsTest(solution, n_sites = len(demand)).report(),
+            lambda report: {"rows": len(solution), "passed": bool(report["passed"])})
+
+  raise ValueError(f"Unknown stage {stage!r}, expected one of {STAGES}.")
+
+
+def _run_stage(stage, instance_dir, options, queue):
+  """
+  Body of the stage process: setup, timed call, then the result on `queue`.
+  """
+  # CBC writes to the stdout file descriptor, not to sys.stdout
+  devnull = os.open(os.devnull, os.O_WRONLY)
+  os.dup2(devnull, 1)
+  try:
+    with contextlib.redirect_stdout(io.StringIO()):
+      call, finish = _setup(stage, instance_dir, options)
+      rss_before = _peak_rss_mb()
+      start = time.perf_counter()
+      result = call()
+      wall = time.perf_counter() - start
+      peak = _peak_rss_mb()
+      info = finish(result)
+    queue.put({"wall": wall, "peak_rss_mb": peak, "rss_before_mb": rss_before, "info": info})
+  except Exception:
+    queue.put({"error": traceback.format_exc(limit = 3)})
+
+
+def run_stage(stage, instance_dir, options, timeout = None):
+  """
+  Time `stage` on an instance in a fresh process.
+
+  Returns:
+    dict: wall (s), peak_rss_mb, rss_before_mb and info, or error.
+  """
+  context = multiprocessing.get_context("spawn")
+  queue = context.Queue()
+  process = context.Process(target = _run_stage, args = (stage, instance_dir, options, queue))
+  process.start()
+  try:
+    return queue.get(timeout = timeout)
+  except Exception:
+    process.terminate()
+    return {"error": f"timeout after {timeout}s"}
+  finally:
+    process.join()
+
+
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = ROOT_DIR, capture_output = True,
+                          text = True, check = True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def compare(results, baseline, tolerance, min_delta = 0.1):
+  """
+  Stages slower or bigger than in `baseline` by more than `tolerance` (relative), and
+  by more than `min_delta` seconds or MB, so the noise of the short stages is ignored.
+
+  Returns:
+    list: (n_sites, stage, metric, old, new) of every regression.
+  """
+  old = {(x["n_sites"], x["stage"]): x for x in baseline["results"] if "error" not in x}
+  regressions = []
+
+  print(f"\n{'sites':>7} | {'stage':>20} | {'wall old':>9} | {'wall new':>9} | {'peak old':>9} | {'peak new':>9}")
+  for x in results:
+    key = (x["n_sites"], x["stage"])
+    if key not in old or "error" in x:
+      continue
+    y = old[key]
+    flags = []
+    for metric in ("wall", "peak_rss_mb"):
+      if x[metric] > (1 + tolerance) * y[metric] and x[metric] - y[metric] > min_delta:
+        regressions.append((*key, metric, y[metric], x[metric]))
+        flags.append(metric)
+    print(f"{key[0]:>7} | {key[1]:>20} | {y['wall']:9.3f} | {x['wall']:9.3f} | {y['peak_rss_mb']:9.1f} | "
+          f"{x['peak_rss_mb']:9.1f} {'REGRESSION ' + ', '.join(flags) if flags else ''}")
+
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark the pipeline stages on synthetic instances.")
+  parser.add_argument("--sizes", type = int, nargs = "+", default = [2400, 10000, 50000], help = "Numbers of sites.")
+  parser.add_argument("--stages", nargs = "+", default = STAGES, choices = STAGES)
+  parser.add_argument("--work-dir", default = os.path.join(ROOT_DIR, "data", "interim", "benchmarks"),
+                      help = "Where the instances are generated and kept between runs.")
+  parser.add_argument("--dense-limit", type = int, default = 10000,
+                      help = "Largest instance given a dense distance store (n^2 float32 on disk).")
+  parser.add_argument("--seed", type = int, default = 0)
+  parser.add_argument("--window-size", type = int, default = 3)
+  parser.add_argument("--refinery-method", default = "heuristic", choices = ["milp", "heuristic"])
+  parser.add_argument("--n-candidates", type = int, default = 100, help = "Refinery candidates per depot.")
+  parser.add_argument("--time-limit", type = float, default = None, help = "Seconds given to RefineryLocator.")
+  parser.add_argument("--timeout", type = float, default = 1800, help = "Seconds before a stage is stopped.")
+  parser.add_argument("--output", default = None, help = "Json file of the results.")
+  parser.add_argument("--compare", default = None, help = "Json file of an earlier run.")
+  parser.add_argument("--tolerance", type = float, default = 0.2, help = "Relative slowdown reported as a regression.")
+  parser.add_argument("--min-delta", type = float, default = 0.1,
+                      help = "Smallest slowdown (s) or growth (MB) reported as a regression.")
+  parser.add_argument("--repeat", type = int, default = 1, help = "Runs of every stage, the fastest is kept.")
+  args = parser.parse_args()
+
+  options = {"window_size": args.window_size, "refinery_method": args.refinery_method,
+             "n_candidates": args.n_candidates, "time_limit": args.time_limit}
+
+  results = []
+  print(f"{'sites':>7} | {'stage':>20} | {'wall (s)':>9} | {'peak (MB)':>9} | {'inputs (MB)':>11} | info")
+  for n_sites in args.sizes:
+    start = time.perf_counter()
+    instance_dir = prepare_instance(n_sites, args.work_dir, args.dense_limit, args.seed)
+    print(f"{n_sites:>7} | {'instance':>20} | {time.perf_counter() - start:9.3f} | {'':>9} | {'':>11} | {instance_dir}")
+
+    for stage in STAGES:
+      if stage not in args.stages:
+        continue
+      runs = [run_stage(stage, instance_dir, options, args.timeout) for _ in range(args.repeat)]
+      result = {"n_sites": n_sites, "stage": stage,
+                **min(runs, key = lambda x: x.get("wall", np.inf))}
+      results.append(result)
+      if "error" in result:
+        print(f"{n_sites:>7} | {stage:>20} | failed: {result['error'].strip().splitlines()[-1]}")
+      else:
+        print(f"{n_sites:>7} | {stage:>20} | {result['wall']:9.3f} | {result['peak_rss_mb']:9.1f} | "
+              f"{result['rss_before_mb']:11.1f} | {result['info']}")
+
+  report = {"commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "options": {**options, "dense_limit": args.dense_limit, "seed": args.seed, "repeat": args.repeat},
+            "results": results}
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(report, f, indent = 2)
+
+  if args.compare:
+    with open(args.compare) as f:
+      regressions = compare(results, json.load(f), args.tolerance, args.min_delta)
+    if regressions:
+      print(f"\n{len(regressions)} regressions above {100 * args.tolerance:.0f}%")
+      sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,121 @@
+"""
+NAME
+    synthetic.py
+
+DESCRIPTION
+    Synthetic biomass instances at any number of sites
+    ============================================================
+
+    synthetic_history lays the sites on a regular latitude x longitude grid
+    over the area of Biomass_History.csv and draws every year's biomass from
+    a smooth random field (a few Gaussian production areas) with yearly and
+    per-site noise. The yearly total is scaled to `total_biomass`, so the
+    number of depots and refineries stays comparable across sizes and the
+    benchmarks measure the cost of the number of sites only.
+
+    write_distance_store writes the matching haversine distance matrix as a
+    dense float32 DistanceStore .npy, a block of rows at a time, without
+    holding the matrix in memory.
+
+PACKAGE LIST
+    numpy
+    pandas
+"""
+
+## Libraries
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT_DIR, "src"))
+
+from utils import haversine_pairwise
+
+# Area of the sites of Biomass_History.csv
+LATITUDE_RANGE = (20.15456, 24.66818)
+LONGITUDE_RANGE = (68.62419, 74.43682)
+
+
+def synthetic_history(n_sites,
+                      years = range(2010, 2018),
+                      total_biomass = 350000,
+                      n_areas = 8,
+                      seed = 0):
+  """
+  Biomass history of `n_sites` sites on a regular grid, in the Biomass_History.csv layout.
+
+  Parameters:
+    n_sites (int): Number of harvesting sites.
+
+    years (iterable): Years of the history.
+
+    total_biomass (float): Average yearly biomass of all the sites.
+
+    n_areas (int): Number of Gaussian production areas of the biomass field.
+
+    seed (int): Seed of the random field and of the noise.
+
+  Returns:
+    dataframe: Index, Latitude, Longitude and one column per year.
+
+  Example:
+      >>> synthetic_history(10000).shape
+      Output: (10000, 11)
+  """
+  rng = np.random.default_rng(seed)
+  years = [int(x) for x in years]
+
+  # Grid with about the aspect ratio of the area, filled row by row
+  height, width = LATITUDE_RANGE[1] - LATITUDE_RANGE[0], LONGITUDE_RANGE[1] - LONGITUDE_RANGE[0]
+  n_rows = max(1, int(np.ceil(np.sqrt(n_sites * height / width))))
+  n_cols = int(np.ceil(n_sites / n_rows))
+  position = np.arange(n_sites)
+  latitude = LATITUDE_RANGE[1] - height * (position // n_cols) / max(n_rows - 1, 1)
+  longitude = LONGITUDE_RANGE[0] + width * (position % n_cols) / max(n_cols - 1, 1)
+
+  # Smooth field: Gaussian production areas over a low background
+  centers = np.column_stack([rng.uniform(*LATITUDE_RANGE, n_areas), rng.uniform(*LONGITUDE_RANGE, n_areas)])
+  spread = rng.uniform(0.3, 1.0, n_areas)
+  weight = rng.uniform(0.5, 1.5, n_areas)
+  squared = (latitude[:, None] - centers[:, 0]) ** 2 + (longitude[:, None] - centers[:, 1]) ** 2
+  field = 0.05 + (weight * np.exp(-squared / (2 * spread ** 2))).sum(1)
+
+  yearly = rng.lognormal(0, 0.15, len(years))
+  noise = rng.gamma(4.0, 0.25, (n_sites, len(years)))
+  biomass = field[:, None] * yearly[None, :] * noise
+  biomass *= total_biomass / biomass.sum(0).mean()
+
+  df = pd.DataFrame({"Index": position, "Latitude": latitude, "Longitude": longitude})
+  return pd.concat([df, pd.DataFrame(biomass, columns = [f"{x}" for x in years])], axis = 1)
+
+
+def write_distance_store(df, store_path, block_size = 1024):
+  """
+  Dense float32 haversine distance store of the sites of `df`, readable by DistanceStore.
+
+  Parameters:
+    df (pd.DataFrame): Sites with Latitude and Longitude.
+
+    store_path (str): Path of the .npy file.
+
+    block_size (int): Rows computed at once.
+
+  Returns:
+    str: `store_path`.
+  """
+  latitude, longitude = df["Latitude"].to_numpy(), df["Longitude"].to_numpy()
+  n_sites = len(df)
+
+  os.makedirs(os.path.dirname(store_path) or ".", exist_ok = True)
+  tmp_path = f"{store_path}.{os.getpid()}.tmp.npy"
+  store = np.lib.format.open_memmap(tmp_path, mode = "w+", dtype = np.float32, shape = (n_sites, n_sites))
+  for start in range(0, n_sites, block_size):
+    stop = min(start + block_size, n_sites)
+    store[start:stop] = haversine_pairwise(latitude[start:stop], longitude[start:stop], latitude, longitude)
+  store.flush()
+  del store
+  os.replace(tmp_path, store_path)
+
+  return store_path
@@ -0,0 +1,93 @@
+"""
+NAME
+    transport_solver.py
+
+DESCRIPTION
+    Benchmark of the biomass transportation engines
+    ============================================================
+
+    Times BiomassDemandSupply (PuLP + CBC) against BiomassDemandSupplySparse
+    (SciPy sparse + HiGHS) and BiomassDemandSupplyFlow (min-cost flow) on the
+    depots of the sample submission and compares their objective values.
+
+    Usage:
+        python benchmarks/transport_solver.py --year 2017
+
+PACKAGE LIST
+    numpy
+    pandas
+    pulp
+    scipy
+"""
+
+## Libraries
+import os
+import sys
+import time
+import argparse
+import contextlib
+import io
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT_DIR, "src"))
+
+from distance_store import DistanceStore
+from optimization_model import BiomassDemandSupply, BiomassDemandSupplySparse
+from network_flow import BiomassDemandSupplyFlow
+
+
+def load_distances(path):
+  if path.endswith(".npy"):
+    return DistanceStore(path)
+  return pd.read_csv(path).drop(["Unnamed: 0"], axis=1)
+
+
+def transport_cost(result_df, distances_df):
+  distances = distances_df.to_numpy()
+  depot_pos = {int(x): pos for pos, x in enumerate(distances_df.columns)}
+  cols = result_df["destination_index"].map(depot_pos).to_numpy()
+  return float(np.sum(distances[result_df["source_index"].to_numpy(), cols] * result_df["value"].to_numpy()))
+
+
+def main():
+  parser = argparse.ArgumentParser(description = "Benchmark the biomass transportation engines.")
+  parser.add_argument("--data-dir", default = os.path.join(ROOT_DIR, "data", "raw"))
+  parser.add_argument("--distance-matrix", default = None,
+                      help = "Distance_Matrix.csv or a .npy distance store (default: <data-dir>/Distance_Matrix.csv)")
+  parser.add_argument("--year", default = "2017", help = "Biomass column used as the forecast.")
+  parser.add_argument("--repeat", type = int, default = 3, help = "Runs of the sparse and flow engines.")
+  args = parser.parse_args()
+
+  DemandHistory = pd.read_csv(os.path.join(args.data_dir, "Biomass_History.csv")).drop(["Index"], axis=1)
+  SampleSubmission = pd.read_csv(os.path.join(args.data_dir, "sample_submission.csv"))
+  DistanceMatrix = load_distances(args.distance_matrix or os.path.join(args.data_dir, "Distance_Matrix.csv"))
+
+  rows_idx = SampleSubmission[SampleSubmission["data_type"].eq("depot_location")]["source_index"].values
+  DepotsDistanceMatrix = DistanceMatrix.iloc[:, rows_idx]
+
+  timings = {}
+
+  start = time.perf_counter()
+  with contextlib.redirect_stdout(io.StringIO()):
+    pulp_result = BiomassDemandSupply(DemandHistory, DepotsDistanceMatrix, args.year)
+  timings["pulp"] = time.perf_counter() - start
+
+  results = {"pulp": pulp_result}
+  for engine, solver in (("sparse", BiomassDemandSupplySparse), ("flow", BiomassDemandSupplyFlow)):
+    engine_times = []
+    for _ in range(args.repeat):
+      start = time.perf_counter()
+      with contextlib.redirect_stdout(io.StringIO()):
+        results[engine] = solver(DemandHistory, DepotsDistanceMatrix, args.year)
+      engine_times.append(time.perf_counter() - start)
+    timings[engine] = min(engine_times)
+
+  print(f"Sites: {len(DemandHistory)}, Depots: {len(rows_idx)}, Year: {args.year}")
+  for engine, result in results.items():
+    cost = transport_cost(result, DepotsDistanceMatrix) if result is not None else float("nan")
+    print(f"{engine:>8}: {timings[engine]:8.3f} s | transport cost {cost:,.2f} | speedup {timings['pulp'] / timings[engine]:.1f}x")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,3 @@
+# src/test_constraint.py is the submission checker, not a test module: it imports the
+# flat src modules by bare name and is run as a script, so pytest must not collect it.
+collect_ignore = ["src/test_constraint.py"]
@@ -0,0 +1,23 @@
+"""
+NAME
+    __main__.py
+
+DESCRIPTION
+    Command-line entry point, `python -m src run`
+    ============================================================
+
+    The modules of src import each other by name (as in the notebooks),
+    so the folder is put on sys.path before loading the pipeline.
+"""
+
+## Libraries
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from pipeline import main
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,288 @@
+"""
+NAME
+    dataset.py
+
+DESCRIPTION
+    Immutable array-backed biomass data of the harvesting sites
+    ============================================================
+
+    BiomassDataset holds what every module reads from Biomass_History.csv:
+
+      - latitude and longitude as float64 arrays;
+      - the yearly biomass as one C-contiguous float32 (sites x years) matrix,
+        whose columns are addressed by integer year (dataset[2018]);
+      - the site label of every row (the DataFrame index);
+      - a coordinate -> row lookup built once, so locations found by the
+        locators map back to sites without string keys.
+
+    Every array is read-only and the object cannot be modified: new years
+    (a forecast) or a subset of the sites give a new dataset.
+
+    The solvers accept a DataFrame or a BiomassDataset through the accessors
+    below (year_values, year_matrix, site_coordinates, ...). A DataFrame is
+    read as before, in float64; a dataset is read without building any frame.
+
+PACKAGE LIST
+    numpy
+    pandas
+"""
+
+## Libraries
+import numpy as np
+import pandas as pd
+
+
+def _read_only(array):
+  array.setflags(write = False)
+  return array
+
+
+class BiomassDataset():
+  """
+  class BiomassDataset()
+
+  Example:
+      >>> data = BiomassDataset.from_frame(pd.read_csv("data/raw/Biomass_History.csv").drop(["Index"], axis = 1))
+      >>> data
+      Output: BiomassDataset(n_sites=2418, years=2010..2017)
+      >>> data[2017].sum()
+      Output: 384857.0
+      >>> data = data.with_years(forecast_matrix, [2018, 2019])
+      >>> depots = DepotLocator(data, years = [2018, 2019])
+  """
+
+  __slots__ = ("latitude", "longitude", "biomass", "years", "index", "coordinates",
+               "_year_position", "_coordinate_index", "_site_index", "_frozen")
+
+  def __init__(self, latitude, longitude, biomass, years, index = None):
+    """
+    Parameters:
+      latitude (array): Latitude of every site.
+
+      longitude (array): Longitude of every site.
+
+      biomass (array): (sites x years) biomass, stored as float32.
+
+      years (list): Year of every biomass column.
+
+      index (array): Label of every site (default: 0..n_sites - 1).
+    """
+    latitude = np.array(latitude, dtype = np.float64)
+    longitude = np.array(longitude, dtype = np.float64)
+    biomass = np.array(biomass, dtype = np.float32, order = "C", ndmin = 2)
+    years = tuple(int(x) for x in years)
+    n_sites = len(latitude)
+
+    if len(longitude) != n_sites or biomass.shape != (n_sites, len(years)):
+      raise ValueError(f"Inconsistent shapes: {n_sites} latitudes, {len(longitude)} longitudes, "
+                       f"biomass {biomass.shape} for {len(years)} years.")
+    if len(set(years)) != len(years):
+      raise ValueError(f"Duplicated years {years}.")
+
+    index = np.arange(n_sites, dtype = np.int64) if index is None else np.array(index, dtype = np.int64)
+
+    self.latitude = _read_only(latitude)
+    self.longitude = _read_only(longitude)
+    self.biomass = _read_only(biomass)
+    self.years = years
+    self.index = _read_only(index)
+    self.coordinates = _read_only(np.column_stack([latitude, longitude]))
+    self._year_position = {x: i for (i, x) in enumerate(years)}
+    self._coordinate_index = {x: i for (i, x) in enumerate(zip(latitude.tolist(), longitude.tolist()))}
+    self._site_index = None
+    self._frozen = True
+
+  def __setattr__(self, name, value):
+    if getattr(self, "_frozen", False) and name != "_site_index":
+      raise AttributeError("BiomassDataset is immutable, use with_years() or take() for a new one.")
+    object.__setattr__(self, name, value)
+
+  @classmethod
+  def from_frame(cls, df, years = None):
+    """
+    Dataset of a Biomass_History-like frame (Latitude, Longitude and one column per year).
+
+    Parameters:
+      df (pd.DataFrame): Biomass data. Its index gives the site labels.
+
+      years (list): Year columns to keep (default: every column whose name is a year).
+    """
+    if years is None:
+      years = [x for x in df.columns if str(x).isdigit()]
+    return cls(df["Latitude"].to_numpy(), df["Longitude"].to_numpy(),
+               df[[f"{x}" for x in years]].to_numpy(dtype = np.float32), years, df.index.to_numpy())
+
+  def __repr__(self):
+    span = f"{self.years[0]}..{self.years[-1]}" if self.years else "none"
+    return f"BiomassDataset(n_sites={len(self)}, years={span})"
+
+  def __len__(self):
+    return len(self.latitude)
+
+  @property
+  def n_sites(self):
+    return len(self.latitude)
+
+  def year_position(self, year):
+    """
+    Column of `year` (int or "2018") in the biomass matrix.
+    """
+    try:
+      return self._year_position[int(year)]
+    except (KeyError, ValueError):
+      raise KeyError(f"No biomass for year {year!r}, the dataset has {self.years}.") from None
+
+  def __getitem__(self, year):
+    """
+    Read-only float32 biomass of every site for `year`.
+    """
+    return self.biomass[:, self.year_position(year)]
+
+  def values(self, years):
+    """
+    (sites x len(years)) float32 biomass of the given years.
+    """
+    positions = [self.year_position(x) for x in years]
+    if positions == list(range(positions[0], positions[0] + len(positions))):
+      return self.biomass[:, positions[0]:positions[-1] + 1]
+    return self.biomass[:, positions]
+
+  def totals(self, years = None):
+    """
+    Total biomass (float64) of every year.
+    """
+    values = self.biomass if years is None else self.values(years)
+    return values.sum(0, dtype = np.float64)
+
+  def site(self, latitude, longitude):
+    """
+    Row of every (latitude, longitude): exact matches from the coordinate lookup,
+    the nearest site otherwise.
+
+    Returns:
+      int or np.ndarray: Row positions (not labels, see `index`).
+    """
+    lat, lon = np.atleast_1d(np.asarray(latitude, dtype = np.float64)), np.atleast_1d(np.asarray(longitude, dtype = np.float64))
+    rows = np.array([self._coordinate_index.get(x, -1) for x in zip(lat.tolist(), lon.tolist())], dtype = np.int64)
+
+    missing = rows < 0
+    if missing.any():
+      rows[missing] = self.site_index().nearest(lat[missing], lon[missing])
+
+    return int(rows[0]) if np.ndim(latitude) == 0 else rows
+
+  def site_index(self):
+    """
+    Ball tree of the sites (utils.SiteIndex), built on first use.
+    """
+    if self._site_index is None:
+      from utils import SiteIndex
+      self._site_index = SiteIndex(self.latitude, self.longitude)
+    return self._site_index
+
+  def take(self, rows):
+    """
+    Dataset of the sites at positions `rows`, keeping their labels.
+    """
+    rows = np.asarray(rows, dtype = np.int64)
+    return BiomassDataset(self.latitude[rows], self.longitude[rows], self.biomass[rows], self.years, self.index[rows])
+
+  def with_years(self, values, years):
+    """
+    Dataset with the biomass of `years` added, or replaced when the year exists.
+
+    Parameters:
+      values (np.ndarray): (sites x len(years)) biomass, e.g. a forecast.
+
+      years (list): Year of every column of `values`.
+    """
+    values = np.asarray(values, dtype = np.float32).reshape(len(self), -1)
+    years = [int(x) for x in years]
+    new_years = list(self.years) + [x for x in years if x not in self._year_position]
+
+    biomass = np.empty((len(self), len(new_years)), dtype = np.float32)
+    biomass[:, :len(self.years)] = self.biomass
+    position = {x: i for (i, x) in enumerate(new_years)}
+    for (column, year) in enumerate(years):
+      biomass[:, position[year]] = values[:, column]
+
+    return BiomassDataset(self.latitude, self.longitude, biomass, new_years, self.index)
+
+  def to_frame(self):
+    """
+    Biomass_History-like frame: Latitude, Longitude and one "yyyy" column per year.
+    """
+    df = pd.DataFrame({"Latitude": self.latitude, "Longitude": self.longitude}, index = self.index)
+    return pd.concat([df, pd.DataFrame(self.biomass, columns = [f"{x}" for x in self.years], index = self.index)],
+                     axis = 1)
+
+
+## Accessors for a DataFrame or a BiomassDataset
+
+def as_dataset(data, years = None):
+  """
+  `data` as a BiomassDataset (converted once when it is a DataFrame).
+  """
+  return data if isinstance(data, BiomassDataset) else BiomassDataset.from_frame(data, years)
+
+
+def as_frame(data):
+  """
+  `data` as a Biomass_History-like DataFrame (built when it is a BiomassDataset).
+  """
+  return data.to_frame() if isinstance(data, BiomassDataset) else data
+
+
+def data_years(data):
+  """
+  Years with biomass, as the frame column names or the dataset years.
+  """
+  if isinstance(data, BiomassDataset):
+    return list(data.years)
+  return [x for x in data.columns if str(x).isdigit()]
+
+
+def year_values(data, year, dtype = np.float64):
+  """
+  Biomass of every site for `year` (int or "2018").
+  """
+  if isinstance(data, BiomassDataset):
+    return np.asarray(data[year], dtype = dtype)
+  return data[f"{year}"].to_numpy(dtype = dtype)
+
+
+def year_matrix(data, years, dtype = np.float64):
+  """
+  (sites x len(years)) biomass of the given years.
+  """
+  if isinstance(data, BiomassDataset):
+    return np.asarray(data.values(years), dtype = dtype)
+  return data[[f"{x}" for x in years]].to_numpy(dtype = dtype)
+
+
+def site_coordinates(data):
+  """
+  Latitude and longitude (float64 arrays) of every site.
+  """
+  if isinstance(data, BiomassDataset):
+    return data.latitude, data.longitude
+  return data["Latitude"].to_numpy(dtype = np.float64), data["Longitude"].to_numpy(dtype = np.float64)
+
+
+def site_labels(data):
+  """
+  Site index of every row: the frame index or the dataset labels.
+  """
+  if isinstance(data, BiomassDataset):
+    return data.index
+  return data.index.to_numpy()
+
+
+def take_sites(data, rows):
+  """
+  The sites at positions `rows`, renumbered from 0 like `df.iloc[rows].reset_index(drop = True)`.
+  """
+  if isinstance(data, BiomassDataset):
+    subset = data.take(rows)
+    return BiomassDataset(subset.latitude, subset.longitude, subset.biomass, subset.years)
+  return data.iloc[np.asarray(rows)].reset_index(drop = True)
@@ -0,0 +1,420 @@
+"""
+NAME
+    decomposition.py
+
+DESCRIPTION
+    Spatial decomposition of the transportation problems
+    ============================================================
+
+    For grids much larger than 2418 sites, the site -> depot flows are split
+    into regions of a deterministic latitude x longitude grid. Every cell
+    takes an equal share of the sites, and the depots are assigned to the
+    cell they lie in. The flow problem of every region is solved with
+    min_cost_flow on its own slice of the distance matrix only, in-process
+    by default, or in worker processes of a pool the caller keeps open.
+
+    A coordinating repair pass then releases the regional flows of the
+    boundary sites, those whose cell edge and nearest depot of another cell
+    are closer than the farthest depot they ship to (plus a margin), and
+    solves them, together with the supply the regions could not place,
+    against the capacity slack of the depots of their own and neighbouring
+    cells and of their nearest depots. Only the supply these cannot take
+    is solved against every depot with slack left.
+
+    When the monolithic solution is given, the cost gap of the decomposed
+    flows is reported, to trade optimality for wall-clock time.
+
+PACKAGE LIST
+    numpy
+    pandas
+    sklearn
+"""
+
+## Libraries
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from network_flow import min_cost_flow
+from scorer import pair_distances
+from utils import SiteIndex, flows_to_frame
+from dataset import site_coordinates, year_values
+
+
+def grid_regions(latitude, longitude, grid = (2, 2)):
+  """
+  Region of every point in a (rows x cols) latitude x longitude grid.
+
+  The row edges are latitude quantiles and, inside every row, the column edges
+  are longitude quantiles, so the cells hold about the same number of points.
+
+  Parameters:
+    latitude (array): Latitude of the points.
+
+    longitude (array): Longitude of the points.
+
+    grid (tuple): Number of rows and columns.
+
+  Returns:
+    tuple: (region of every point, edges) where edges is (latitude edges,
+           longitude edges of every row), to place other points with assign_regions.
+
+  Example:
+      >>> regions, edges = grid_regions(df["Latitude"], df["Longitude"], grid = (2, 2))
+      >>> np.bincount(regions)
+      Output: array([605, 604, 605, 604])
+  """
+  latitude = np.asarray(latitude, dtype = np.float64)
+  longitude = np.asarray(longitude, dtype = np.float64)
+  n_rows, n_cols = grid
+
+  lat_edges = np.quantile(latitude, np.linspace(0, 1, n_rows + 1)[1:-1])
+  rows = np.searchsorted(lat_edges, latitude, side = "right")
+
+  lon_edges = np.zeros((n_rows, n_cols - 1))
+  for row in range(n_rows):
+    members = longitude[rows == row]
+    if len(members):
+      lon_edges[row] = np.quantile(members, np.linspace(0, 1, n_cols + 1)[1:-1])
+
+  edges = (lat_edges, lon_edges)
+  return assign_regions(latitude, longitude, edges), edges
+
+
+def assign_regions(latitude, longitude, edges):
+  """
+  Region of every point in the grid given by the `edges` of grid_regions.
+  """
+  lat_edges, lon_edges = edges
+  latitude = np.asarray(latitude, dtype = np.float64)
+  longitude = np.asarray(longitude, dtype = np.float64)
+  n_cols = lon_edges.shape[1] + 1
+
+  rows = np.searchsorted(lat_edges, latitude, side = "right")
+  cols = np.array([np.searchsorted(lon_edges[r], x, side = "right") for (r, x) in zip(rows, longitude)], dtype = np.int64)
+
+  return rows * n_cols + cols
+
+
+def region_neighbours(edges):
+  """
+  Regions sharing an edge or a corner with every region of the grid, the region included.
+
+  Parameters:
+    edges (tuple): Edges returned by grid_regions.
+
+  Returns:
+    list: Array of the neighbouring regions of every region.
+
+  Example:
+      >>> regions, edges = grid_regions(df["Latitude"], df["Longitude"], grid = (3, 3))
+      >>> region_neighbours(edges)[4]
+      Output: array([0, 1, 3, 4, 5, 6, 7, 8])
+  """
+  lat_edges, lon_edges = edges
+  n_rows, n_cols = len(lat_edges) + 1, lon_edges.shape[1] + 1
+  bounds = np.hstack([np.full((n_rows, 1), -np.inf), lon_edges, np.full((n_rows, 1), np.inf)])
+  left, right = bounds[:, :-1], bounds[:, 1:]
+
+  neighbours = []
+  for row in range(n_rows):
+    for col in range(n_cols):
+      near = [row * n_cols + x for x in range(max(col - 1, 0), min(col + 2, n_cols))]
+      # Cells of the rows above and below whose longitude range touches this cell
+      for other in (row - 1, row + 1):
+        if 0 <= other < n_rows:
+          touching = (left[other] <= right[row, col]) & (left[row, col] <= right[other])
+          near += [other * n_cols + x for x in np.flatnonzero(touching)]
+      neighbours.append(np.unique(near))
+
+  return neighbours
+
+
+def edge_distances(latitude, longitude, regions, edges):
+  """
+  Great-circle distance (km) from every point to the nearest inner edge of its region,
+  inf when the region has no neighbour.
+  """
+  lat_edges, lon_edges = edges
+  latitude = np.asarray(latitude, dtype = np.float64)
+  longitude = np.asarray(longitude, dtype = np.float64)
+  n_rows, n_cols = len(lat_edges) + 1, lon_edges.shape[1] + 1
+  rows, cols = np.asarray(regions) // n_cols, np.asarray(regions) % n_cols
+
+  lat_bounds = np.concatenate([[-np.inf], lat_edges, [np.inf]])
+  to_parallel = np.minimum(latitude - lat_bounds[rows], lat_bounds[rows + 1] - latitude)
+
+  lon_bounds = np.hstack([np.full((n_rows, 1), -np.inf), lon_edges, np.full((n_rows, 1), np.inf)])
+  to_meridian = np.minimum(longitude - lon_bounds[rows, cols], lon_bounds[rows, cols + 1] - longitude)
+  # Shortest arc to a meridian: asin(sin(dlon) cos(lat))
+  meridian_km = 6371.0 * np.arcsin(np.sin(np.radians(np.minimum(to_meridian, 90.0))) * np.cos(np.radians(latitude)))
+
+  return np.minimum(6371.0 * np.radians(to_parallel), np.where(np.isfinite(to_meridian), meridian_km, np.inf))
+
+
+def _submatrix(distance_matrix, rows, cols):
+  """
+  Distances between the sites `rows` and `cols` from a DistanceStore, DataFrame or array.
+  """
+  if hasattr(distance_matrix, "submatrix"):
+    return np.asarray(distance_matrix.submatrix(rows, cols), dtype = np.float64)
+
+  return np.asarray(distance_matrix, dtype = np.float64)[np.ix_(rows, cols)]
+
+
+def _solve_region(costs, supply, capacity):
+  """
+  Flows of one region (in a worker).
+  """
+  return min_cost_flow(costs, supply, capacity)
+
+
+def decomposed_flow(distance_matrix,
+                    source_idx,
+                    sink_idx,
+                    source_regions,
+                    sink_regions,
+                    supply,
+                    capacity,
+                    edges = None,
+                    boundary_margin = 25.0,
+                    n_nearest_sinks = 3,
+                    sink_coordinates = None,
+                    source_coordinates = None,
+                    n_jobs = 1,
+                    pool = None):
+  """
+  Transportation flows solved per region, then repaired across the region edges.
+
+  A source is on a boundary when an inner edge of its region, and the nearest sink of
+  another region, are closer than the farthest sink of its regional flows (plus
+  `boundary_margin`): only then can a sink across the edge be closer, as long as the
+  distances are not shorter than the great-circle ones.
+  The released sources and the supply the regions could not place are solved again
+  against the slack of the sinks of their region, of the neighbouring regions and of
+  their `n_nearest_sinks` nearest sinks. Supply left over is solved against every sink
+  with slack.
+
+  Parameters:
+    distance_matrix (np.ndarray, pd.DataFrame or DistanceStore): The full site distance matrix, in km.
+
+    source_idx (array): Site index of the sources.
+
+    sink_idx (array): Site index of the sinks.
+
+    source_regions (array): Region of every source.
+
+    sink_regions (array): Region of every sink.
+
+    supply (array): Amount available at every source.
+
+    capacity (array): Capacity of every sink.
+
+    edges (tuple): Edges of the region grid (grid_regions), for the boundary test and
+                   the neighbouring regions. None repairs the unplaced supply only.
+
+    boundary_margin (float): Distance (km) added to the farthest sink of a source in the boundary test.
+
+    n_nearest_sinks (int): Nearest sinks (by coordinates) a released source can also ship to.
+
+    sink_coordinates (np.ndarray): (Latitude, Longitude) of the sinks.
+
+    source_coordinates (np.ndarray): (Latitude, Longitude) of the sources.
+
+    n_jobs (int): Worker processes of a pool started for this call (None: cpu_count). The
+                  default 1 solves the regions in-process: a 2418-site region solves in
+                  milliseconds, far less than starting spawn workers.
+
+    pool (concurrent.futures.Executor): Open pool to solve the regions in, reused across
+                                        calls (e.g. every year of a run). Overrides n_jobs.
+
+  Returns:
+    tuple: (flow matrix sources x sinks, dict with the number of regions, of repaired
+           sources, of sources solved against every sink and the time of both passes)
+  """
+  source_idx, sink_idx = np.asarray(source_idx), np.asarray(sink_idx)
+  source_regions, sink_regions = np.asarray(source_regions), np.asarray(sink_regions)
+  supply = np.asarray(supply, dtype = np.float64)
+  capacity = np.asarray(capacity, dtype = np.float64)
+  eps = 1e-09 * max(1.0, float(supply.max(initial = 0)))
+
+  flows = np.zeros((len(source_idx), len(sink_idx)))
+  reach = np.zeros(len(source_idx))
+  regions = [r for r in np.unique(source_regions) if (sink_regions == r).any()]
+  members = [(np.flatnonzero(source_regions == r), np.flatnonzero(sink_regions == r)) for r in regions]
+
+  ## Regional pass: the slices are small, so they are sent to the workers as arrays
+  start = time.time()
+  tasks = [(_submatrix(distance_matrix, source_idx[rows], sink_idx[cols]), supply[rows], capacity[cols])
+           for (rows, cols) in members]
+  n_jobs = min(len(tasks), n_jobs or os.cpu_count() or 1)
+  if pool is not None and tasks:
+    results = list(pool.map(_solve_region, *zip(*tasks)))
+  elif n_jobs <= 1:
+    results = [_solve_region(*task) for task in tasks]
+  else:
+    with ProcessPoolExecutor(max_workers = n_jobs, mp_context = multiprocessing.get_context("spawn")) as pool:
+      results = list(pool.map(_solve_region, *zip(*tasks)))
+
+  for ((rows, cols), (costs, _, _), region_flows) in zip(members, tasks, results):
+    flows[np.ix_(rows, cols)] = region_flows
+    # Distance to the farthest sink of every source
+    reach[rows] = np.where(region_flows > eps, costs, 0).max(1, initial = 0)
+  regional_time = time.time() - start
+
+  ## Repair pass: the regional flows of the boundary sources are released, then these sources,
+  ## the sources of regions without sinks and the leftover supply are solved against the slack
+  ## of the sinks around them
+  start = time.time()
+  boundary = np.zeros(len(source_idx), dtype = bool)
+  if edges is not None and source_coordinates is not None:
+    across = edge_distances(source_coordinates[:, 0], source_coordinates[:, 1], source_regions, edges)
+    if sink_coordinates is not None:
+      # The nearest sink of another region is at least as far as the edge
+      for region in np.unique(source_regions):
+        rows, outside = np.flatnonzero(source_regions == region), np.flatnonzero(sink_regions != region)
+        if len(outside) == 0:
+          across[rows] = np.inf
+          continue
+        distances, _ = SiteIndex(sink_coordinates[outside, 0], sink_coordinates[outside, 1]).query(
+          source_coordinates[rows, 0], source_coordinates[rows, 1])
+        across[rows] = np.maximum(across[rows], distances[:, 0])
+    boundary = across < reach + boundary_margin
+  rows = np.flatnonzero(boundary | (supply - flows.sum(1) > eps))
+
+  left = rows[:0]
+  if len(rows):
+    flows[rows] = 0.0
+    slack = np.maximum(capacity - flows.sum(0), 0)
+    neighbours = region_neighbours(edges) if edges is not None else None
+
+    nearest = np.empty((len(rows), 0), dtype = np.int64)
+    if sink_coordinates is not None and source_coordinates is not None and n_nearest_sinks > 0:
+      _, nearest = SiteIndex(sink_coordinates[:, 0], sink_coordinates[:, 1]).query(
+        source_coordinates[rows, 0], source_coordinates[rows, 1], k = min(n_nearest_sinks, len(sink_idx)))
+
+    # Candidate sinks of the released sources of every region, read block by block
+    blocks = []
+    for region in np.unique(source_regions[rows]):
+      released = np.flatnonzero(source_regions[rows] == region)
+      near = neighbours[region] if neighbours is not None else [region]
+      cols = np.union1d(np.flatnonzero(np.isin(sink_regions, near)), nearest[released].reshape(-1))
+      cols = cols[slack[cols] > eps]
+      if len(cols):
+        blocks.append((released, cols))
+
+    if blocks:
+      columns = np.unique(np.concatenate([cols for (_, cols) in blocks]))
+      costs = np.full((len(rows), len(columns)), np.inf)
+      for (released, cols) in blocks:
+        costs[np.ix_(released, np.searchsorted(columns, cols))] = _submatrix(distance_matrix, source_idx[rows[released]],
+                                                                             sink_idx[cols])
+      flows[np.ix_(rows, columns)] = min_cost_flow(costs, supply[rows], slack[columns])
+
+    # Supply the sinks around its source cannot take
+    left = rows[supply[rows] - flows[rows].sum(1) > eps]
+    slack = np.maximum(capacity - flows.sum(0), 0)
+    open_sinks = np.flatnonzero(slack > eps)
+    if len(left) and len(open_sinks):
+      flows[np.ix_(left, open_sinks)] += min_cost_flow(_submatrix(distance_matrix, source_idx[left], sink_idx[open_sinks]),
+                                                       supply[left] - flows[left].sum(1), slack[open_sinks])
+
+  info = {"regions": len(regions),
+          "repaired_sources": len(rows),
+          "global_sources": len(left),
+          "regional_time": regional_time,
+          "repair_time": time.time() - start}
+
+  return flows, info
+
+
+def flow_cost(flow_rows, distance_matrix):
+  """
+  Transport cost (distance x amount) of biomass or pellet rows.
+  """
+  distances = pair_distances(distance_matrix, flow_rows["source_index"].to_numpy(dtype = np.int64),
+                             flow_rows["destination_index"].to_numpy(dtype = np.int64))
+  return float((distances * flow_rows["value"].to_numpy(dtype = np.float64)).sum())
+
+
+def BiomassDemandSupplyDecomposed(demand_history,
+                                  depot_location,
+                                  distance_matrix,
+                                  year,
+                                  processing_capacities = 20000,
+                                  min_processed_ratio = 0.8,
+                                  grid = (2, 2),
+                                  boundary_margin = 25.0,
+                                  n_jobs = 1,
+                                  pool = None,
+                                  reference = None):
+  """
+  Site -> depot biomass flows solved region by region.
+
+  Same output as BiomassDemandSupplyFlow. Every site ships its whole biomass when the
+  depots can take it, otherwise the depots are filled.
+
+  Parameters:
+    demand_history (pd.DataFrame or BiomassDataset): Biomass data with Latitude, Longitude and one column per year.
+
+    depot_location (pd.DataFrame): Depot rows with their site index in "source_index".
+
+    distance_matrix (pd.DataFrame or DistanceStore): The full site distance matrix.
+
+    year (int): Year whose forecasted biomass is supplied to the depots.
+
+    processing_capacities (int): Yearly processing capacity of each depot.
+
+    min_processed_ratio (float): Share of the forecasted biomass that must be processed.
+
+    grid (tuple): Rows and columns of the region grid.
+
+    boundary_margin (float): Margin (km) of the boundary test of decomposed_flow. Larger
+                             margins repair more sites, closer to the monolithic cost.
+
+    n_jobs (int), pool (concurrent.futures.Executor): Where the regions are solved, see decomposed_flow.
+
+    reference (pd.DataFrame): Monolithic biomass_demand_supply rows of the year, e.g. from
+                              BiomassDemandSupplyFlow, to report the optimality gap.
+
+  Returns:
+    dataframe: The biomass_demand_supply rows, or None when the depots cannot
+               process `min_processed_ratio` of the biomass.
+
+  Example:
+      >>> BiomassDemandSupplyDecomposed(DemandHistory, depot_location, DistanceMatrix, 2018,
+                                        grid = (3, 3), reference = biomass_supply_2018)
+      Output: 8 regions, 1239 sites repaired, 0.01s + 0.01s
+              Transport cost 14979731.0 | monolithic 14875857.6 | gap 0.70%
+  """
+  biomass_capacities = year_values(demand_history, year)
+  depots_idx = depot_location["source_index"].to_numpy(dtype = np.int64)
+  sites_idx = np.arange(len(demand_history))
+
+  overallDepotCapacity = len(depots_idx) * processing_capacities
+  if overallDepotCapacity < min_processed_ratio * biomass_capacities.sum():
+    print(f"Problem Status: infeasible, depots capacity {overallDepotCapacity} < required biomass")
+    return None
+
+  coordinates = np.column_stack(site_coordinates(demand_history))
+  site_regions, edges = grid_regions(coordinates[:, 0], coordinates[:, 1], grid)
+  depot_regions = site_regions[depots_idx]
+
+  flows, info = decomposed_flow(distance_matrix, sites_idx, depots_idx, site_regions, depot_regions,
+                                biomass_capacities, np.full(len(depots_idx), float(processing_capacities)),
+                                edges = edges, boundary_margin = boundary_margin,
+                                sink_coordinates = coordinates[depots_idx], source_coordinates = coordinates,
+                                n_jobs = n_jobs, pool = pool)
+  print(f"{info['regions']} regions, {info['repaired_sources']} sites repaired, "
+        f"{info['regional_time']:.2f}s + {info['repair_time']:.2f}s")
+
+  result = flows_to_frame(flows, sites_idx, depots_idx, year, "biomass_demand_supply")
+
+  if reference is not None:
+    cost, monolithic = flow_cost(result, distance_matrix), flow_cost(reference, distance_matrix)
+    print(f"Transport cost {cost:.1f} | monolithic {monolithic:.1f} | gap {100 * (cost / monolithic - 1):.2f}%")
+
+  return result
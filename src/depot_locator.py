@@ -1,10 +1,16 @@
 ## Libraries
 import json
+import math
+import time
 import numpy as np
 import pandas as pd
 from visualize import plot_map
-from utils import cluster_data, haversine_distance
+from utils import cluster_data, haversine_one_to_many, haversine_pairwise, SiteIndex
+from network_flow import min_cost_flow
+from instrumentation import instrumented, record
+from dataset import as_frame, site_coordinates, site_labels, take_sites, year_matrix, year_values
 
+@instrumented
 def center_of_gravity_method(df):
   """
   The COG is the weighted average of the latitude, longitude, and demand,
@@ -14,7 +20,7 @@ def center_of_gravity_method(df):
   It locates just one facility in a location
 
   Parameters:
-    df (pd.DataFrame): A dataframe containing the biomass demand data for different years and
+    df (pd.DataFrame or BiomassDataset): A dataframe containing the biomass demand data for different years and
                       the harvesting locations latitude and longitude for one cluster of the whole location.
   Example:
       >>> df         :| 	|  Latitude	 | Longitude	|  2010	     | 2011	     |  ...  | 2014	      |
@@ -30,36 +36,46 @@ def center_of_gravity_method(df):
       Output: [24.66818, 71.33144]
   """
 
-  data = df[["Latitude", "Longitude" , "2017"]].values
+  cog_latitude, cog_longitude = center_of_gravity(df)
 
-  # Calculate the Center of Gravity (COG) for the entire dataset
-  cog_latitude = np.sum(data[:, 0] * data[:, 2]) / np.sum(data[:, 2])
-  cog_longitude = np.sum(data[:, 1] * data[:, 2]) / np.sum(data[:, 2])
+  # Snap the COG to the closest grid point of the cluster
+  latitudes, longitudes = site_coordinates(df)
+  closet_grid = int(np.argmin(haversine_one_to_many(cog_latitude, cog_longitude, latitudes, longitudes)))
+  facility_location = [float(latitudes[closet_grid]), float(longitudes[closet_grid])]
 
-  grid_distance = {}
-  for x in df[["Latitude","Longitude"]].values:
-    lat, lon = x[0], x[1]
-    key = str(lat) + "_" + str(lon)
-    value = haversine_distance(cog_latitude, cog_longitude, lat, lon)
-    grid_distance[key] = value
+  return facility_location
 
-  closet_grid = min(grid_distance, key=grid_distance.get)
-  fac_lat, fac_lon = closet_grid.split("_")
-  facility_location = [float(fac_lat), float(fac_lon)]
 
-  return facility_location
+def center_of_gravity(df, year = "2017"):
+  """
+  Demand-weighted average latitude and longitude of the harvesting sites in `df`.
+
+  Returns:
+    tuple: (latitude, longitude) of the center of gravity, not snapped to a grid point.
+  """
+  latitude, longitude = site_coordinates(df)
+  weights = year_values(df, year)
+
+  # Calculate the Center of Gravity (COG) for the entire dataset
+  cog_latitude = np.sum(latitude * weights) / np.sum(weights)
+  cog_longitude = np.sum(longitude * weights) / np.sum(weights)
+
+  return cog_latitude, cog_longitude
 
 
+@instrumented
 def DepotLocator(df,
                     years = [],
                     facility_capacity = 20000,
-                    facility_type = "depots"):
+                    facility_type = "depots",
+                    seed = 42,
+                    plot = False):
   """
   Optimal facility location using clustering and center of gravity method.
 
   Parameters:
-    df (pd.DataFrame): A dataframe containing the biomass demand data for different years and
-                      the harvesting locations latitude and longitude.
+    df (pd.DataFrame or BiomassDataset): A dataframe containing the biomass demand data for different
+                      years and the harvesting locations latitude and longitude. It is not modified.
 
     years (array): Array of years whose biomass demand data will be used to determine the needed
                     number of facilities.
@@ -68,6 +84,11 @@ def DepotLocator(df,
 
     facility_type (str): The type of facilities to be located.
 
+    seed (int): Random state of the KMeans clusterings.
+
+    plot (bool or str): Draw the map of the clusters and depots. A file path saves it
+                        there (headless) instead of showing it.
+
   Returns:
     dataframe: A dataframe whose rows represent the optimal locations (Latitude and Longitude) of
                 the facilities.
@@ -96,27 +117,31 @@ def DepotLocator(df,
   import json
 
   ### Year with the maximum total biomass harvest
-  years_total_biomass = df[years].sum().to_dict()
+  years_total_biomass = {x: year_values(df, x).sum() for x in years}
   year = max(years_total_biomass, key=years_total_biomass.get)
 
   ## Total number of needed Facilities
   total_facility_needed = math.ceil(years_total_biomass[year] / facility_capacity)
 
   print("Total Needed Facilities : ", total_facility_needed)
+  record(sites = len(df), facilities_needed = total_facility_needed)
 
-  ## Divide the whole location into different clusters
-  df["Clusters"] = cluster_data(df = df,
-                                n_clusters = 4)
+  ## Divide the whole location into different clusters (kept out of `df`, which is not modified)
+  clusters = cluster_data(df = df,
+                          n_clusters = 4,
+                          random_state = seed)
+  cluster_biomass = pd.Series(year_values(df, year)).groupby(clusters).sum()
 
-  needed_facilities = (df.groupby("Clusters")[f"{year}"].agg("sum") / facility_capacity).to_dict()
+  needed_facilities = (cluster_biomass / facility_capacity).to_dict()
 
   print("Needed Facilities :", json.dumps(needed_facilities, indent=4))
 
-  assigned_facilities = round(df.groupby("Clusters")[f"{year}"].agg("sum") / facility_capacity).to_dict()
+  assigned_facilities = round(cluster_biomass / facility_capacity).to_dict()
 
   print("Assigned Facilities :", json.dumps(assigned_facilities, indent=4))
 
   total_assigned_facilities = sum(assigned_facilities.values())
+  record(facilities_assigned = total_assigned_facilities)
 
   if total_assigned_facilities > total_facility_needed:
     print(f"The total assigned {facility_type} is greater than the needed facilities by {total_assigned_facilities - total_facility_needed} {facility_type}")
@@ -135,54 +160,201 @@ def DepotLocator(df,
   facilities_locations = []
 
   for cluster, n_cluster in assigned_facilities.items():
-    temp_df = df[df["Clusters"].eq(cluster)].reset_index(drop=True)
-    temp_df["new_Clusters"] = cluster_data(df = temp_df,
-                                  n_clusters = int(n_cluster))
+    temp_df = take_sites(df, np.flatnonzero(clusters == cluster))
+    new_clusters = cluster_data(df = temp_df,
+                                n_clusters = int(n_cluster),
+                                random_state = seed)
 
     for new_cluster in range(int(n_cluster)):
-      new_df = temp_df[temp_df["new_Clusters"].eq(new_cluster)].reset_index(drop=True)
-      facility_location = center_of_gravity_method(new_df)
-      facilities_locations.append(facility_location)
+      new_df = take_sites(temp_df, np.flatnonzero(new_clusters == new_cluster))
+      facilities_locations.append(center_of_gravity(new_df))
 
   if total_assigned_facilities < total_facility_needed:
     result_dict = {key: needed_facilities[key] - assigned_facilities[key] if needed_facilities[key] - assigned_facilities[key] > 0 else 0  for key in assigned_facilities}
     filtered_keys = [key for key, value in result_dict.items() if value > 0]
 
-    extra_facility_df = df[df["Clusters"].isin(filtered_keys)].reset_index(drop=True)
+    extra_facility_df = take_sites(df, np.flatnonzero(np.isin(clusters, filtered_keys)))
     extra_facilities_needed = total_facility_needed - total_assigned_facilities
     print(f"extra_facilities_needed: {extra_facilities_needed}")
 
     if extra_facilities_needed > 1:
 
-      extra_facility_df["new_Clusters"] = cluster_data(df = extra_facility_df,
-                                  n_clusters = int(extra_facilities_needed))
+      new_clusters = cluster_data(df = extra_facility_df,
+                                  n_clusters = int(extra_facilities_needed),
+                                  random_state = seed)
 
       for new_cluster_ in range(int(extra_facilities_needed)):
-        new_df = extra_facility_df[extra_facility_df["new_Clusters"].eq(new_cluster_)].reset_index(drop=True)
-        facility_location = center_of_gravity_method(new_df)
+        new_df = take_sites(extra_facility_df, np.flatnonzero(new_clusters == new_cluster_))
+        facility_location = center_of_gravity(new_df)
         print(f"Extra Facilities: {facility_location}")
         facilities_locations.append(facility_location)
 
     else:
-      facility_location = center_of_gravity_method(extra_facility_df)
+      facility_location = center_of_gravity(extra_facility_df)
       print(f"Extra Facilities: {facility_location}")
       facilities_locations.append(facility_location)
 
-  facility_data = pd.DataFrame(facilities_locations, columns = ["Latitude","Longitude"])
+  ## Snap every COG to its nearest harvesting site
+  cog = np.array(facilities_locations).reshape(-1, 2)
+  site_index = SiteIndex(*site_coordinates(df))
+  sites_pos = site_index.nearest(cog[:, 0], cog[:, 1])
+
+  facility_data = pd.DataFrame({"Latitude": site_index.latitude[sites_pos],
+                                "Longitude": site_index.longitude[sites_pos]})
   facility_data["year"] = int(f"{years[0]}{years[1]}")
   facility_data["data_type"] = "depot_location"
   facility_data["destination_index"] = 0
   facility_data["value"] = 0
+  facility_data["source_index"] = site_labels(df)[sites_pos]
+
 
-  latlong_idx = {y:x for (x,y) in (df["Latitude"].astype(str) + "_" + df["Longitude"].astype(str)).to_dict().items()}
+  if plot:
+    plot_map(df = as_frame(df).assign(Clusters = clusters),
+            year = year,
+            depot_data = facility_data,
+            refinery_data = None,
+            cluster_col = "Clusters",
+            path = plot if isinstance(plot, str) else None)
 
-  facility_data["source_index"] = (facility_data["Latitude"].astype(str) + "_" + facility_data["Longitude"].astype(str)).map(latlong_idx)
+  return facility_data
 
 
-  plot_map(df = df,
-          year = year,
-          depot_data = facility_data,
-          refinery_data = None,
-          cluster_col = "Clusters")
+def _seed_choice(rng, score, facilities):
+  """
+  Site drawn with probability proportional to `score`, never one of `facilities`.
+  Uniform over the other sites when every score is 0 (more facilities than sites with biomass).
+  """
+  score = np.array(score, dtype = np.float64)
+  score[facilities] = 0
+  total = score.sum()
+  if not total > 0:
+    score = np.ones(len(score))
+    score[facilities] = 0
+    total = score.sum()
+  return int(rng.choice(len(score), p = score / total))
+
+
+def _distance_block(df, distance_matrix):
+  """
+  Function returning the float64 distances between two lists of site positions, read
+  from `distance_matrix` (array, DataFrame or DistanceStore) without copying it whole,
+  or the haversine distances when it is None.
+  """
+  if distance_matrix is None:
+    latitude, longitude = site_coordinates(df)
+    return lambda rows, cols: haversine_pairwise(latitude[rows], longitude[rows], latitude[cols], longitude[cols])
+  if hasattr(distance_matrix, "submatrix"):
+    return lambda rows, cols: np.asarray(distance_matrix.submatrix(rows, cols), dtype = np.float64)
+
+  # An array or a DataFrame of one dtype is read in place
+  values = distance_matrix.to_numpy() if isinstance(distance_matrix, pd.DataFrame) else np.asarray(distance_matrix)
+  return lambda rows, cols: values[np.ix_(rows, cols)].astype(np.float64)
+
+
+@instrumented
+def CapacitatedDepotLocator(df,
+                            years = [],
+                            facility_capacity = 20000,
+                            max_facilities = 25,
+                            distance_matrix = None,
+                            seed = 47,
+                            time_limit = 1.0):
+  """
+  Capacity-aware depot placement by alternating assignment and relocation.
+
+  Depots are seeded with a demand-weighted k-means++ draw over the harvesting sites, then
+  the two steps below are repeated until the depot set stops changing or `time_limit`
+  seconds have passed:
+    - assignment: the biomass of the year with the largest harvest is sent to the depots
+      with min_cost_flow, so no depot receives more than `facility_capacity`;
+    - relocation: every depot moves to the site, among those it was assigned, minimising
+      the transport cost of their biomass.
+
+  Only the distance columns of the depots and the blocks between the sites of every
+  depot are read from the distance matrix (or memory-mapped DistanceStore), which is
+  never copied whole, so the placement can be repeated many times in scenario sweeps.
+
+  Parameters:
+    df (pd.DataFrame or BiomassDataset): Biomass data with the harvesting sites latitude and longitude.
+
+    years (array): Years whose biomass decides the number of depots and the assignment.
+
+    facility_capacity (int): The capacity of each depot.
+
+    max_facilities (int): Maximum number of depots.
+
+    distance_matrix (np.ndarray, pd.DataFrame or DistanceStore): Site distance matrix. When None
+                                                                 the haversine distances are used.
+
+    seed (int): Seed of the initial draw.
+
+    time_limit (float): Seconds given to the search, None for no limit.
+
+  Returns:
+    dataframe: The depot_location rows, in the same format as DepotLocator.
+  """
+  start = time.perf_counter()
+  rng = np.random.default_rng(seed)
+
+  biomass = year_matrix(df, years)
+  yearly_total = biomass.sum(0)
+  weights = biomass[:, int(np.argmax(yearly_total))]
+
+  n_facilities = min(max_facilities, int(math.ceil(yearly_total.max() / facility_capacity)))
+  print("Total Needed Facilities : ", n_facilities)
+  record(sites = len(df), facilities_needed = n_facilities)
+
+  block = _distance_block(df, distance_matrix)
+  sites = np.arange(len(weights))
+
+  ## Demand-weighted k-means++ seeding
+  facilities = [_seed_choice(rng, weights, [])]
+  nearest = block(sites, facilities)[:, 0]
+  for _ in range(n_facilities - 1):
+    facilities.append(_seed_choice(rng, weights * nearest ** 2, facilities))
+    nearest = np.minimum(nearest, block(sites, facilities[-1:])[:, 0])
+
+  capacities = np.full(n_facilities, float(facility_capacity))
+  best_cost, best_facilities = np.inf, list(facilities)
+
+  while True:
+    costs = block(sites, facilities)
+    flows = min_cost_flow(costs, weights, capacities)
+    cost = float(np.sum(flows * costs))
+    if cost >= best_cost - 1e-06:
+      break
+    best_cost, best_facilities = cost, list(facilities)
+
+    if time_limit is not None and time.perf_counter() - start >= time_limit:
+      break
+
+    ## Move every depot to the site of its assigned sites minimising the cost of their
+    ## biomass, busiest depots first so two depots never share a site
+    moved = list(facilities)
+    taken = []
+    for j in np.argsort(-flows.sum(0), kind = "stable"):
+      assigned = np.flatnonzero(flows[:, j] > 0)
+      candidates = np.setdiff1d(np.append(assigned, facilities[j]), taken)
+      if len(candidates) == 0:
+        candidates = np.setdiff1d(sites, taken)
+      candidate_cost = flows[assigned, j] @ block(assigned, candidates)
+      moved[j] = int(candidates[np.argmin(candidate_cost)])
+      taken.append(moved[j])
+
+    if moved == facilities:
+      break
+    facilities = moved
+
+  print(f"Minimum Cost Value: {best_cost}")
+  record(cost = best_cost)
+
+  latitude, longitude = site_coordinates(df)
+  facility_data = pd.DataFrame({"Latitude": latitude[best_facilities],
+                                "Longitude": longitude[best_facilities]})
+  facility_data["year"] = int(f"{years[0]}{years[1]}")
+  facility_data["data_type"] = "depot_location"
+  facility_data["destination_index"] = 0
+  facility_data["value"] = 0
+  facility_data["source_index"] = site_labels(df)[best_facilities]
 
-  return facility_data
\ No newline at end of file
+  return facility_data
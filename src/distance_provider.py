@@ -0,0 +1,253 @@
+"""
+NAME
+    distance_provider.py
+
+DESCRIPTION
+    Distance providers for instances too large for a dense matrix
+    ============================================================
+
+    The optimisation code reads distances through a small interface:
+    rows(), cols(), submatrix(), pairs() and the `iloc` indexer returning
+    DataFrames. DistanceStore (distance_store.py) is the dense provider;
+    this module adds two providers that never hold the n x n matrix:
+
+      - HaversineDistances computes great-circle distances on the fly,
+        vectorised over the requested block;
+      - KNearestDistances keeps, for every site, the distances to its k
+        nearest candidate sites only, found with a ball tree and stored as a
+        CSR graph (indptr, indices, data).
+
+    Every provider also gives its plausible arcs with arcs(). A pair that is
+    not an arc of the graph has an infinite distance, and BiomassDemandSupply,
+    RefineryLocator and the scorer only create variables (or costs) for the
+    finite ones.
+
+PACKAGE LIST
+    numpy
+    pandas
+    sklearn
+"""
+
+## Libraries
+import numpy as np
+import pandas as pd
+from distance_store import _StoreIndexer
+from utils import SiteIndex, haversine_pairwise, haversine_distance
+
+
+class _Provider():
+  """
+  class _Provider()
+
+  Shared indexing of the providers: subclasses implement submatrix() and pairs().
+  """
+
+  def __len__(self):
+    return self.n_sites
+
+  def _index(self, idx):
+    if idx is None:
+      return np.arange(self.n_sites)
+    if isinstance(idx, slice):
+      return np.arange(self.n_sites)[idx]
+    return np.asarray(idx, dtype = np.int64).reshape(-1)
+
+  def rows(self, idx = None):
+    """
+    Distance rows of the given sites, shape (len(idx), n_sites).
+    """
+    return self.submatrix(idx, None)
+
+  def cols(self, idx = None):
+    """
+    Distance columns of the given sites, shape (n_sites, len(idx)).
+    """
+    return self.submatrix(None, idx)
+
+  def arcs(self, rows = None, cols = None):
+    """
+    Finite distances between the `rows` and `cols` sites.
+
+    Returns:
+      tuple: Positions in `rows`, positions in `cols` and distances of every arc.
+    """
+    distances = self.submatrix(rows, cols)
+    row_pos, col_pos = np.nonzero(np.isfinite(distances))
+    return row_pos, col_pos, distances[row_pos, col_pos]
+
+  def to_frame(self, rows = None, cols = None):
+    """
+    DataFrame with integer row index and string column names, like DistanceStore.to_frame.
+    """
+    return pd.DataFrame(self.submatrix(rows, cols),
+                        index = self._index(rows),
+                        columns = self._index(cols).astype(str))
+
+  @property
+  def iloc(self):
+    return _StoreIndexer(self)
+
+
+class HaversineDistances(_Provider):
+  """
+  class HaversineDistances()
+
+  Great-circle distances (km) computed for the requested block only.
+
+  Example:
+      >>> distances = HaversineDistances(df["Latitude"], df["Longitude"])
+      >>> DepotsDistanceMatrix = distances.iloc[:, depots_idx]
+  """
+
+  def __init__(self, latitude, longitude):
+    self.latitude = np.asarray(latitude, dtype = np.float64)
+    self.longitude = np.asarray(longitude, dtype = np.float64)
+    self.n_sites = len(self.latitude)
+    self.shape = (self.n_sites, self.n_sites)
+
+  def __repr__(self):
+    return f"HaversineDistances(n_sites={self.n_sites})"
+
+  def submatrix(self, rows = None, cols = None):
+    """
+    Distances between the `rows` sites and the `cols` sites, shape (len(rows), len(cols)).
+    """
+    rows, cols = self._index(rows), self._index(cols)
+    return haversine_pairwise(self.latitude[rows], self.longitude[rows],
+                              self.latitude[cols], self.longitude[cols])
+
+  def pairs(self, rows, cols):
+    """
+    Distance between rows[k] and cols[k] for every k.
+    """
+    rows, cols = self._index(rows), self._index(cols)
+    return haversine_distance(self.latitude[rows], self.longitude[rows],
+                              self.latitude[cols], self.longitude[cols])
+
+
+class KNearestDistances(_Provider):
+  """
+  class KNearestDistances()
+
+  Sparse graph of the k nearest candidate sites of every site.
+
+  Row i holds the distances from site i to its k nearest candidates, sorted by
+  column. Any other pair is not an arc and has an infinite distance. The graph
+  is kept as three CSR arrays, and a pair is looked up with one binary search
+  on the sorted keys row * n_sites + column.
+
+  Example:
+      >>> # Every site to its 5 nearest depots, for BiomassDemandSupply
+      >>> graph = KNearestDistances.build(df["Latitude"], df["Longitude"], k = 5, candidates = depots_idx)
+      >>> BiomassDemandSupply(df, graph.iloc[:, depots_idx], 2018)
+      >>> # Every site to its 200 nearest sites, road distances taken from the dense store
+      >>> graph = KNearestDistances.build(df["Latitude"], df["Longitude"], k = 200, base = store)
+      >>> graph.save("data/interim/knn_200.npz")
+  """
+
+  def __init__(self, indptr, indices, data, n_sites = None):
+    self.indptr = np.asarray(indptr, dtype = np.int64)
+    self.indices = np.asarray(indices, dtype = np.int64)
+    self.data = np.asarray(data, dtype = np.float32)
+    self.n_sites = int(n_sites) if n_sites is not None else len(self.indptr) - 1
+    self.shape = (len(self.indptr) - 1, self.n_sites)
+
+    row = np.repeat(np.arange(self.shape[0], dtype = np.int64), np.diff(self.indptr))
+    self._keys = row * self.n_sites + self.indices
+
+  def __repr__(self):
+    return f"KNearestDistances(n_sites={self.n_sites}, arcs={len(self.data)})"
+
+  @classmethod
+  def build(cls, latitude, longitude, k = 50, candidates = None, base = None):
+    """
+    Graph of the k nearest candidates of every site, found with a haversine ball tree.
+
+    Parameters:
+      latitude (array): Latitude of every site.
+
+      longitude (array): Longitude of every site.
+
+      k (int): Arcs per site.
+
+      candidates (array): Site index of the possible destinations (default: every site).
+
+      base (DistanceStore or provider): Source of the arc distances, e.g. road distances.
+                                        The haversine distances are used when None.
+
+    Returns:
+      KNearestDistances
+    """
+    latitude = np.asarray(latitude, dtype = np.float64)
+    longitude = np.asarray(longitude, dtype = np.float64)
+    n_sites = len(latitude)
+    candidates = np.arange(n_sites) if candidates is None else np.asarray(candidates, dtype = np.int64)
+    k = min(k, len(candidates))
+
+    tree = SiteIndex(latitude[candidates], longitude[candidates])
+    distances, positions = tree.query(latitude, longitude, k = k)
+
+    order = np.argsort(candidates[positions], axis = 1, kind = "stable")
+    indices = np.take_along_axis(candidates[positions], order, axis = 1).reshape(-1)
+    data = np.take_along_axis(distances, order, axis = 1).reshape(-1)
+    if base is not None:
+      data = np.asarray(base.pairs(np.repeat(np.arange(n_sites), k), indices))
+
+    return cls(np.arange(n_sites + 1) * k, indices, data, n_sites)
+
+  def save(self, path):
+    """
+    Save the graph to a .npz file.
+    """
+    np.savez(path, indptr = self.indptr, indices = self.indices, data = self.data, n_sites = self.n_sites)
+
+  @classmethod
+  def load(cls, path):
+    """
+    Graph saved with save().
+    """
+    with np.load(path) as f:
+      return cls(f["indptr"], f["indices"], f["data"], int(f["n_sites"]))
+
+  def pairs(self, rows, cols):
+    """
+    Distance between rows[k] and cols[k] for every k (inf when it is not an arc).
+    """
+    rows, cols = self._index(rows), self._index(cols)
+    keys = rows * self.n_sites + cols
+    pos = np.minimum(np.searchsorted(self._keys, keys), max(len(self._keys) - 1, 0))
+
+    out = np.full(len(keys), np.inf)
+    found = self._keys[pos] == keys if len(self._keys) else np.zeros(len(keys), dtype = bool)
+    out[found] = self.data[pos[found]]
+    return out
+
+  def arcs(self, rows = None, cols = None):
+    """
+    Arcs between the `rows` and `cols` sites, read from the graph without a dense block.
+
+    Returns:
+      tuple: Positions in `rows`, positions in `cols` and distances of every arc.
+    """
+    rows, cols = self._index(rows), self._index(cols)
+    col_pos = np.full(self.n_sites, -1)
+    col_pos[cols] = np.arange(len(cols))
+
+    starts, counts = self.indptr[rows], np.diff(self.indptr)[rows]
+    row_pos = np.repeat(np.arange(len(rows)), counts)
+    entries = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+    keep = col_pos[self.indices[entries]] >= 0
+    entries = entries[keep]
+    return row_pos[keep], col_pos[self.indices[entries]], self.data[entries].astype(np.float64)
+
+  def submatrix(self, rows = None, cols = None):
+    """
+    Distances between the `rows` sites and the `cols` sites, inf where there is no arc.
+    """
+    rows, cols = self._index(rows), self._index(cols)
+    out = np.full((len(rows), len(cols)), np.inf)
+    row_pos, col_pos, distances = self.arcs(rows, cols)
+    out[row_pos, col_pos] = distances
+    return out
+
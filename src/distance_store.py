@@ -0,0 +1,259 @@
+"""
+NAME
+    distance_store.py
+
+DESCRIPTION
+    Binary, memory-mapped storage of the site distance matrix
+    ============================================================
+
+    distance_store.py converts data/raw/Distance_Matrix.csv once into a
+    compact float32 .npy file and opens it zero-copy through numpy.memmap,
+    so later runs (and several worker processes) share one page-cache copy
+    instead of re-parsing the csv.
+
+    The matrix can be stored dense (n x n) or, since it is symmetric, as a
+    packed upper triangle (n * (n + 1) / 2 values).
+
+PACKAGE LIST
+    numpy
+    pandas
+"""
+
+## Libraries
+import os
+import numpy as np
+import pandas as pd
+
+
+def build_distance_store(csv_path,
+                         store_path,
+                         upper_triangle = False,
+                         chunksize = 256):
+  """
+  Convert the distance matrix csv into a float32 .npy store.
+
+  The csv is read in chunks of rows and written straight into a memory-mapped
+  .npy file, so the full float64 table is never materialised.
+
+  Parameters:
+    csv_path (str): Path of the Distance_Matrix.csv file.
+
+    store_path (str): Path of the .npy file to create.
+
+    upper_triangle (bool): Store only the packed upper triangle (diagonal included).
+
+    chunksize (int): Number of csv rows parsed at a time.
+
+  Returns:
+    DistanceStore: The freshly written store, opened read-only.
+
+  Example:
+      >>> store = build_distance_store("data/raw/Distance_Matrix.csv",
+                                       "data/interim/Distance_Matrix.npy")
+      >>> store.shape
+      Output: (2418, 2418)
+  """
+  header = pd.read_csv(csv_path, nrows = 0, index_col = 0)
+  n_sites = header.shape[1]
+
+  shape = (n_sites * (n_sites + 1) // 2,) if upper_triangle else (n_sites, n_sites)
+  out = np.lib.format.open_memmap(store_path, mode = "w+", dtype = np.float32, shape = shape)
+
+  row = 0
+  for chunk in pd.read_csv(csv_path, index_col = 0, chunksize = chunksize, dtype = np.float32):
+    values = chunk.to_numpy(dtype = np.float32)
+    if upper_triangle:
+      for offset, values_row in enumerate(values):
+        i = row + offset
+        start = _packed_offset(i, n_sites)
+        out[start:start + n_sites - i] = values_row[i:]
+    else:
+      out[row:row + len(values)] = values
+    row += len(values)
+
+  if row != n_sites:
+    raise ValueError(f"Distance matrix is not square: {row} rows for {n_sites} columns.")
+
+  out.flush()
+  del out
+
+  return DistanceStore(store_path)
+
+
+def load_distance_store(store_path, csv_path = None, upper_triangle = False):
+  """
+  Open the distance store, converting the csv first if the store does not exist yet.
+
+  Parameters:
+    store_path (str): Path of the .npy store.
+
+    csv_path (str): Path of the csv used to build the store when it is missing.
+
+    upper_triangle (bool): Layout used when the store has to be built.
+
+  Returns:
+    DistanceStore
+  """
+  if not os.path.exists(store_path):
+    if csv_path is None:
+      raise FileNotFoundError(f"No distance store at {store_path} and no csv to build it from.")
+    return build_distance_store(csv_path, store_path, upper_triangle = upper_triangle)
+
+  return DistanceStore(store_path)
+
+
+def _packed_offset(i, n_sites):
+  """
+  Position of element (i, i) in the packed upper triangle.
+  """
+  return i * n_sites - i * (i - 1) // 2
+
+
+class DistanceStore():
+  """
+  class DistanceStore()
+
+  Read-only view over a memory-mapped distance matrix.
+
+  Rows and columns are addressed by site index. Because the matrix is symmetric,
+  a column block is served as the transpose of the matching row block, which reads
+  contiguous rows instead of strided columns. Contiguous row slices of a dense store
+  are returned as zero-copy views of the memory map.
+
+  The `iloc` indexer mirrors the DataFrame read by pd.read_csv(...).drop(["Unnamed: 0"], axis=1),
+  so `store.iloc[:, rows_idx]` and `store.iloc[rows_idx, :]` can be passed where the
+  optimisation code expects the distance DataFrame.
+
+  Example:
+      >>> store = DistanceStore("data/interim/Distance_Matrix.npy")
+      >>> store.cols([1256, 1595]).shape
+      Output: (2418, 2)
+      >>> DepotsDistanceMatrix = store.iloc[:, [1256, 1595]]
+  """
+
+  def __init__(self, store_path):
+    self.path = store_path
+    self._data = np.load(store_path, mmap_mode = "r")
+
+    if self._data.ndim == 2:
+      self.upper_triangle = False
+      self.n_sites = self._data.shape[0]
+    else:
+      self.upper_triangle = True
+      self.n_sites = int((np.sqrt(8 * self._data.shape[0] + 1) - 1) // 2)
+
+    self.shape = (self.n_sites, self.n_sites)
+    self.dtype = self._data.dtype
+
+  def __reduce__(self):
+    # Worker processes re-open the memory map instead of receiving a pickled copy
+    return (DistanceStore, (self.path,))
+
+  def __len__(self):
+    return self.n_sites
+
+  def __repr__(self):
+    layout = "upper triangle" if self.upper_triangle else "dense"
+    return f"DistanceStore({self.path!r}, shape={self.shape}, {layout})"
+
+  def _index(self, idx):
+    if idx is None:
+      return np.arange(self.n_sites)
+    if isinstance(idx, slice):
+      return np.arange(self.n_sites)[idx]
+    return np.asarray(idx, dtype = np.int64).reshape(-1)
+
+  def rows(self, idx = None):
+    """
+    Distance rows of the given sites.
+
+    Parameters:
+      idx (int, slice or array): Site indices. A slice on a dense store returns a view.
+
+    Returns:
+      np.ndarray: Array of shape (len(idx), n_sites).
+    """
+    if not self.upper_triangle:
+      if isinstance(idx, slice) or idx is None:
+        return self._data[idx if idx is not None else slice(None)]
+      return self._data[self._index(idx)]
+
+    idx = self._index(idx)
+    out = np.empty((len(idx), self.n_sites), dtype = self.dtype)
+    cols = np.arange(self.n_sites)
+    for pos, i in enumerate(idx):
+      lo, hi = np.minimum(i, cols), np.maximum(i, cols)
+      out[pos] = self._data[_packed_offset(lo, self.n_sites) + hi - lo]
+    return out
+
+  def cols(self, idx = None):
+    """
+    Distance columns of the given sites, served from the symmetric rows.
+
+    Returns:
+      np.ndarray: Array of shape (n_sites, len(idx)).
+    """
+    return self.rows(idx).T
+
+  def submatrix(self, rows = None, cols = None):
+    """
+    Distances between the `rows` sites and the `cols` sites.
+
+    Returns:
+      np.ndarray: Array of shape (len(rows), len(cols)).
+    """
+    if cols is None:
+      return self.rows(rows)
+    if rows is None:
+      return self.cols(cols)
+
+    rows, cols = self._index(rows), self._index(cols)
+    # Read the smaller block of contiguous rows
+    if len(rows) <= len(cols):
+      return self.rows(rows)[:, cols]
+    return self.rows(cols)[:, rows].T
+
+  def pairs(self, rows, cols):
+    """
+    Distance between rows[k] and cols[k] for every k, e.g. along the flows of a submission.
+
+    Returns:
+      np.ndarray: Array with the length of `rows`.
+    """
+    rows, cols = self._index(rows), self._index(cols)
+    if not self.upper_triangle:
+      return self._data[rows, cols]
+
+    lo, hi = np.minimum(rows, cols), np.maximum(rows, cols)
+    return self._data[_packed_offset(lo, self.n_sites) + hi - lo]
+
+  def to_frame(self, rows = None, cols = None):
+    """
+    DataFrame with the same labels as the csv loaded in the notebooks:
+    integer row index and string column names.
+    """
+    row_idx, col_idx = self._index(rows), self._index(cols)
+    return pd.DataFrame(self.submatrix(rows, cols),
+                        index = row_idx,
+                        columns = col_idx.astype(str))
+
+  @property
+  def iloc(self):
+    return _StoreIndexer(self)
+
+
+class _StoreIndexer():
+  """
+  Positional indexer returning DataFrames, `store.iloc[rows, cols]`.
+  """
+
+  def __init__(self, store):
+    self.store = store
+
+  def __getitem__(self, key):
+    rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+    rows = None if isinstance(rows, slice) and rows == slice(None) else rows
+    cols = None if isinstance(cols, slice) and cols == slice(None) else cols
+    if np.isscalar(rows) or np.isscalar(cols):
+      raise TypeError("Use rows()/cols()/submatrix() for scalar access.")
+    return self.store.to_frame(rows, cols)
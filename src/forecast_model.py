@@ -0,0 +1,433 @@
+"""
+NAME
+    forecast_model.py
+
+DESCRIPTION
+    K-fold LightGBM forecast of the yearly biomass
+    ============================================================
+
+    forecast_model.py trains the notebook's KFold LightGBM model outside the
+    notebook. The folds are trained concurrently in a process pool, each one
+    limited to its share of the CPU threads.
+
+    The training features are binned once into a LightGBM binary dataset,
+    cached in data/interim under a hash of the features, and every fold trains
+    on a subset of it. The fold models are saved in models/ under a hash of the
+    features and the parameters, so a forecast whose inputs did not change
+    reloads the models instead of retraining them.
+
+    forecast_horizon rolls the forecast over several years, feeding every
+    year's forecast back in as the last year of the next window.
+    forecast_scenarios rolls S scenarios at once, adding back out-of-fold
+    errors of the models, for the stochastic planning of stochastic_model.py.
+
+PACKAGE LIST
+    numpy
+    pandas
+    lightgbm
+    sklearn
+"""
+
+## Libraries
+import os
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from config import PARAMS
+from utils import window_features
+from dataset import site_coordinates, site_labels, year_matrix
+
+
+# Parameters that change how the binary dataset is built
+_DATASET_PARAMS = ("max_bin", "min_data_in_bin", "bin_construct_sample_cnt", "min_data_in_leaf",
+                   "feature_pre_filter", "use_missing", "zero_as_missing")
+
+
+def feature_hash(X, y = None, *extra):
+  """
+  Hash of a feature matrix, its column names, the target and any json-serialisable extras.
+
+  Parameters:
+    X (pd.DataFrame): Feature matrix.
+
+    y (array): Target values.
+
+    extra: Other values the cached result depends on (parameters, number of folds, ...).
+
+  Returns:
+    str: Hexadecimal digest, the same for identical inputs across runs.
+  """
+  digest = hashlib.sha1()
+  digest.update(json.dumps(list(map(str, X.columns))).encode())
+  digest.update(np.ascontiguousarray(X.to_numpy(dtype = np.float32)).tobytes())
+  if y is not None:
+    digest.update(np.ascontiguousarray(np.asarray(y, dtype = np.float32)).tobytes())
+  digest.update(json.dumps(extra, sort_keys = True, default = str).encode())
+
+  return digest.hexdigest()[:16]
+
+
+def cached_dataset(X, y, params = PARAMS.lgb_params, cache_dir = "data/interim"):
+  """
+  Path of the LightGBM binary dataset of (X, y), built on the first call only.
+
+  Parameters:
+    X (pd.DataFrame): Training features.
+
+    y (array): Training target.
+
+    params (dict): LightGBM parameters, only the binning ones are used.
+
+    cache_dir (str): Folder of the cached .bin files.
+
+  Returns:
+    str: Path of the binary dataset.
+  """
+  import lightgbm as lgb
+
+  dataset_params = {key: params[key] for key in _DATASET_PARAMS if key in params}
+  dataset_params["verbose"] = -1
+
+  bin_path = os.path.join(cache_dir, f"lgb_dataset_{feature_hash(X, y, dataset_params)}.bin")
+  if not os.path.exists(bin_path):
+    os.makedirs(cache_dir, exist_ok = True)
+    tmp_path = f"{bin_path}.{os.getpid()}.tmp"
+    lgb.Dataset(X, y, params = dataset_params, free_raw_data = True).save_binary(tmp_path)
+    os.replace(tmp_path, bin_path)
+
+  return bin_path
+
+
+def _train_fold(bin_path, trn_idx, val_idx, params, model_path):
+  """
+  Train one fold on subsets of the cached binary dataset and save its model.
+  """
+  import lightgbm as lgb
+
+  full = lgb.Dataset(bin_path, params = params).construct()
+  trn_data = full.subset(trn_idx).construct()
+  val_data = full.subset(val_idx).construct()
+
+  clf = lgb.train(params, trn_data, valid_sets = [trn_data, val_data])
+  clf.save_model(model_path)
+
+  return model_path
+
+
+def train_forecast_models(train,
+                          features = None,
+                          target = "Target",
+                          params = PARAMS.lgb_params,
+                          n_splits = PARAMS.n_splits,
+                          seed = PARAMS.SEED,
+                          n_jobs = None,
+                          model_dir = "models",
+                          cache_dir = "data/interim"):
+  """
+  Train (or reload) one LightGBM model per KFold split.
+
+  Folds run in parallel processes; every process gets cpu_count // n_jobs threads so
+  the folds do not oversubscribe the machine. When the models of identical features,
+  target and parameters are already in `model_dir`, they are loaded instead.
+
+  Parameters:
+    train (pd.DataFrame): Training windows from create_train_data.
+
+    features (list): Feature columns. Defaults to every column except `target`.
+
+    target (str): Target column.
+
+    params (dict): LightGBM parameters.
+
+    n_splits (int): Number of folds.
+
+    seed (int): Seed of the KFold shuffle.
+
+    n_jobs (int): Number of folds trained at once. Defaults to min(n_splits, cpu_count).
+
+    model_dir (str): Folder of the saved fold models.
+
+    cache_dir (str): Folder of the cached binary datasets.
+
+  Returns:
+    tuple: (list of lgb.Booster, out-of-fold predictions as np.ndarray)
+
+  Example:
+      >>> train = create_train_data(DemandHistory, window_size = 3)
+      >>> features = [x for x in train.columns if x not in ["Latitude", "Longitude", "Target"]]
+      >>> models, oof_preds = train_forecast_models(train, features = features)
+      Output: Fold 1 / 5 MAE : 27.71
+              ...
+              Train MAE : 27.21
+  """
+  import lightgbm as lgb
+  from sklearn.model_selection import KFold
+  from sklearn.metrics import mean_absolute_error
+
+  features = [x for x in train.columns if x != target] if features is None else list(features)
+  X, y = train[features], train[target].to_numpy()
+
+  kfolds = KFold(n_splits = n_splits, random_state = seed, shuffle = True)
+  splits = list(kfolds.split(X, y))
+
+  model_key = feature_hash(X, y, params, n_splits, seed)
+  model_paths = [os.path.join(model_dir, f"lgb_{model_key}_fold{fold_}.txt") for fold_ in range(n_splits)]
+
+  missing = [fold_ for fold_, path in enumerate(model_paths) if not os.path.exists(path)]
+  if missing:
+    os.makedirs(model_dir, exist_ok = True)
+    bin_path = cached_dataset(X, y, params, cache_dir)
+
+    n_cpus = os.cpu_count() or 1
+    n_jobs = min(len(missing), n_jobs or n_cpus)
+    fold_params = dict(params, num_threads = max(1, n_cpus // n_jobs), verbose = -1)
+
+    if n_jobs == 1:
+      for fold_ in missing:
+        _train_fold(bin_path, splits[fold_][0], splits[fold_][1], fold_params, model_paths[fold_])
+    else:
+      # spawn: LightGBM's OpenMP runtime is not fork-safe
+      with ProcessPoolExecutor(max_workers = n_jobs, mp_context = multiprocessing.get_context("spawn")) as pool:
+        jobs = [pool.submit(_train_fold, bin_path, splits[fold_][0], splits[fold_][1], fold_params, model_paths[fold_])
+                for fold_ in missing]
+        for job in jobs:
+          job.result()
+
+  models = [lgb.Booster(model_file = path) for path in model_paths]
+
+  oof_preds = np.zeros(len(X))
+  for fold_, (clf, (trn_idx, val_idx)) in enumerate(zip(models, splits)):
+    oof_preds[val_idx] = clf.predict(X.iloc[val_idx])
+    print(f"Fold {fold_+1} / {n_splits} MAE : {mean_absolute_error(y[val_idx], oof_preds[val_idx])}")
+  print(f"Train MAE : {mean_absolute_error(y, oof_preds)}")
+
+  return models, oof_preds
+
+
+def predict_forecast(models, X):
+  """
+  Average of the fold predictions, negative forecasts clipped to zero.
+
+  Parameters:
+    models (list): Fold models returned by train_forecast_models.
+
+    X (pd.DataFrame): Inference features with the training feature columns.
+
+  Returns:
+    np.ndarray: Forecast of every row of X.
+
+  Example:
+      >>> test_2018 = create_train_data(DemandHistory, window_size = 3, target_year = 2018)
+      >>> DemandHistory["2018"] = predict_forecast(models, test_2018)
+  """
+  X = X[models[0].feature_name()]
+
+  preds = np.zeros(len(X))
+  for clf in models:
+    preds += np.maximum(clf.predict(X), 0)
+
+  return preds / len(models)
+
+
+def _first_window(demand_history, models, years, window_size = None):
+  """
+  (sites x window_size) biomass of the years before years[0], and the site coordinates.
+  """
+  if window_size is None:
+    window_size = sum(1 for x in models[0].feature_name() if x[4:].isdigit() and x.startswith("year"))
+
+  past = year_matrix(demand_history, [years[0] - window_size + x for x in range(window_size)], dtype = np.float32)
+  coordinates = np.column_stack(site_coordinates(demand_history)).astype(np.float32)
+  return past, coordinates
+
+
+def _predict_window(models, past, coordinates):
+  """
+  Averaged fold forecast of the year following every window (row) of `past`.
+  """
+  feature_names = models[0].feature_name()
+  features, columns = window_features(past)
+  features = np.hstack([coordinates, features])
+  position = {x: i for (i, x) in enumerate(["Latitude", "Longitude"] + columns)}
+  X = features[:, [position[x] for x in feature_names]]
+
+  preds = np.zeros(len(X))
+  for clf in models:
+    preds += np.maximum(clf.predict(X), 0)
+  return preds / len(models)
+
+
+def forecast_horizon(demand_history,
+                     models,
+                     years,
+                     window_size = None):
+  """
+  Recursive forecast of every site over several consecutive years.
+
+  The window of the last `window_size` years is kept as one (sites x window_size)
+  array. Every year builds one feature matrix for all sites, scores it with every
+  fold model, and shifts the averaged forecast into the window for the next year.
+
+  Parameters:
+    demand_history (pd.DataFrame or BiomassDataset): Biomass data with the `window_size` years before years[0].
+
+    models (list): Fold models returned by train_forecast_models.
+
+    years (list): Consecutive years to forecast, e.g. range(2018, 2023).
+
+    window_size (int): Years per window. Defaults to the yearN features of the models.
+
+  Returns:
+    dataframe: The biomass_forecast rows of every year (year, data_type, source_index,
+               destination_index, value), years one after the other.
+
+  Example:
+      >>> forecast = forecast_horizon(DemandHistory, models, years = [2018, 2019])
+      >>> DemandHistory[["2018", "2019"]] = forecast.pivot(index = "source_index",
+                                                          columns = "year", values = "value")
+  """
+  years = [int(x) for x in years]
+  past, coordinates = _first_window(demand_history, models, years, window_size)
+
+  forecast = np.empty((len(years), len(past)))
+  for (step, year) in enumerate(years):
+    forecast[step] = _predict_window(models, past, coordinates)
+    past = np.column_stack([past[:, 1:], forecast[step].astype(np.float32)])
+
+  return pd.DataFrame({"year": np.repeat(years, len(past)),
+                       "data_type": "biomass_forecast",
+                       "source_index": np.tile(site_labels(demand_history), len(years)),
+                       "destination_index": 0,
+                       "value": forecast.reshape(-1)})
+
+
+def forecast_scenarios(demand_history,
+                       models,
+                       years,
+                       residuals,
+                       predictions,
+                       n_scenarios = 100,
+                       quantiles = None,
+                       correlation = 0.0,
+                       recursive = False,
+                       n_bins = 10,
+                       window_size = None,
+                       seed = PARAMS.SEED,
+                       point_forecast = None):
+  """
+  Forecast scenarios of every site: the forecast with out-of-fold model errors added back.
+
+  The residual added to a forecast is taken from the out-of-fold residuals of the
+  training windows with a similar prediction (the `n_bins` quantile bins of
+  `predictions`, as the errors grow with the biomass), and the result is clipped at
+  zero. The residual of a site is its bin's residual at rank u, with u drawn from a
+  Gaussian copula: `correlation` is the share of a shock common to all the sites of a
+  scenario year (0: independent sites, 1: every site at the same rank).
+
+  By default the residuals are drawn around the point forecast of forecast_horizon,
+  which costs one forecast whatever the number of scenarios. With `recursive`, every
+  scenario year is fed back into the window of that scenario and the next year is
+  scored again, one n_scenarios x sites feature matrix per year.
+
+  `point_forecast` draws the residuals around the forecast of another model (e.g. the
+  out-of-sample errors of statistical_forecast.out_of_sample_errors around its forecast),
+  without the LightGBM models.
+
+  Parameters:
+    demand_history (pd.DataFrame or BiomassDataset): Biomass data with the `window_size` years before years[0].
+
+    models (list): Fold models returned by train_forecast_models (None with point_forecast).
+
+    years (list): Consecutive years to forecast.
+
+    residuals (np.ndarray): Out-of-fold residuals of the training windows (target - prediction).
+
+    predictions (np.ndarray): Out-of-fold predictions of the same windows.
+
+    n_scenarios (int): Number of sampled scenarios.
+
+    quantiles (list): Residual quantiles to use instead of draws, one scenario per quantile
+                      with every site at that quantile (e.g. [0.1, 0.5, 0.9]).
+
+    correlation (float): Share of the common shock in the draws, between 0 and 1.
+
+    recursive (bool): Propagate the errors of a year through the windows of the next years.
+
+    n_bins (int): Bins of the predictions the residuals are taken from.
+
+    window_size (int): Years per window. Defaults to the yearN features of the models.
+
+    seed (int): Seed of the draws.
+
+    point_forecast (np.ndarray): (sites x years) forecast used instead of the models (not recursive).
+
+  Returns:
+    np.ndarray: (n_scenarios x sites x years) biomass scenarios.
+
+  Example:
+      >>> models, oof_preds = train_forecast_models(train, features = features)
+      >>> scenarios = forecast_scenarios(DemandHistory, models, [2018, 2019],
+                                         train["Target"] - oof_preds, oof_preds, correlation = 0.3)
+      >>> scenarios.sum(1).std(0) / scenarios.sum(1).mean(0)
+      Output: array([0.1426, 0.164 ])
+  """
+  from scipy.special import ndtr
+
+  years = [int(x) for x in years]
+  residuals, predictions = np.asarray(residuals, dtype = np.float64), np.asarray(predictions, dtype = np.float64)
+  rng = np.random.default_rng(seed)
+  n_scenarios = len(quantiles) if quantiles is not None else n_scenarios
+
+  # Residuals sorted by bin of their prediction, then by value
+  edges = np.unique(np.quantile(predictions, np.linspace(0, 1, n_bins + 1)[1:-1]))
+  residual_bin = np.searchsorted(edges, predictions, side = "right")
+  order = np.lexsort((residuals, residual_bin))
+  sorted_residuals = np.append(residuals[order], 0.0)
+  bin_start = np.searchsorted(residual_bin[order], np.arange(len(edges) + 1))
+  bin_count = np.diff(np.append(bin_start, len(residuals)))
+
+  def draw(preds):
+    # preds: (n_scenarios x sites) forecasts, returns them with a residual added
+    if quantiles is not None:
+      rank = np.repeat(np.asarray(quantiles, dtype = np.float64)[:, None], preds.shape[1], axis = 1)
+    else:
+      common = rng.standard_normal((n_scenarios, 1))
+      rank = ndtr(np.sqrt(correlation) * common + np.sqrt(1 - correlation) * rng.standard_normal(preds.shape))
+    bins = np.searchsorted(edges, preds, side = "right")
+    position = np.minimum((rank * bin_count[bins]).astype(np.int64), np.maximum(bin_count[bins] - 1, 0))
+    # Empty bins point past the residuals, at the appended 0
+    position = np.where(bin_count[bins] > 0, bin_start[bins] + position, len(residuals))
+    return np.maximum(preds + sorted_residuals[position], 0)
+
+  if point_forecast is not None:
+    if recursive:
+      raise ValueError("A point_forecast cannot be propagated recursively, it needs the models.")
+    point_forecast = np.asarray(point_forecast, dtype = np.float64).reshape(-1, len(years))
+    return np.stack([draw(np.broadcast_to(point_forecast[:, step], (n_scenarios, len(point_forecast))))
+                     for step in range(len(years))], axis = 2)
+
+  past, coordinates = _first_window(demand_history, models, years, window_size)
+  n_sites = len(past)
+  scenarios = np.empty((n_scenarios, n_sites, len(years)))
+
+  if not recursive:
+    for step in range(len(years)):
+      preds = _predict_window(models, past, coordinates)
+      scenarios[:, :, step] = draw(np.broadcast_to(preds, (n_scenarios, n_sites)))
+      past = np.column_stack([past[:, 1:], preds.astype(np.float32)])
+    return scenarios
+
+  # The windows of the first year are the same in every scenario, so it is scored once
+  preds = np.broadcast_to(_predict_window(models, past, coordinates), (n_scenarios, n_sites))
+  past, coordinates = np.tile(past, (n_scenarios, 1)), np.tile(coordinates, (n_scenarios, 1))
+  for step in range(len(years)):
+    if step > 0:
+      preds = _predict_window(models, past, coordinates).reshape(n_scenarios, n_sites)
+    scenarios[:, :, step] = draw(preds)
+    past = np.column_stack([past[:, 1:], scenarios[:, :, step].reshape(-1).astype(np.float32)])
+
+  return scenarios
@@ -0,0 +1,289 @@
+"""
+NAME
+    instrumentation.py
+
+DESCRIPTION
+    Stage timings, model sizes and memory of the solvers
+    ============================================================
+
+    The solver entry points of depot_locator, refinery_locator, optimization_model,
+    utils and test_constraint are wrapped with @instrumented (helpers called
+    in inner loops, like the haversine functions, are left out). When a sink is
+    registered, every call becomes a stage record:
+
+      stage, parent, depth, pid, start, wall (s), cpu (s), peak_rss_mb,
+      peak_rss_growth_mb (how much the stage raised the process high-water
+      mark), error (exception name) and the fields the function added with
+      record(), e.g. the LP variables, constraints, build_time and solve_time.
+
+    Records are sent to every registered sink: LoggingSink (one log line per
+    stage), JsonLinesSink (one json object per line, appended) and
+    ProfileSink, which runs the outermost stage under cProfile and dumps the
+    stats to a .prof file.
+
+    Without a sink, @instrumented calls the function directly after a single
+    check and record() returns at once.
+
+PACKAGE LIST
+    (standard library only)
+"""
+
+## Libraries
+import os
+import sys
+import json
+import time
+import logging
+import cProfile
+import functools
+import threading
+import contextlib
+
+try:
+  import resource
+except ImportError:  # Windows
+  resource = None
+
+_SINKS = []
+_LOCAL = threading.local()
+
+
+def _peak_rss_mb():
+  """
+  High-water mark of the process resident memory in MB (None when unknown).
+  """
+  if resource is None:
+    return None
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def _stack():
+  if not hasattr(_LOCAL, "stack"):
+    _LOCAL.stack = []
+  return _LOCAL.stack
+
+
+class LoggingSink():
+  """
+  class LoggingSink()
+
+  One log line per stage: name, wall and cpu time, memory and the recorded fields.
+  """
+
+  def __init__(self, logger = "instrumentation", level = logging.INFO):
+    self.logger = logging.getLogger(logger) if isinstance(logger, str) else logger
+    self.level = level
+
+  def emit(self, record):
+    fields = {k: v for (k, v) in record.items() if k not in ("stage", "parent", "depth", "pid", "start", "wall",
+                                                                "cpu", "peak_rss_mb", "peak_rss_growth_mb")}
+    memory = "" if record["peak_rss_mb"] is None else f" | peak {record['peak_rss_mb']:.0f} MB"
+    self.logger.log(self.level, "%s%s %.3fs (cpu %.3fs)%s%s", "  " * record["depth"], record["stage"],
+                    record["wall"], record["cpu"], memory, f" | {fields}" if fields else "")
+
+
+class JsonLinesSink():
+  """
+  class JsonLinesSink()
+
+  Appends every stage record to a json lines file, one object per line. The file is
+  opened once in append mode and flushed after each record; close() releases it.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+    self.file = None
+
+  def emit(self, record):
+    if self.file is None:
+      self.file = open(self.path, "a")
+    self.file.write(json.dumps(record, default = str) + "\n")
+    self.file.flush()
+
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+
+class ProfileSink():
+  """
+  class ProfileSink()
+
+  Runs the outermost instrumented stage under cProfile and dumps the stats to
+  `directory`/<stage>-<pid>-<n>.prof, to read with pstats or snakeviz.
+  Only the outermost stage is profiled, as cProfile does not nest.
+  """
+
+  def __init__(self, directory, stages = None):
+    self.directory = directory
+    self.stages = None if stages is None else set(stages)
+    self.count = 0
+    os.makedirs(directory, exist_ok = True)
+
+  def wants(self, name):
+    return self.stages is None or name in self.stages
+
+  def dump(self, name, profiler):
+    self.count += 1
+    path = os.path.join(self.directory, f"{name}-{os.getpid()}-{self.count}.prof")
+    profiler.dump_stats(path)
+    return path
+
+  def emit(self, record):
+    pass
+
+
+def add_sink(sink):
+  """
+  Register a sink: an object with an emit(record) method.
+
+  Returns:
+    The sink, to remove it later.
+  """
+  _SINKS.append(sink)
+  return sink
+
+
+def remove_sink(sink):
+  """
+  Unregister a sink and close it when it has a close() method.
+  """
+  if sink in _SINKS:
+    _SINKS.remove(sink)
+  if hasattr(sink, "close"):
+    sink.close()
+
+
+def enabled():
+  """
+  True when at least one sink is registered.
+  """
+  return bool(_SINKS)
+
+
+@contextlib.contextmanager
+def sinks(*new_sinks):
+  """
+  Register `new_sinks` for the duration of the block.
+
+  Example:
+      >>> with instrumentation.sinks(JsonLinesSink("reports/stages.jsonl"), ProfileSink("reports/profiles")):
+      ...   DepotLocator(df, years = ["2018", "2019"])
+  """
+  for sink in new_sinks:
+    add_sink(sink)
+  try:
+    yield
+  finally:
+    for sink in new_sinks:
+      remove_sink(sink)
+
+
+def record(**fields):
+  """
+  Add fields (model size, solver status, ...) to the record of the current stage.
+  Does nothing when instrumentation is disabled or outside a stage.
+  """
+  if not _SINKS:
+    return
+  stack = _stack()
+  if stack:
+    stack[-1].update(fields)
+
+
+@contextlib.contextmanager
+def stage(name, **fields):
+  """
+  Time a block as a stage and send its record to the sinks.
+
+  Parameters:
+    name (str): Stage name.
+
+    fields: Fields added to the record.
+
+  Returns:
+    dict: The record, to add fields to (a throwaway dict when disabled).
+
+  Example:
+      >>> with stage("flows", year = 2018) as rec:
+      ...   flows = BiomassDemandSupplyFlow(demand, depots_distance, 2018)
+      ...   rec["rows"] = len(flows)
+  """
+  if not _SINKS:
+    yield dict(fields)
+    return
+
+  stack = _stack()
+  current = {"stage": name,
+             "parent": stack[-1]["stage"] if stack else None,
+             "depth": len(stack),
+             "pid": os.getpid(),
+             "start": time.time()}
+  current.update(fields)
+
+  profilers = [x for x in _SINKS if isinstance(x, ProfileSink) and x.wants(name)]
+  profiler = None
+  if profilers and not getattr(_LOCAL, "profiling", False):
+    profiler, _LOCAL.profiling = cProfile.Profile(), True
+
+  peak_before = _peak_rss_mb()
+  stack.append(current)
+  wall, cpu = time.perf_counter(), time.process_time()
+  if profiler is not None:
+    profiler.enable()
+  try:
+    yield current
+  except BaseException as error:
+    current["error"] = type(error).__name__
+    raise
+  finally:
+    if profiler is not None:
+      profiler.disable()
+      _LOCAL.profiling = False
+    current["wall"] = time.perf_counter() - wall
+    current["cpu"] = time.process_time() - cpu
+    stack.pop()
+
+    current["peak_rss_mb"] = _peak_rss_mb()
+    current["peak_rss_growth_mb"] = None if peak_before is None else current["peak_rss_mb"] - peak_before
+    if profiler is not None:
+      current["profile"] = [x.dump(name, profiler) for x in profilers]
+
+    for sink in list(_SINKS):
+      sink.emit(current)
+
+
+def instrumented(function = None, name = None):
+  """
+  Decorator reporting every call of the function as a stage (named after its qualified name).
+
+  Example:
+      >>> @instrumented
+      ... def DepotLocator(df, years = []): ...
+      >>> @instrumented(name = "constraintsTest.report")
+      ... def report(self): ...
+  """
+  def decorate(function):
+    stage_name = name or function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      if not _SINKS:
+        return function(*args, **kwargs)
+      with stage(stage_name):
+        return function(*args, **kwargs)
+
+    return wrapper
+
+  return decorate if function is None else decorate(function)
+
+
+def lp_size(prob):
+  """
+  Number of variables and constraints of a PuLP problem, as record() fields.
+  """
+  return {"variables": prob.numVariables(), "constraints": prob.numConstraints()}
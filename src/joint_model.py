@@ -0,0 +1,326 @@
+"""
+NAME
+    joint_model.py
+
+DESCRIPTION
+    Joint depot, refinery and flow MILP over all the years
+    ============================================================
+
+    JointModel decides the depot and refinery locations together with the
+    biomass and pellet flows of every year, minimising the weighted transport
+    and underutilisation cost of scorer.py, in one PuLP model:
+
+      - depots are chosen among `n_depot_candidates` sites, and every
+        harvesting site can ship to its `n_arcs` nearest candidate depots;
+      - refineries are chosen among `n_refinery_candidates` sites;
+      - the locations are shared by all the years, the flows are per year.
+
+    The forecast only appears in the right-hand sides (biomass available at
+    every site, minimum processed biomass). set_forecast() updates those in
+    the PuLP model, so a forecast update does not rebuild it in Python, and
+    solve() passes the previous locations to CBC as MIP start. Only that
+    start is reused: PuLP writes the whole model to a new MPS file and CBC
+    presolves it from scratch, so a re-solve takes about as long as the
+    first one. The first solve starts from CapacitatedDepotLocator depots
+    and greedily placed refineries.
+
+PACKAGE LIST
+    numpy
+    pandas
+    pulp
+    sklearn
+"""
+
+## Libraries
+import math
+import numpy as np
+import pandas as pd
+from utils import SiteIndex, flows_to_frame
+from depot_locator import CapacitatedDepotLocator
+from scorer import WEIGHTS
+from dataset import site_coordinates, site_labels, take_sites, year_matrix
+
+
+def _distance_rows(distance_matrix, idx):
+  """
+  Distance rows of the given sites from a DistanceStore, DataFrame or array.
+  """
+  if hasattr(distance_matrix, "rows"):
+    return np.asarray(distance_matrix.rows(idx), dtype = np.float64)
+
+  return np.asarray(distance_matrix, dtype = np.float64)[np.asarray(idx)]
+
+
+def _weighted_sites(df, weights, n_sites, fixed, seed):
+  """
+  `fixed` sites plus the sites nearest to the centroids of a weighted KMeans, n_sites in total.
+  """
+  from sklearn.cluster import KMeans
+
+  n_clusters = max(1, min(n_sites, len(df)))
+  kmeans = KMeans(n_clusters = n_clusters, n_init = 1, random_state = seed)
+  latitude, longitude = site_coordinates(df)
+  kmeans.fit(np.column_stack([latitude, longitude]), sample_weight = weights + 1e-09)
+
+  site_index = SiteIndex(latitude, longitude)
+  centroids = site_index.nearest(kmeans.cluster_centers_[:, 0], kmeans.cluster_centers_[:, 1])
+
+  sites = list(dict.fromkeys([int(x) for x in fixed] + [int(x) for x in np.atleast_1d(centroids)]))
+  return np.array(sites[:max(n_sites, len(fixed))], dtype = np.int64)
+
+
+class JointModel():
+  """
+  class JointModel()
+
+  One MILP for the depot and refinery locations and the flows of every year.
+
+  Example:
+      >>> model = JointModel(DemandHistory, DistanceMatrix, years = [2018, 2019])
+      >>> model.solve(time_limit = 120, gap = 0.01)
+      Output: 'Optimal'
+      >>> DemandHistory[["2018", "2019"]] = new_forecast
+      >>> model.set_forecast(DemandHistory)
+      >>> model.solve(time_limit = 30)           # MIP start from the previous solution
+      >>> submission_rows = model.solution()
+  """
+
+  def __init__(self,
+               demand,
+               distance_matrix,
+               years = [2018, 2019],
+               depot_capacity = 20000,
+               refinery_capacity = 100000,
+               max_depots = 25,
+               max_refineries = 5,
+               min_processed_ratio = 0.8,
+               n_depot_candidates = 60,
+               n_refinery_candidates = 20,
+               n_arcs = 6,
+               weights = WEIGHTS,
+               seed = 47):
+    """
+    Parameters:
+      demand (pd.DataFrame or BiomassDataset): Biomass data with Latitude, Longitude and one column per year.
+
+      distance_matrix (pd.DataFrame or DistanceStore): The full site distance matrix.
+
+      years (list): Years of the solution.
+
+      depot_capacity (int): Yearly processing capacity of each depot.
+
+      refinery_capacity (int): Yearly processing capacity of each refinery.
+
+      max_depots (int): Maximum number of depots.
+
+      max_refineries (int): Maximum number of refineries.
+
+      min_processed_ratio (float): Share of the yearly forecast that must be processed.
+
+      n_depot_candidates (int): Number of possible depot sites.
+
+      n_refinery_candidates (int): Number of possible refinery sites.
+
+      n_arcs (int): Candidate depots every harvesting site can ship to.
+
+      weights (dict): Weights of the "transport" and "underutilisation" costs.
+
+      seed (int): Seed of the candidate selection and of the starting depots.
+    """
+    import pulp
+
+    self.years = [int(x) for x in years]
+    self.site_index = site_labels(demand)
+    self.depot_capacity = depot_capacity
+    self.refinery_capacity = refinery_capacity
+    self.min_processed_ratio = min_processed_ratio
+
+    supply = self._supply(demand)
+    weight = supply.max(1)
+
+    ## Starting solution: capacity-aware depots and greedy refineries
+    year_cols = [f"{x}" for x in self.years]
+    start_depots = CapacitatedDepotLocator(demand, year_cols, depot_capacity, max_depots,
+                                           distance_matrix = distance_matrix, seed = seed)
+    start_depots = np.flatnonzero(np.isin(self.site_index, start_depots["source_index"].to_numpy()))
+
+    ## Candidate locations and arcs
+    self.depot_sites = _weighted_sites(demand, weight, n_depot_candidates, start_depots, seed)
+    depot_rows = _distance_rows(distance_matrix, self.site_index[self.depot_sites])    # candidates x sites
+
+    self.refinery_sites = _weighted_sites(take_sites(demand, self.depot_sites), np.ones(len(self.depot_sites)),
+                                          n_refinery_candidates, [], seed)
+    self.refinery_sites = self.depot_sites[self.refinery_sites]
+    pellet_costs = depot_rows[:, self.refinery_sites]                                   # depots x refineries
+
+    n_start_refineries = min(max_refineries, int(math.ceil(len(start_depots) * depot_capacity / refinery_capacity)))
+    start_refineries = self._greedy_refineries(pellet_costs[np.isin(self.depot_sites, start_depots)],
+                                               np.ones(len(start_depots)), n_start_refineries)
+
+    n_arcs = min(n_arcs, len(self.depot_sites))
+    nearest = np.argpartition(depot_rows, n_arcs - 1, axis = 0)[:n_arcs]                # n_arcs x sites
+    self.arc_site = np.tile(np.arange(len(weight)), n_arcs)
+    self.arc_depot = nearest.reshape(-1)
+    arc_costs = depot_rows[self.arc_depot, self.arc_site]
+
+    ## Model
+    prob = pulp.LpProblem("Joint_Supply_Chain", pulp.LpMinimize)
+    self.y = [pulp.LpVariable(f"y_{j}", cat = pulp.LpBinary) for j in range(len(self.depot_sites))]
+    self.z = [pulp.LpVariable(f"z_{k}", cat = pulp.LpBinary) for k in range(len(self.refinery_sites))]
+    self.b, self.p = {}, {}
+    self.supply_constraints, self.processed_constraints = {}, {}
+
+    transport, processed_total = [], []
+    for t, year in enumerate(self.years):
+      b = [pulp.LpVariable(f"b_{t}_{a}", lowBound = 0) for a in range(len(self.arc_site))]
+      p = {(j, k): pulp.LpVariable(f"p_{t}_{j}_{k}", lowBound = 0)
+           for j in range(len(self.depot_sites)) for k in range(len(self.refinery_sites))}
+      self.b[year], self.p[year] = b, p
+
+      arcs_of_site = [[] for _ in range(len(weight))]
+      arcs_of_depot = [[] for _ in range(len(self.depot_sites))]
+      for a, (i, j) in enumerate(zip(self.arc_site, self.arc_depot)):
+        arcs_of_site[i].append(b[a])
+        arcs_of_depot[j].append(b[a])
+
+      # Biomass leaving a site is at most its forecast (right-hand side updated by set_forecast)
+      for i, arcs in enumerate(arcs_of_site):
+        constraint = pulp.lpSum(arcs) <= supply[i, t]
+        prob += constraint, f"supply_{t}_{i}"
+        self.supply_constraints[year, i] = constraint
+
+      # Depot capacity and flow conservation
+      for j, arcs in enumerate(arcs_of_depot):
+        prob += pulp.lpSum(arcs) <= depot_capacity * self.y[j], f"depot_capacity_{t}_{j}"
+        prob += (pulp.lpSum(p[j, k] for k in range(len(self.refinery_sites))) == pulp.lpSum(arcs),
+                 f"depot_balance_{t}_{j}")
+
+      for k in range(len(self.refinery_sites)):
+        prob += (pulp.lpSum(p[j, k] for j in range(len(self.depot_sites))) <= refinery_capacity * self.z[k],
+                 f"refinery_capacity_{t}_{k}")
+
+      processed = pulp.lpSum(b)
+      constraint = processed >= min_processed_ratio * supply[:, t].sum()
+      prob += constraint, f"processed_{t}"
+      self.processed_constraints[year] = constraint
+
+      transport.append(pulp.lpSum(float(c) * v for c, v in zip(arc_costs, b)))
+      transport.append(pulp.lpSum(float(pellet_costs[j, k]) * v for (j, k), v in p.items()))
+      processed_total.append(processed)
+
+    prob += pulp.lpSum(self.y) <= max_depots, "max_depots"
+    prob += pulp.lpSum(self.z) <= max_refineries, "max_refineries"
+
+    # Underutilisation: installed capacity minus the biomass and pellets reaching it, every year
+    installed = len(self.years) * (depot_capacity * pulp.lpSum(self.y) + refinery_capacity * pulp.lpSum(self.z))
+    prob += (weights["transport"] * pulp.lpSum(transport)
+             + weights["underutilisation"] * (installed - 2 * pulp.lpSum(processed_total)))
+
+    self.prob = prob
+    self.set_start(start_depots, self.refinery_sites[start_refineries])
+
+  def _supply(self, demand):
+    return np.maximum(year_matrix(demand, self.years), 0)
+
+  @staticmethod
+  def _greedy_refineries(costs, load, n_refineries):
+    """
+    Greedy uncapacitated p-median of the depots over the refinery candidates.
+    """
+    chosen, nearest = [], np.full(len(costs), np.inf)
+    for _ in range(min(n_refineries, costs.shape[1])):
+      total = (load[:, None] * np.minimum(nearest[:, None], costs)).sum(0)
+      total[chosen] = np.inf
+      chosen.append(int(np.argmin(total)))
+      nearest = np.minimum(nearest, costs[:, chosen[-1]])
+    return np.array(chosen, dtype = np.int64)
+
+  def set_start(self, depot_sites, refinery_sites):
+    """
+    MIP start of the locations (positions in the demand rows). CBC completes the flows.
+    """
+    for j, site in enumerate(self.depot_sites):
+      self.y[j].setInitialValue(int(site in set(depot_sites)))
+    for k, site in enumerate(self.refinery_sites):
+      self.z[k].setInitialValue(int(site in set(refinery_sites)))
+
+  def set_forecast(self, demand):
+    """
+    Replace the forecast by changing only the right-hand sides of the PuLP model
+    (the next solve still sends the whole model to CBC).
+
+    Parameters:
+      demand (pd.DataFrame or BiomassDataset): Biomass data with the same sites and one column per year.
+    """
+    supply = self._supply(demand)
+    for t, year in enumerate(self.years):
+      for i in range(len(supply)):
+        self.supply_constraints[year, i].constant = -supply[i, t]
+      self.processed_constraints[year].constant = -self.min_processed_ratio * supply[:, t].sum()
+
+  def solve(self, time_limit = None, gap = None, threads = None, warm_start = True, msg = False):
+    """
+    Solve with CBC, starting from the current values of the variables.
+
+    Parameters:
+      time_limit (float): Seconds given to CBC (None: no limit). CBC checks it between
+                          nodes, so the solve can run a few seconds longer, plus the time
+                          PuLP takes to write and read the model files.
+
+      gap (float): Relative optimality gap at which CBC stops.
+
+      threads (int): CBC threads.
+
+      warm_start (bool): Pass the current solution (or the heuristic start) as MIP start.
+
+      msg (bool): Print the CBC log.
+
+    Returns:
+      str: PuLP status of the solve.
+    """
+    import pulp
+
+    solver = pulp.PULP_CBC_CMD(msg = msg, timeLimit = time_limit, gapRel = gap,
+                               threads = threads, warmStart = warm_start)
+    self.prob.solve(solver)
+
+    status = pulp.LpStatus[self.prob.status]
+    print("Problem Status", status)
+    print("Minimum Cost Value", pulp.value(self.prob.objective))
+    return status
+
+  def solution(self, tolerance = 1e-05):
+    """
+    Depot, refinery, biomass and pellet submission rows of the current solution.
+
+    Returns:
+      dataframe: Submission rows (the biomass_forecast rows are not included).
+    """
+    depots = self.depot_sites[[j for j, v in enumerate(self.y) if (v.varValue or 0) > 0.5]]
+    refineries = self.refinery_sites[[k for k, v in enumerate(self.z) if (v.varValue or 0) > 0.5]]
+    location_year = int(f"{self.years[0]}{self.years[1]}") if len(self.years) == 2 else 0
+
+    rows = [pd.DataFrame({"year": location_year, "data_type": "depot_location",
+                          "source_index": self.site_index[depots], "destination_index": 0, "value": 0}),
+            pd.DataFrame({"year": location_year, "data_type": "refinery_location",
+                          "source_index": self.site_index[refineries], "destination_index": 0, "value": 0})]
+
+    n_sites, n_depots, n_refineries = len(self.site_index), len(self.depot_sites), len(self.refinery_sites)
+    for year in self.years:
+      biomass = np.zeros((n_sites, n_depots))
+      values = np.array([v.varValue or 0 for v in self.b[year]])
+      np.add.at(biomass, (self.arc_site, self.arc_depot), values)
+
+      pellets = np.zeros((n_depots, n_refineries))
+      for (j, k), v in self.p[year].items():
+        pellets[j, k] = v.varValue or 0
+
+      rows.append(flows_to_frame(biomass, self.site_index, self.site_index[self.depot_sites],
+                                 year, "biomass_demand_supply", tolerance))
+      # Pellets leave with the biomass once the tolerance is taken off
+      pellets = pellets * np.divide(np.maximum(biomass.sum(0) - tolerance * (biomass > 1e-09).sum(0), 0),
+                                    pellets.sum(1), out = np.zeros(n_depots), where = pellets.sum(1) > 0)[:, None]
+      rows.append(flows_to_frame(pellets, self.site_index[self.depot_sites], self.site_index[self.refinery_sites],
+                                 year, "pellet_demand_supply", tolerance = 0))
+
+    return pd.concat(rows, ignore_index = True)
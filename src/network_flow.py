@@ -0,0 +1,339 @@
+"""
+NAME
+    network_flow.py
+
+DESCRIPTION
+    Min-cost-flow engine for site -> depot -> refinery flows
+    ============================================================
+
+    The biomass (site -> depot) and pellet (depot -> refinery) flows are
+    transportation problems: many sources, a handful of capacitated sinks.
+    min_cost_flow solves them with successive shortest paths on the residual
+    network, without going through a general LP solver.
+
+    Residual paths of a transportation problem alternate sinks and sources,
+    so the search runs on a condensed graph of the sinks only: the arc
+    j -> j' costs min over sources i' shipping to j of c[i', j'] - c[i', j]
+    (re-route part of i' from j to j'). The flows and the condensed arcs are
+    kept in dense NumPy arrays, and the condensed arcs of a sink are only
+    rebuilt when one of its flows drops to zero.
+
+    Before the shortest paths, an auction-style pass on sink prices places
+    most of the supply in a few vectorised rounds, so only a handful of
+    sources are left to route one by one.
+
+PACKAGE LIST
+    numpy
+    pandas
+"""
+
+## Libraries
+import numpy as np
+import pandas as pd
+from utils import flows_to_frame
+from dataset import year_values
+
+
+def min_cost_flow(costs,
+                  supply,
+                  capacity,
+                  tolerance = 1e-09,
+                  max_rounds = 30):
+  """
+  Minimum cost transportation flows by successive shortest paths.
+
+  When the total supply fits in the sinks every source ships all of its supply.
+  Otherwise every sink is filled and the supply that is the most expensive to move
+  stays at its source. Pairs costing inf are not arcs and never carry flow: supply
+  that cannot reach a sink with room through the arcs stays at its source, and the
+  flows through the arcs are the largest possible at the lowest cost.
+
+  Parameters:
+    costs (np.ndarray): Unit transport cost from every source (rows) to every sink (columns).
+
+    supply (array): Amount available at every source.
+
+    capacity (array): Capacity of every sink.
+
+    tolerance (float): Amounts below tolerance * max(supply) are treated as zero.
+
+    max_rounds (int): Rounds of sink price updates before the shortest paths take over.
+
+  Returns:
+    np.ndarray: Flow matrix with the same shape as `costs`. Integral supplies and
+                capacities give integral flows.
+
+  Example:
+      >>> costs = np.array([[1., 4.], [2., 1.], [3., 2.]])
+      >>> min_cost_flow(costs, supply = [5, 5, 5], capacity = [10, 5])
+      Output: array([[5., 0.],
+                     [0., 5.],
+                     [5., 0.]])
+  """
+  costs = np.asarray(costs, dtype = np.float64)
+  supply = np.asarray(supply, dtype = np.float64)
+  capacity = np.asarray(capacity, dtype = np.float64)
+
+  n_sources, n_sinks = costs.shape
+  eps = tolerance * max(1.0, float(supply.max(initial = 0)))
+
+  # A dummy sink keeps the supply that does not fit in the real sinks. Its flow is fixed
+  # (the excess), so any uniform cost gives the same flows. Pricing it at the distance beyond
+  # which about `excess` of the supply lies lets the sink prices start close to their optimum.
+  excess = supply.sum() - capacity.sum()
+  if excess > eps:
+    nearest = costs.min(1, initial = np.inf)
+    order = np.argsort(nearest)[::-1]
+    dummy_cost = nearest[order[min(np.searchsorted(np.cumsum(supply[order]), excess), n_sources - 1)]]
+    dummy_cost = dummy_cost if np.isfinite(dummy_cost) else 0.0
+    costs = np.hstack([costs, np.full((n_sources, 1), dummy_cost)])
+    capacity = np.append(capacity, excess)
+
+  # Pairs that are not arcs cost inf. When some supply cannot reach the sinks through the
+  # arcs, an "unrouted" sink priced above any path keeps it: the flows through the arcs are
+  # then the largest possible, at the lowest cost, and every source has a finite path.
+  finite = np.isfinite(costs)
+  max_cost = float(np.abs(costs[finite]).max(initial = 0))
+  if not finite.all():
+    unrouted_cost = 2 * (costs.shape[1] + 1) * max(1.0, max_cost)
+    costs = np.hstack([np.where(finite, costs, np.inf), np.full((n_sources, 1), unrouted_cost)])
+    capacity = np.append(capacity, supply.sum())
+    max_cost = unrouted_cost
+
+  n_nodes = costs.shape[1]
+  cost_tolerance = 1e-12 * max(1.0, max_cost)
+
+  # Most of the flow is placed at once from sink prices, the shortest paths only
+  # route what the prices left over.
+  flows = _price_assignment(costs, supply, capacity, eps, max_rounds)
+  remaining_supply = supply - flows.sum(1)
+  residual_capacity = capacity - flows.sum(0)
+
+  # Condensed sink graph: reroute[j, j'] is the cheapest re-routing of flow from j to j'
+  # and via[j, j'] the source carrying it.
+  reroute = np.full((n_nodes, n_nodes), np.inf)
+  via = np.zeros((n_nodes, n_nodes), dtype = np.int64)
+  stale = np.ones(n_nodes, dtype = bool)
+
+  # potential[j] is the cheapest cost of pushing one more unit from sink j to a sink
+  # with room left, next_sink[j] the first hop of that path. A source then reaches
+  # its best open sink through argmin(costs[i] + potential).
+  potential = np.zeros(n_nodes)
+  next_sink = np.full(n_nodes, -1)
+  outdated = True
+
+  def add_support(i, j):
+    delta = costs[i] - costs[i, j]
+    delta[j] = np.inf
+    better = delta < reroute[j]
+    reroute[j, better] = delta[better]
+    via[j, better] = i
+
+  def rebuild(j):
+    rows = np.flatnonzero(flows[:, j] > eps)
+    if len(rows) == 0:
+      reroute[j] = np.inf
+    else:
+      delta = costs[rows] - costs[rows, j][:, None]
+      delta[:, j] = np.inf
+      best = delta.argmin(0)
+      reroute[j] = delta[best, np.arange(n_nodes)]
+      via[j] = rows[best]
+    stale[j] = False
+
+  def update_potential():
+    for j in np.flatnonzero(stale):
+      rebuild(j)
+
+    # Bellman-Ford towards the open sinks over the condensed graph
+    is_open = residual_capacity > eps
+    potential[:] = np.where(is_open, 0.0, np.inf)
+    next_sink[:] = -1
+    for _ in range(n_nodes):
+      candidates = reroute + potential[None, :]
+      best = candidates.argmin(1)
+      new_potential = candidates[np.arange(n_nodes), best]
+      improved = ~is_open & (new_potential < potential - cost_tolerance)
+      if not improved.any():
+        break
+      potential[improved] = new_potential[improved]
+      next_sink[improved] = best[improved]
+
+  for i in np.flatnonzero(remaining_supply > eps):
+    remaining = remaining_supply[i]
+
+    while remaining > eps:
+      if outdated:
+        update_potential()
+        outdated = False
+
+      path = [int(np.argmin(costs[i] + potential))]
+      while next_sink[path[-1]] != -1 and len(path) <= n_nodes:
+        path.append(int(next_sink[path[-1]]))
+      target = path[-1]
+      if residual_capacity[target] <= eps:
+        # Rounding left a residue larger than the room in the sinks
+        break
+
+      hops = [(path[h], path[h + 1], via[path[h], path[h + 1]]) for h in range(len(path) - 1)]
+      amount = min(remaining, residual_capacity[target], *[flows[k, j] for (j, _, k) in hops])
+
+      if flows[i, path[0]] <= eps:
+        add_support(i, path[0])
+      flows[i, path[0]] += amount
+
+      for (j, j_next, k) in hops:
+        flows[k, j] -= amount
+        if flows[k, j] <= eps:
+          flows[k, j] = 0.0
+          stale[j] = True
+        if flows[k, j_next] <= eps:
+          add_support(k, j_next)
+        flows[k, j_next] += amount
+
+      # A direct shipment to an open sink leaves the potentials unchanged
+      outdated = outdated or len(hops) > 0
+
+      remaining -= amount
+      residual_capacity[target] -= amount
+      if residual_capacity[target] <= eps:
+        residual_capacity[target] = 0.0
+        outdated = True
+
+  return flows[:, :n_sinks]
+
+
+def _price_assignment(costs, supply, capacity, eps, max_rounds):
+  """
+  Initial flows from sink prices.
+
+  Every source ships to the sink minimising cost + price. The price of an overloaded
+  sink is raised until just before its load would fall under its capacity, so a sink
+  with a positive price is always full. The overload left after `max_rounds` is cut
+  from the sources with the cheapest alternative. The resulting partial flow is
+  optimal for the supply it carries.
+  """
+  n_sources, n_nodes = costs.shape
+  flows = np.zeros(costs.shape)
+  if n_nodes == 0:
+    return flows
+
+  rows = np.arange(n_sources)
+  price = np.zeros(n_nodes)
+  gap = 1e-09 * max(1.0, float(np.abs(costs[np.isfinite(costs)]).max(initial = 0)))
+
+  for _ in range(max_rounds + 1):
+    reduced = costs + price
+    best = reduced.argmin(1)
+    load = np.bincount(best, weights = supply, minlength = n_nodes)
+    overloaded = np.flatnonzero(load > capacity + eps)
+    if n_nodes == 1 or len(overloaded) == 0:
+      break
+
+    margin = np.partition(reduced, 1, axis = 1)[:, 1] - reduced[rows, best]
+    raised = False
+    for j in overloaded:
+      members = np.flatnonzero(best == j)
+      members = members[np.argsort(margin[members], kind = "stable")]
+      n_leaving = np.searchsorted(np.cumsum(supply[members]), load[j] - capacity[j], side = "right")
+      if n_leaving == 0 or n_leaving == len(members):
+        continue
+      step = margin[members[n_leaving]] - gap
+      if np.isfinite(step) and step > 0:
+        price[j] += step
+        raised = True
+
+    if not raised:
+      break
+
+  margin = np.partition(reduced, 1, axis = 1)[:, 1] - reduced[rows, best] if n_nodes > 1 else np.zeros(n_sources)
+  flows[rows, best] = supply
+  for j in np.flatnonzero(load > capacity + eps):
+    members = np.flatnonzero(best == j)
+    members = members[np.argsort(margin[members], kind = "stable")]
+    removed_before = np.cumsum(supply[members]) - supply[members]
+    cut = np.clip(load[j] - capacity[j] - removed_before, 0, supply[members])
+    flows[members, j] -= cut
+
+  return flows
+
+
+def BiomassDemandSupplyFlow(demand_history,
+                            distances_df,
+                            year,
+                            processing_capacities = 20000,
+                            min_processed_ratio = 0.8):
+  """
+  Site -> depot biomass flows solved with min_cost_flow.
+
+  Same inputs and output as BiomassDemandSupply, so it can replace it
+  when re-solving both years for many candidate depot layouts.
+
+  Parameters:
+    demand_history (pd.DataFrame or BiomassDataset): Biomass data with one column per year ("2018", "2019", ...).
+
+    distances_df (pd.DataFrame): Distances from every harvesting site (rows) to the depots (columns),
+                                 e.g. DistanceMatrix.iloc[:, depots_idx].
+
+    year (int): Year whose forecasted biomass is supplied to the depots.
+
+    processing_capacities (int): Yearly processing capacity of each depot.
+
+    min_processed_ratio (float): Share of the forecasted biomass that must be processed.
+
+  Returns:
+    dataframe: The biomass_demand_supply rows, or None when the depots cannot
+               process `min_processed_ratio` of the biomass.
+  """
+  costs = distances_df.to_numpy(dtype = np.float64)
+  biomass_capacities = year_values(demand_history, year)
+  depots_idx = np.array([int(x) for x in distances_df.columns])
+
+  overallDepotCapacity = len(depots_idx) * processing_capacities
+  if overallDepotCapacity < min_processed_ratio * biomass_capacities.sum():
+    print(f"Problem Status: infeasible, depots capacity {overallDepotCapacity} < required biomass")
+    return None
+
+  flows = min_cost_flow(costs, biomass_capacities, np.full(len(depots_idx), float(processing_capacities)))
+  # With sparse distances (inf off the arcs) some biomass may have no depot within reach
+  if flows.sum() < min_processed_ratio * biomass_capacities.sum() - 1e-06:
+    print(f"Problem Status: infeasible, only {flows.sum():.1f} of the biomass reaches a depot")
+    return None
+
+  return flows_to_frame(flows, np.arange(len(costs)), depots_idx, year, "biomass_demand_supply")
+
+
+def PelletDemandSupplyFlow(biomass_supply,
+                           refinery_location,
+                           distance_matrix,
+                           year,
+                           refinery_capacity = 100000):
+  """
+  Depot -> refinery pellet flows solved with min_cost_flow.
+
+  Every depot ships all the biomass it receives in `biomass_supply` to the refineries,
+  split across refineries when that is cheaper or needed by the capacities.
+
+  Parameters:
+    biomass_supply (pd.DataFrame): The biomass_demand_supply rows of the year.
+
+    refinery_location (pd.DataFrame): Refinery rows with their site index in "source_index".
+
+    distance_matrix (pd.DataFrame or DistanceStore): The full site distance matrix.
+
+    year (int): Year of the flows.
+
+    refinery_capacity (int): Yearly processing capacity of each refinery.
+
+  Returns:
+    dataframe: The pellet_demand_supply rows of the year.
+  """
+  depot_supply = biomass_supply.groupby("destination_index")["value"].sum()
+  depots_idx = depot_supply.index.to_numpy()
+  refinery_idx = refinery_location["source_index"].to_numpy()
+
+  costs = distance_matrix.iloc[depots_idx, refinery_idx].to_numpy(dtype = np.float64)
+  flows = min_cost_flow(costs, depot_supply.to_numpy(), np.full(len(refinery_idx), float(refinery_capacity)))
+
+  # Pellets leaving a depot must match the biomass entering it, so no tolerance is taken off
+  return flows_to_frame(flows, depots_idx, refinery_idx, year, "pellet_demand_supply", tolerance = 0)
@@ -1,63 +1,91 @@
 ##Libraries
+import time
 import numpy as np
-import pulp
 import pandas as pd
+from utils import flows_to_frame
+from instrumentation import instrumented, record, lp_size
+from dataset import year_values
 
 
+@instrumented
 def BiomassDemandSupply(demand_history,
                         distances_df,
                         year,
                         processing_capacities = 20000):
+  import pulp
 
+  build_start = time.perf_counter()
   distances = distances_df.copy()
 
-  # Create the new row
-  new_row = {x:0 for x in distances.columns}
+  # Create the new row (dummy harvesting site absorbing the unused depot capacity)
+  dummy_idx = len(demand_history)
+  new_row = pd.DataFrame(0, index = [dummy_idx], columns = distances.columns)
   # Append the new row to the DataFrame
-  distances = distances.append(new_row, ignore_index=True)
+  distances = pd.concat([distances, new_row])
 
   overallDepotCapacity = len(distances.columns)*processing_capacities
-  totalHarvestedBiomass = demand_history[f"{year}"].sum()
+  totalHarvestedBiomass = year_values(demand_history, year).sum()
   dummyDemandPointCapacity = overallDepotCapacity - totalHarvestedBiomass
 
   sites_idx = distances.index.to_list()
   depots_idx = distances.columns.to_list()
 
-  biomass_capacities = demand_history[f"{year}"].tolist()
+  biomass_capacities = year_values(demand_history, year).tolist()
   biomass_capacities.append(dummyDemandPointCapacity)
   biomass_capacities = np.array(biomass_capacities)
 
+  # Only the finite distances are arcs: a sparse distance provider marks the
+  # implausible site -> depot pairs with inf, and no variable is made for them
+  costs = distances.to_numpy(dtype = np.float64)
+  arc_depots, arc_sites = np.nonzero(np.isfinite(costs.T))
+
+  # Sites without any arc keep their biomass, the dummy site takes over their share
+  stranded = np.setdiff1d(np.arange(len(sites_idx)), arc_sites)
+  if len(stranded):
+    print(f"{len(stranded)} sites have no arc to a depot and keep their biomass")
+    biomass_capacities[-1] += biomass_capacities[stranded].sum()
+
   forecasted_biomass = np.sum(biomass_capacities)
 
   # Create a Linear Programming problem
   prob = pulp.LpProblem("Biomass_Transportation", pulp.LpMinimize)
 
   # Create decision variables
-  x = {(i, j): pulp.LpVariable(f'x_{i}_{j}', lowBound=0) for j in depots_idx for i in sites_idx}
+  x = {(sites_idx[i], depots_idx[j]): pulp.LpVariable(f'x_{sites_idx[i]}_{depots_idx[j]}', lowBound=0)
+       for (j, i) in zip(arc_depots, arc_sites)}
 
   # Objective function: minimize transportation cost
-  prob += pulp.lpSum(distances.loc[i, j] * x[i, j] for i in sites_idx for j in depots_idx)
+  prob += pulp.lpSum(costs[i, j] * var for ((i, j), var) in zip(zip(arc_sites, arc_depots), x.values()))
+
+  site_arcs, depot_arcs = {i: [] for i in sites_idx}, {j: [] for j in depots_idx}
+  for ((i, j), var) in x.items():
+    site_arcs[i].append(var)
+    depot_arcs[j].append(var)
 
   # Constraints
   # Harvesting sites supply constraint
-  for i in sites_idx:
-    prob += pulp.lpSum(x[i, j] for j in depots_idx) == biomass_capacities[i]
+  for (pos, i) in enumerate(sites_idx):
+    if site_arcs[i]:
+      prob += pulp.lpSum(site_arcs[i]) == biomass_capacities[pos]
     #prob += pulp.lpSum(x[i, j] for j in depots_idx) >= 0.8 * biomass_capacities[i]
 
   #prob += pulp.lpSum(x[i, j] for i in sites_idx for j in depots_idx) >= 0.8 * forecasted_biomass
 
   # Depot demand constraint
   for j in depots_idx:
-    prob += pulp.lpSum(x[i, j] for i in sites_idx) == processing_capacities
+    prob += pulp.lpSum(depot_arcs[j]) == processing_capacities
 
   # Solve the problem
+  solve_start = time.perf_counter()
   prob.solve()
+  record(build_time = solve_start - build_start, solve_time = time.perf_counter() - solve_start,
+         status = pulp.LpStatus[prob.status], cost = prob.objective.value(), **lp_size(prob))
 
   print(f"Problem Status: {prob.status}")
   print(f"Minimum Cost Value: {prob.objective.value()}")
 
   if prob.status == pulp.LpStatusOptimal:
-    results = [pulp.value(x[i, j]) for j in depots_idx for i in sites_idx]
+    results = [pulp.value(var) for var in x.values()]
 
     result_df = pd.DataFrame({"year":year,
               "source_index":[int(i[0]) for i in x.keys()],
@@ -67,9 +95,117 @@ def BiomassDemandSupply(demand_history,
 
     result_df = result_df[result_df["value"].ne(0)].sort_values("source_index").reset_index(drop=True)
     result_df["value"] = result_df["value"] - 1e-05
-    result_df = result_df[result_df["source_index"].ne(2418)]
+    result_df = result_df[result_df["source_index"].ne(dummy_idx)]
 
     return result_df
 
   else:
-    return None
\ No newline at end of file
+    return None
+
+@instrumented
+def BiomassDemandSupplySparse(demand_history,
+                              distances_df,
+                              year,
+                              processing_capacities = 20000,
+                              min_processed_ratio = 0.8,
+                              maximize_throughput = True):
+  """
+  Matrix-form alternative to BiomassDemandSupply solved with HiGHS.
+
+  The cost vector and the supply/capacity constraints are assembled directly as
+  NumPy/SciPy sparse arrays and solved with scipy.optimize.linprog, instead of
+  building one pulp.LpVariable per (site, depot) pair. The 80% processing rule is
+  a single constraint on the total flow, so no dummy harvesting site is needed.
+
+  Parameters:
+    demand_history (pd.DataFrame or BiomassDataset): Biomass data with one column per year ("2018", "2019", ...).
+
+    distances_df (pd.DataFrame): Distances from every harvesting site (rows) to the depots (columns),
+                                 e.g. DistanceMatrix.iloc[:, depots_idx]. Pairs at inf, e.g. from a
+                                 KNearestDistances graph, are not arcs and get no variable.
+
+    year (int): Year whose forecasted biomass is supplied to the depots.
+
+    processing_capacities (int): Yearly processing capacity of each depot.
+
+    min_processed_ratio (float): Share of the forecasted biomass that must be processed.
+
+    maximize_throughput (bool): Fill the depots with as much biomass as the capacity allows,
+                                like the dummy-site formulation of BiomassDemandSupply. When False
+                                only `min_processed_ratio` of the biomass is processed.
+
+  Returns:
+    dataframe: The biomass_demand_supply rows (year, source_index, destination_index, data_type, value),
+               or None when the problem is infeasible.
+
+  Example:
+      >>> DepotsDistanceMatrix = DistanceMatrix.iloc[:, rows_idx]
+      >>> BiomassDemandSupplySparse(DemandHistory, DepotsDistanceMatrix, 2018)
+      Output:
+            |   | year | source_index | destination_index | data_type             | value      |
+            | 0 | 2018 | 0            | 1256              | biomass_demand_supply | 8.475734   |
+  """
+  from scipy import sparse
+  from scipy.optimize import linprog
+
+  build_start = time.perf_counter()
+  costs = distances_df.to_numpy(dtype = np.float64)
+  biomass_capacities = year_values(demand_history, year)
+  depots_idx = np.array([int(x) for x in distances_df.columns])
+
+  n_sites, n_depots = costs.shape
+
+  # One variable per finite (site, depot) arc, in row-major order. A sparse distance
+  # provider marks the implausible pairs with inf; on a dense matrix every pair is an arc.
+  arc_sites, arc_depots = np.nonzero(np.isfinite(costs))
+  n_arcs = len(arc_sites)
+  site_rows = sparse.csr_matrix((np.ones(n_arcs), (arc_sites, np.arange(n_arcs))), shape = (n_sites, n_arcs))
+  depot_rows = sparse.csr_matrix((np.ones(n_arcs), (arc_depots, np.arange(n_arcs))), shape = (n_depots, n_arcs))
+  depot_capacities = np.full(n_depots, float(processing_capacities))
+
+  forecasted_biomass = biomass_capacities.sum()
+
+  # Sites without any arc keep their biomass
+  stranded = np.diff(site_rows.indptr) == 0
+  if stranded.any():
+    print(f"{stranded.sum()} sites have no arc to a depot and keep their biomass")
+    biomass_capacities = np.where(stranded, 0.0, biomass_capacities)
+  overallDepotCapacity = n_depots * processing_capacities
+  required_biomass = min_processed_ratio * forecasted_biomass
+
+  if maximize_throughput and overallDepotCapacity < required_biomass:
+    print(f"Problem Status: infeasible, depots capacity {overallDepotCapacity} < required biomass {required_biomass}")
+    return None
+
+  if maximize_throughput and biomass_capacities.sum() <= overallDepotCapacity:
+    # Every site ships all its biomass, depots may be left under capacity
+    A_ub, b_ub = depot_rows, depot_capacities
+    A_eq, b_eq = site_rows, biomass_capacities
+  elif maximize_throughput:
+    # Every depot is filled, sites may keep part of their biomass
+    A_ub, b_ub = site_rows, biomass_capacities
+    A_eq, b_eq = depot_rows, depot_capacities
+  else:
+    total_row = sparse.csr_matrix(np.ones((1, n_arcs)))
+    A_ub = sparse.vstack([site_rows, depot_rows, -total_row], format = "csr")
+    b_ub = np.concatenate([biomass_capacities, depot_capacities, [-required_biomass]])
+    A_eq, b_eq = None, None
+
+  solve_start = time.perf_counter()
+  res = linprog(costs[arc_sites, arc_depots], A_ub = A_ub, b_ub = b_ub, A_eq = A_eq, b_eq = b_eq,
+                bounds = (0, None), method = "highs")
+  record(build_time = solve_start - build_start, solve_time = time.perf_counter() - solve_start,
+         status = res.status, cost = res.fun, variables = n_arcs,
+         constraints = A_ub.shape[0] + (0 if A_eq is None else A_eq.shape[0]))
+
+  print(f"Problem Status: {res.status}")
+
+  if res.status != 0:
+    return None
+
+  print(f"Minimum Cost Value: {res.fun}")
+
+  results = np.zeros((n_sites, n_depots))
+  results[arc_sites, arc_depots] = res.x
+
+  return flows_to_frame(results, np.arange(n_sites), depots_idx, year, "biomass_demand_supply")
@@ -0,0 +1,764 @@
+"""
+NAME
+    pipeline.py
+
+DESCRIPTION
+    End-to-end pipeline from the raw csv files to the submission
+    ============================================================
+
+    pipeline.py runs the notebook steps as a DAG of stages:
+
+      history -> features -> forecast -> depots -> refineries -> flows -> submission
+
+    Every stage output is saved in the cache folder (Parquet for tables, NPY for
+    arrays) under a key hashing the stage parameters, the content of the outputs
+    it reads and the content of the raw files. A stage whose key did not change is
+    loaded from the cache, so changing e.g. the refinery capacity only re-runs
+    refineries, flows and submission, and a forced stage whose output changed
+    (e.g. a time-limited depot search) re-runs every stage reading it.
+
+    It is run with `python -m src run`, and `python -m src sweep` runs a grid
+    of scenarios on the cached forecasts (see sweep.py and __main__.py).
+    `python -m src serve` answers what-if questions on these forecasts over
+    HTTP/JSON (service.py), and `python -m src robust` plans the facilities
+    against forecast scenarios (stochastic_model.py).
+    --metrics, --profile and --log-stages send the timing, model size and
+    memory of every stage to the instrumentation sinks (instrumentation.py).
+
+    --forecaster ridge, spatial_ar or holt replaces the LightGBM forecast with
+    a closed-form model of statistical_forecast.py (no features stage, under a
+    second), and `python -m src backtest` compares them on rolling origins.
+    The robust scenarios then draw the one-step-ahead errors of that model
+    around its forecast, so no LightGBM model is trained.
+
+    An --output ending in .parquet or .arrow writes the compact submission
+    format of submission_io.py, and `python -m src export` validates such a
+    file chunk by chunk and writes it as the official csv.
+
+PACKAGE LIST
+    numpy
+    pandas
+    pyarrow
+"""
+
+## Libraries
+import os
+import json
+import time
+import logging
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+import instrumentation
+from config import PARAMS
+from distance_store import load_distance_store
+
+
+SUBMISSION_COLUMNS = ['year', 'data_type', 'source_index', 'destination_index', 'value']
+
+
+CONTENT_FILE = "content.sha1"
+
+
+def file_hash(path, chunk_size = 1 << 20):
+  """
+  Content hash of a file, read in chunks.
+  """
+  digest = hashlib.sha1()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+      digest.update(chunk)
+
+  return digest.hexdigest()[:16]
+
+
+def output_hash(outputs):
+  """
+  Content hash of stage outputs: the values, index, columns and dtypes of every table and array.
+  """
+  digest = hashlib.sha1()
+  for part in sorted(outputs):
+    value = outputs[part]
+    digest.update(part.encode())
+    if isinstance(value, pd.DataFrame):
+      digest.update(json.dumps([list(map(str, value.columns)), list(map(str, value.dtypes))]).encode())
+      digest.update(pd.util.hash_pandas_object(value, index = True).to_numpy().tobytes())
+    else:
+      value = np.ascontiguousarray(value)
+      digest.update(f"{value.dtype.str}{value.shape}".encode())
+      digest.update(value.tobytes())
+
+  return digest.hexdigest()[:16]
+
+
+class Stage():
+  """
+  class Stage()
+
+  One step of the pipeline: `function(inputs, params)` receives the outputs of the
+  `deps` stages merged in one dict and returns a dict of DataFrames or NumPy arrays.
+  """
+
+  def __init__(self, name, function, deps = (), params = None):
+    self.name = name
+    self.function = function
+    self.deps = list(deps)
+    self.params = params or {}
+
+
+class Pipeline():
+  """
+  class Pipeline()
+
+  DAG of stages with content-hashed caching of their outputs.
+
+  Example:
+      >>> pipeline = Pipeline("data/interim")
+      >>> pipeline.add(Stage("history", load_history, params = {"file": file_hash(path)}))
+      >>> pipeline.add(Stage("features", build_features, deps = ["history"], params = {"window_size": 3}))
+      >>> pipeline.run("features")["train"].shape
+      Output: history      done in 0.0s
+              features     done in 0.0s
+              (12090, 14)
+  """
+
+  def __init__(self, cache_dir = "data/interim", force = ()):
+    self.cache_dir = cache_dir
+    self.force = set(force)
+    self.stages = {}
+    self._content = {}
+
+  def add(self, stage):
+    self.stages[stage.name] = stage
+    return stage
+
+  def key(self, name):
+    """
+    Hash of the stage parameters and of the content of the outputs of every upstream stage,
+    known once they have run (or been loaded).
+    """
+    stage = self.stages[name]
+    missing = [x for x in stage.deps if x not in self._content]
+    if missing:
+      raise KeyError(f"The key of {name!r} needs the outputs of {missing}, run them first.")
+
+    content = json.dumps({"stage": name,
+                          "params": stage.params,
+                          "deps": [self._content[x] for x in stage.deps]}, sort_keys = True, default = str)
+    return hashlib.sha1(content.encode()).hexdigest()[:16]
+
+  def _path(self, name):
+    return os.path.join(self.cache_dir, "stages", f"{name}-{self.key(name)}")
+
+  def _load(self, path):
+    outputs = {}
+    for file in sorted(os.listdir(path)):
+      part, extension = os.path.splitext(file)
+      if extension == ".parquet":
+        outputs[part] = pd.read_parquet(os.path.join(path, file))
+      elif extension == ".npy":
+        outputs[part] = np.load(os.path.join(path, file))
+
+    content_path = os.path.join(path, CONTENT_FILE)
+    if os.path.exists(content_path):
+      with open(content_path) as f:
+        content = f.read().strip()
+    else:
+      # Cached before the content hashes were stored
+      content = output_hash(outputs)
+      with open(content_path, "w") as f:
+        f.write(content)
+    return outputs, content
+
+  def _save(self, path, outputs):
+    # Written to a temporary folder first, so an interrupted stage is never read back
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path, exist_ok = True)
+    for part, value in outputs.items():
+      if isinstance(value, pd.DataFrame):
+        value.to_parquet(os.path.join(tmp_path, f"{part}.parquet"))
+      else:
+        np.save(os.path.join(tmp_path, f"{part}.npy"), np.asarray(value))
+    content = output_hash(outputs)
+    with open(os.path.join(tmp_path, CONTENT_FILE), "w") as f:
+      f.write(content)
+    # A forced re-run replaces the previous output of the same key
+    if os.path.isdir(path):
+      shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return content
+
+  def run(self, target, _done = None):
+    """
+    Run `target` and the stages it depends on, loading every unchanged stage from the cache.
+
+    Returns:
+      dict: The outputs of `target`.
+    """
+    done = {} if _done is None else _done
+    if target in done:
+      return done[target]
+
+    stage = self.stages[target]
+    inputs = {}
+    for dep in stage.deps:
+      inputs.update(self.run(dep, done))
+
+    key = self.key(target)
+    path = self._path(target)
+    if os.path.isdir(path) and target not in self.force:
+      print(f"{target:<12} cached ({key})")
+      done[target], self._content[target] = self._load(path)
+      return done[target]
+
+    start = time.time()
+    with instrumentation.stage(f"pipeline.{target}", key = key):
+      outputs = stage.function(inputs, stage.params)
+    self._content[target] = self._save(path, outputs)
+    # Forced once: later runs of this pipeline read the fresh output back, as its dependents did
+    self.force.discard(target)
+    print(f"{target:<12} done in {time.time() - start:.1f}s")
+
+    done[target] = outputs
+    return outputs
+
+
+def _history_with_forecast(history, forecast):
+  """
+  Biomass history with one column per forecasted year.
+  """
+  history = history.copy()
+  wide = forecast.pivot(index = "source_index", columns = "year", values = "value")
+  for year in wide.columns:
+    history[f"{year}"] = wide[year].reindex(history.index).to_numpy()
+
+  return history
+
+
+def build_pipeline(args):
+  """
+  The submission pipeline configured from the command-line arguments.
+
+  Parameters:
+    args (argparse.Namespace): Arguments of the `run` command.
+
+  Returns:
+    Pipeline
+  """
+  # Imported here so `python -m src --help` does not load LightGBM and PuLP
+  from utils import create_train_data
+  from forecast_model import train_forecast_models, forecast_horizon, forecast_scenarios
+  from statistical_forecast import statistical_forecast, out_of_sample_errors
+  from depot_locator import DepotLocator, CapacitatedDepotLocator
+  from refinery_locator import RefineryLocator
+  from network_flow import BiomassDemandSupplyFlow, PelletDemandSupplyFlow
+  from optimization_model import BiomassDemandSupply
+  from decomposition import BiomassDemandSupplyDecomposed
+  from test_constraint import constraintsTest
+
+  history_path = os.path.join(args.data_dir, "Biomass_History.csv")
+  distance_path = args.distance_matrix or os.path.join(args.data_dir, "Distance_Matrix.csv")
+
+  distance_key = file_hash(distance_path)
+  store = {}
+
+  def distances():
+    # The store is only built or opened when a stage needs the distances
+    if "matrix" not in store:
+      if distance_path.endswith(".npy"):
+        store["matrix"] = load_distance_store(distance_path)
+      else:
+        os.makedirs(args.cache_dir, exist_ok = True)
+        store["matrix"] = load_distance_store(os.path.join(args.cache_dir, f"Distance_Matrix_{distance_key}.npy"),
+                                              csv_path = distance_path)
+    return store["matrix"]
+
+  years = [int(x) for x in args.years]
+  year_cols = [f"{x}" for x in years]
+
+  def history(inputs, params):
+    return {"history": pd.read_csv(history_path).drop(["Index"], axis = 1)}
+
+  def features(inputs, params):
+    return {"train": create_train_data(inputs["history"], window_size = params["window_size"])}
+
+  def forecast(inputs, params):
+    train = inputs["train"]
+    feature_cols = [x for x in train.columns if x not in ["Latitude", "Longitude", "Target"]]
+    models, _ = train_forecast_models(train,
+                                      features = feature_cols,
+                                      params = params["lgb_params"],
+                                      n_splits = params["n_splits"],
+                                      seed = params["seed"],
+                                      model_dir = args.model_dir,
+                                      cache_dir = args.cache_dir)
+    return {"forecast": forecast_horizon(inputs["history"], models, params["years"])}
+
+  def fast_forecast(inputs, params):
+    return {"forecast": statistical_forecast(inputs["history"], params["years"], params["model"],
+                                             **params["model_params"])}
+
+  def scenarios(inputs, params):
+    train = inputs["train"]
+    feature_cols = [x for x in train.columns if x not in ["Latitude", "Longitude", "Target"]]
+    # The fold models are reloaded from model_dir, only their out-of-fold errors are needed here
+    models, oof_preds = train_forecast_models(train,
+                                              features = feature_cols,
+                                              params = params["lgb_params"],
+                                              n_splits = params["n_splits"],
+                                              seed = params["seed"],
+                                              model_dir = args.model_dir,
+                                              cache_dir = args.cache_dir)
+    residuals = train["Target"].to_numpy() - oof_preds
+    return {"scenarios": forecast_scenarios(inputs["history"], models, params["years"], residuals, oof_preds,
+                                            n_scenarios = params["n_scenarios"],
+                                            correlation = params["correlation"],
+                                            seed = params["seed"])}
+
+  def fast_scenarios(inputs, params):
+    # Errors of the selected model refitted before past years, drawn around its own forecast
+    residuals, predictions = out_of_sample_errors(inputs["history"], params["model"], before = params["years"][0],
+                                                  **params["model_params"])
+    point = inputs["forecast"]["value"].to_numpy().reshape(len(params["years"]), -1).T
+    return {"scenarios": forecast_scenarios(inputs["history"], None, params["years"], residuals, predictions,
+                                            n_scenarios = params["n_scenarios"],
+                                            correlation = params["correlation"],
+                                            seed = params["seed"],
+                                            point_forecast = point)}
+
+  def depots(inputs, params):
+    demand = _history_with_forecast(inputs["history"], inputs["forecast"])
+    if params["method"] == "capacitated":
+      depot_location = CapacitatedDepotLocator(demand,
+                                               years = year_cols,
+                                               facility_capacity = params["capacity"],
+                                               distance_matrix = distances(),
+                                               seed = params["seed"],
+                                               time_limit = params["time_limit"])
+    else:
+      depot_location = DepotLocator(demand, years = year_cols, facility_capacity = params["capacity"])
+    return {"depots": depot_location}
+
+  def refineries(inputs, params):
+    demand = _history_with_forecast(inputs["history"], inputs["forecast"])
+    refinery_location, allocation = RefineryLocator(demand,
+                                                    inputs["depots"],
+                                                    distances(),
+                                                    year_cols,
+                                                    depot_apacity = params["depot_capacity"],
+                                                    refinery_apacity = params["refinery_capacity"],
+                                                    method = params["method"],
+                                                    time_limit = params["time_limit"],
+                                                    seed = params["seed"])
+    return {"refineries": refinery_location, "allocation": allocation}
+
+  def flows(inputs, params):
+    demand = _history_with_forecast(inputs["history"], inputs["forecast"])
+    depots_idx = inputs["depots"]["source_index"].to_numpy()
+    depots_distance = distances().iloc[:, depots_idx]
+
+    biomass, pellet = [], []
+    for year in years:
+      if params["solver"] == "lp":
+        biomass_supply = BiomassDemandSupply(demand, depots_distance, year, params["depot_capacity"])
+      elif params["solver"] == "decomposed":
+        biomass_supply = BiomassDemandSupplyDecomposed(demand, inputs["depots"], distances(), year,
+                                                       params["depot_capacity"], grid = params["regions"])
+      else:
+        biomass_supply = BiomassDemandSupplyFlow(demand, depots_distance, year, params["depot_capacity"])
+      if biomass_supply is None:
+        raise RuntimeError(f"The depots cannot process the {year} biomass.")
+      biomass.append(biomass_supply[SUBMISSION_COLUMNS])
+      pellet.append(PelletDemandSupplyFlow(biomass_supply, inputs["refineries"], distances(), year,
+                                           params["refinery_capacity"])[SUBMISSION_COLUMNS])
+
+    return {"biomass": pd.concat(biomass, ignore_index = True),
+            "pellet": pd.concat(pellet, ignore_index = True)}
+
+  def submission(inputs, params):
+    solution = pd.concat([inputs["biomass"],
+                          inputs["pellet"],
+                          inputs["forecast"][SUBMISSION_COLUMNS],
+                          inputs["refineries"][SUBMISSION_COLUMNS],
+                          inputs["depots"][SUBMISSION_COLUMNS]], ignore_index = True)
+
+    report = constraintsTest(solution).report()
+    failed = [(x["check"], x["year"]) for x in report["checks"] if not x["passed"]]
+    print("Constraints passed" if report["passed"] else f"Constraints violated: {failed}")
+
+    return {"submission": solution}
+
+  pipeline = Pipeline(args.cache_dir, force = args.force)
+  pipeline.distances = distances
+  pipeline.add(Stage("history", history, params = {"file": file_hash(history_path)}))
+  pipeline.add(Stage("features", features, ["history"], {"window_size": args.window_size}))
+  if args.forecaster == "lightgbm":
+    pipeline.add(Stage("forecast", forecast, ["history", "features"],
+                       {"lgb_params": PARAMS.lgb_params, "n_splits": PARAMS.n_splits,
+                        "seed": PARAMS.SEED, "years": years}))
+    pipeline.add(Stage("scenarios", scenarios, ["history", "features"],
+                       {"lgb_params": PARAMS.lgb_params, "n_splits": PARAMS.n_splits,
+                        "seed": PARAMS.SEED, "years": years, "n_scenarios": args.scenarios,
+                        "correlation": args.scenario_correlation}))
+  else:
+    # The autoregressions use the window size as number of lags
+    model_params = {"n_lags": args.window_size} if args.forecaster in ("ridge", "spatial_ar") else {}
+    pipeline.add(Stage("forecast", fast_forecast, ["history"],
+                       {"model": args.forecaster, "model_params": model_params, "years": years}))
+    pipeline.add(Stage("scenarios", fast_scenarios, ["history", "forecast"],
+                       {"model": args.forecaster, "model_params": model_params, "seed": PARAMS.SEED,
+                        "years": years, "n_scenarios": args.scenarios,
+                        "correlation": args.scenario_correlation}))
+  pipeline.add(Stage("depots", depots, ["history", "forecast"],
+                     {"method": args.depot_method, "capacity": args.depot_capacity, "seed": args.seed,
+                      "time_limit": args.time_limit,
+                      "distance": distance_key if args.depot_method == "capacitated" else None}))
+  pipeline.add(Stage("refineries", refineries, ["history", "forecast", "depots"],
+                     {"method": args.refinery_method, "depot_capacity": args.depot_capacity,
+                      "refinery_capacity": args.refinery_capacity, "time_limit": args.time_limit,
+                      "seed": args.seed, "distance": distance_key}))
+  pipeline.add(Stage("flows", flows, ["history", "forecast", "depots", "refineries"],
+                     {"solver": args.flow_solver, "depot_capacity": args.depot_capacity,
+                      "regions": args.regions if args.flow_solver == "decomposed" else None,
+                      "refinery_capacity": args.refinery_capacity, "distance": distance_key}))
+  pipeline.add(Stage("submission", submission, ["forecast", "depots", "refineries", "flows"]))
+
+  return pipeline
+
+
+def add_run_arguments(parser):
+  """
+  Options of the `run` command.
+  """
+  parser.add_argument("--data-dir", default = os.path.join("data", "raw"),
+                      help = "Folder of Biomass_History.csv and Distance_Matrix.csv.")
+  parser.add_argument("--distance-matrix", default = None,
+                      help = "Distance matrix csv or .npy store (default: <data-dir>/Distance_Matrix.csv).")
+  parser.add_argument("--cache-dir", default = os.path.join("data", "interim"), help = "Folder of the cached stages.")
+  parser.add_argument("--model-dir", default = "models", help = "Folder of the saved forecast models.")
+  parser.add_argument("--output", default = os.path.join("data", "output", "Submission.csv"),
+                      help = "Submission file: official .csv, or compact .parquet / .arrow (see submission_io.py).")
+  parser.add_argument("--years", nargs = 2, default = ["2018", "2019"])
+  parser.add_argument("--window-size", type = int, default = 3)
+  parser.add_argument("--forecaster", choices = ["lightgbm", "ridge", "spatial_ar", "holt"], default = "lightgbm",
+                      help = "Biomass forecast: K-fold LightGBM or a closed-form model of statistical_forecast.py.")
+  parser.add_argument("--depot-method", choices = ["kmeans", "capacitated"], default = "kmeans")
+  parser.add_argument("--refinery-method", choices = ["milp", "heuristic"], default = "milp")
+  parser.add_argument("--flow-solver", choices = ["flow", "lp", "decomposed"], default = "flow")
+  parser.add_argument("--regions", type = int, nargs = 2, default = [2, 2], metavar = ("ROWS", "COLS"),
+                      help = "Region grid of the decomposed flow solver.")
+  parser.add_argument("--depot-capacity", type = int, default = 20000)
+  parser.add_argument("--refinery-capacity", type = int, default = 100000)
+  parser.add_argument("--time-limit", type = float, default = None,
+                      help = "Seconds given to the refinery solver and the capacitated depot search.")
+  parser.add_argument("--seed", type = int, default = PARAMS.SEED)
+  parser.add_argument("--scenarios", type = int, default = 100, help = "Forecast scenarios of the robust plan.")
+  parser.add_argument("--scenario-correlation", type = float, default = 0.3,
+                      help = "Share of the error common to all the sites of a scenario year (0 to 1).")
+  parser.add_argument("--force", nargs = "*", default = [], metavar = "STAGE",
+                      help = "Stages to re-run even when cached (the stages reading them re-run when their output changed).")
+  parser.add_argument("--metrics", default = None, metavar = "FILE",
+                      help = "Append the timing, model size and memory of every stage to this json lines file.")
+  parser.add_argument("--profile", default = None, metavar = "DIR",
+                      help = "Run every pipeline stage under cProfile and dump the stats to this folder.")
+  parser.add_argument("--log-stages", action = "store_true", help = "Log every instrumented stage.")
+
+
+def instrumentation_sinks(args):
+  """
+  The instrumentation sinks asked for on the command line.
+  """
+  sinks = []
+  if args.metrics:
+    sinks.append(instrumentation.JsonLinesSink(args.metrics))
+  if args.profile:
+    sinks.append(instrumentation.ProfileSink(args.profile))
+  if args.log_stages:
+    logging.basicConfig(level = logging.INFO, format = "%(message)s")
+    sinks.append(instrumentation.LoggingSink())
+  return sinks
+
+
+def run(args):
+  """
+  Run the pipeline and write the submission, as csv or in a compact file.
+  """
+  if args.time_limit is None and args.depot_method == "capacitated":
+    args.time_limit = 1.0
+
+  with instrumentation.sinks(*instrumentation_sinks(args)):
+    outputs = build_pipeline(args).run("submission")
+
+  os.makedirs(os.path.dirname(args.output) or ".", exist_ok = True)
+  if os.path.splitext(args.output)[1].lower() == ".csv":
+    outputs["submission"].to_csv(args.output, index = False)
+  else:
+    from submission_io import write_submission
+    # The deliverable keeps exact values, float32 would round the flows by the tolerance of constraint 8
+    write_submission(outputs["submission"], args.output, value_dtype = np.float64)
+  print(f"Submission written to {args.output}")
+
+
+def export(args):
+  """
+  Validate a compact submission file chunk by chunk and write it as the official csv,
+  only when every constraint passes.
+  """
+  from submission_io import export_csv, validate_submission
+
+  report = validate_submission(args.submission, [int(x) for x in args.years], chunk_size = args.chunk_size).report()
+  failed = [(x["check"], x["year"]) for x in report["checks"] if not x["passed"]]
+  if not report["passed"]:
+    # A submission breaking the constraints is not exported, and the command fails
+    raise SystemExit(f"Constraints violated: {failed}, {args.output} not written")
+  print("Constraints passed")
+
+  export_csv(args.submission, args.output, chunk_size = args.chunk_size)
+  print(f"Submission written to {args.output}")
+
+
+def backtest(args):
+  """
+  Rolling-origin backtest of the statistical forecasts, with the LightGBM baseline on demand.
+  """
+  from statistical_forecast import MODELS, LightGBMBaseline, backtest as rolling_backtest
+
+  history = pd.read_csv(os.path.join(args.data_dir, "Biomass_History.csv")).drop(["Index"], axis = 1)
+  models = {x: MODELS[x]() for x in args.models}
+  if args.lightgbm:
+    models["lightgbm"] = LightGBMBaseline(window_size = args.window_size, seed = args.seed,
+                                          model_dir = args.model_dir, cache_dir = args.cache_dir)
+
+  scores = rolling_backtest(history, models, origins = args.origins, horizon = args.horizon)
+  table = scores.pivot_table(index = "model", columns = "step", values = "mae")
+  table.columns = [f"mae {x} year ahead" for x in table.columns]
+  table["seconds"] = scores.groupby("model")["seconds"].first()
+  print(f"Origins {sorted(scores['origin'].unique().tolist())}")
+  print(table.sort_values(table.columns[0]).round(3).to_string())
+
+  if args.output:
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok = True)
+    scores.to_csv(args.output, index = False)
+    print(f"Scores written to {args.output}")
+
+
+def forecast_variants(args, window_sizes):
+  """
+  History with the forecast of every window size, from the cached pipeline stages.
+
+  Returns:
+    tuple: Variant name ("window_size=3", "ridge window_size=3" for a statistical forecaster, ...)
+           -> biomass DataFrame, and the pipeline of the last variant (for its distance store).
+  """
+  forecasts = {}
+  with instrumentation.sinks(*instrumentation_sinks(args)):
+    for window_size in window_sizes:
+      args.window_size = int(window_size)
+      pipeline = build_pipeline(args)
+      outputs = pipeline.run("forecast")
+      history = pipeline.run("history")["history"]
+      # The forecaster is part of the name, so a sweep resumed with another forecaster re-runs its scenarios
+      name = f"window_size={window_size}"
+      if args.forecaster != "lightgbm":
+        name = f"{args.forecaster} {name}"
+      forecasts[name] = _history_with_forecast(history, outputs["forecast"])
+
+  return forecasts, pipeline
+
+
+def serve(args):
+  """
+  Serve what-if questions on localhost with service.WhatIfService.
+  """
+  import asyncio
+  from service import WhatIfService
+
+  forecasts, pipeline = forecast_variants(args, args.window_sizes or [args.window_size])
+  service = WhatIfService(forecasts,
+                          pipeline.distances().path,
+                          years = [int(x) for x in args.years],
+                          n_jobs = args.jobs,
+                          cache_size = args.cache_size,
+                          depot_capacity = args.depot_capacity,
+                          refinery_capacity = args.refinery_capacity,
+                          refinery_method = args.refinery_method,
+                          time_limit = args.time_limit,
+                          seed = args.seed)
+  try:
+    asyncio.run(service.serve(args.host, args.port))
+  except KeyboardInterrupt:
+    pass
+
+
+def robust(args):
+  """
+  Plan the depots and refineries against the forecast scenarios (stochastic_model.py),
+  compare the plan with the point-forecast one and write its submission.
+  """
+  from stochastic_model import RobustFacilityLocator, evaluate_plan, summarise
+  from network_flow import BiomassDemandSupplyFlow, PelletDemandSupplyFlow
+  from test_constraint import constraintsTest
+
+  years = [int(x) for x in args.years]
+  with instrumentation.sinks(*instrumentation_sinks(args)):
+    pipeline = build_pipeline(args)
+    outputs = {}
+    for name in ["history", "forecast", "depots", "refineries", "scenarios"]:
+      outputs.update(pipeline.run(name))
+    scenarios = outputs["scenarios"]
+    demand = _history_with_forecast(outputs["history"], outputs["forecast"])
+    distances = pipeline.distances()
+
+    depots, refineries, candidates = RobustFacilityLocator(demand, scenarios, distances, years,
+                                                           depot_capacity = args.depot_capacity,
+                                                           refinery_capacity = args.refinery_capacity,
+                                                           quantiles = args.quantiles,
+                                                           refinery_method = args.refinery_method,
+                                                           time_limit = args.time_limit,
+                                                           seed = args.seed)
+
+    # The plan of the point forecast, from the cached pipeline stages
+    point = evaluate_plan(scenarios, outputs["depots"]["source_index"], outputs["refineries"]["source_index"],
+                          distances, years, args.depot_capacity, args.refinery_capacity)
+    candidates = pd.concat([candidates, pd.DataFrame([dict(quantile = "point forecast",
+                                                           n_depots = len(outputs["depots"]),
+                                                           n_refineries = len(outputs["refineries"]),
+                                                           **summarise(point), selected = False)])],
+                           ignore_index = True)
+    print(f"{len(scenarios)} forecast scenarios")
+    print(candidates[["quantile", "n_depots", "n_refineries", "expected_cost", "cost_p90",
+                      "infeasible_share", "selected"]].to_string(index = False))
+    if args.report:
+      os.makedirs(os.path.dirname(args.report) or ".", exist_ok = True)
+      candidates.to_csv(args.report, index = False)
+
+    # Submission of the robust plan, with the flows of the point forecast
+    depots_distance = distances.iloc[:, depots["source_index"].to_numpy()]
+    parts = [depots[SUBMISSION_COLUMNS], refineries[SUBMISSION_COLUMNS],
+             outputs["forecast"][SUBMISSION_COLUMNS]]
+    for year in years:
+      biomass_supply = BiomassDemandSupplyFlow(demand, depots_distance, year, args.depot_capacity)
+      if biomass_supply is None:
+        raise RuntimeError(f"The depots cannot process the {year} biomass.")
+      parts += [biomass_supply[SUBMISSION_COLUMNS],
+                PelletDemandSupplyFlow(biomass_supply, refineries, distances, year,
+                                       args.refinery_capacity)[SUBMISSION_COLUMNS]]
+    solution = pd.concat(parts, ignore_index = True)
+
+  report = constraintsTest(solution).report()
+  failed = [(x["check"], x["year"]) for x in report["checks"] if not x["passed"]]
+  print("Constraints passed" if report["passed"] else f"Constraints violated: {failed}")
+
+  os.makedirs(os.path.dirname(args.output) or ".", exist_ok = True)
+  if os.path.splitext(args.output)[1].lower() == ".csv":
+    solution.to_csv(args.output, index = False)
+  else:
+    from submission_io import write_submission
+    write_submission(solution, args.output, value_dtype = np.float64)
+  print(f"Submission written to {args.output}")
+
+
+def sweep(args):
+  """
+  Run a parameter grid with sweep.run_sweep.
+
+  The grid is a json object (inline or in a file) mapping the SCENARIO_DEFAULTS
+  parameters to lists of values. A "window_size" list gives one forecast variant
+  per window size, each forecast coming from the cached pipeline stages.
+  """
+  from sweep import expand_grid, run_sweep
+
+  grid = json.loads(open(args.grid).read() if os.path.exists(args.grid) else args.grid)
+  window_sizes = grid.pop("window_size", [args.window_size])
+  window_sizes = window_sizes if isinstance(window_sizes, list) else [window_sizes]
+
+  forecasts, pipeline = forecast_variants(args, window_sizes)
+  grid["forecast"] = list(forecasts)
+
+  defaults = {"depot_method": args.depot_method,
+              "depot_capacity": args.depot_capacity,
+              "refinery_method": args.refinery_method,
+              "refinery_capacity": args.refinery_capacity,
+              "flow_solver": args.flow_solver,
+              "seed": args.seed,
+              "time_limit": args.time_limit}
+
+  run_sweep(expand_grid(grid, defaults),
+            forecasts,
+            pipeline.distances().path,
+            args.output,
+            years = [int(x) for x in args.years],
+            n_jobs = args.jobs,
+            submissions_dir = args.submissions)
+  print(f"Results written to {args.output}")
+
+
+def main(argv = None):
+  parser = argparse.ArgumentParser(prog = "python -m src",
+                                   description = "Biomass supply chain pipeline.")
+  commands = parser.add_subparsers(dest = "command", required = True)
+
+  run_parser = commands.add_parser("run", help = "Run the pipeline up to the submission file.")
+  add_run_arguments(run_parser)
+  run_parser.set_defaults(handler = run)
+
+  sweep_parser = commands.add_parser("sweep", help = "Run a grid of scenarios in parallel.")
+  add_run_arguments(sweep_parser)
+  sweep_parser.add_argument("--grid", required = True,
+                            help = 'Json grid, inline or in a file, e.g. \'{"refinery_capacity": [80000, 100000]}\'.')
+  sweep_parser.add_argument("--jobs", type = int, default = None, help = "Worker processes (default: cpu_count).")
+  sweep_parser.add_argument("--submissions", default = None, metavar = "DIR",
+                            help = "Save the submission of every scenario as DIR/<scenario_id>.parquet.")
+  sweep_parser.set_defaults(handler = sweep,
+                            output = os.path.join("data", "output", "sweep.csv"),
+                            refinery_method = "heuristic",
+                            time_limit = 1.0)
+
+  robust_parser = commands.add_parser("robust", help = "Plan the facilities against forecast scenarios.")
+  add_run_arguments(robust_parser)
+  robust_parser.add_argument("--quantiles", type = float, nargs = "+", default = [0.5, 0.75, 0.9],
+                             help = "Quantiles of the scenario biomass the candidate plans are made for.")
+  robust_parser.add_argument("--report", default = None, metavar = "FILE",
+                             help = "Csv of the candidate plans and their expected cost.")
+  robust_parser.set_defaults(handler = robust, refinery_method = "heuristic", time_limit = 1.0,
+                             output = os.path.join("data", "output", "Submission_robust.csv"))
+
+  serve_parser = commands.add_parser("serve", help = "Answer what-if questions over HTTP/JSON on localhost.")
+  add_run_arguments(serve_parser)
+  serve_parser.add_argument("--host", default = "127.0.0.1")
+  serve_parser.add_argument("--port", type = int, default = 8765)
+  serve_parser.add_argument("--jobs", type = int, default = None, help = "Worker processes (default: cpu_count).")
+  serve_parser.add_argument("--cache-size", type = int, default = 1024, help = "Results kept in the LRU cache.")
+  serve_parser.add_argument("--window-sizes", type = int, nargs = "+", default = None,
+                            help = "One forecast variant per window size (default: --window-size).")
+  serve_parser.set_defaults(handler = serve, refinery_method = "heuristic", time_limit = 1.0)
+
+  backtest_parser = commands.add_parser("backtest", help = "Compare the forecast models on rolling origins.")
+  backtest_parser.add_argument("--data-dir", default = os.path.join("data", "raw"), help = "Folder of Biomass_History.csv.")
+  backtest_parser.add_argument("--models", nargs = "+", default = ["ridge", "spatial_ar", "holt", "last"],
+                               choices = ["ridge", "spatial_ar", "holt", "last"])
+  backtest_parser.add_argument("--lightgbm", action = "store_true",
+                               help = "Add the LightGBM baseline, retrained before every origin (minutes).")
+  backtest_parser.add_argument("--origins", type = int, nargs = "+", default = None,
+                               help = "First forecasted year of every fold (default: the last 3 possible).")
+  backtest_parser.add_argument("--horizon", type = int, default = 2, help = "Years forecasted from every origin.")
+  backtest_parser.add_argument("--window-size", type = int, default = 3, help = "Window of the LightGBM baseline.")
+  backtest_parser.add_argument("--seed", type = int, default = PARAMS.SEED)
+  backtest_parser.add_argument("--model-dir", default = "models", help = "Folder of the saved forecast models.")
+  backtest_parser.add_argument("--cache-dir", default = os.path.join("data", "interim"),
+                               help = "Folder of the cached binary datasets.")
+  backtest_parser.add_argument("--output", default = None, metavar = "FILE", help = "Csv of every model, origin and step.")
+  backtest_parser.set_defaults(handler = backtest)
+
+  export_parser = commands.add_parser("export", help = "Validate a .parquet / .arrow submission and write its csv.")
+  export_parser.add_argument("submission", help = "Compact submission file.")
+  export_parser.add_argument("--output", default = os.path.join("data", "output", "Submission.csv"))
+  export_parser.add_argument("--years", nargs = 2, default = ["2018", "2019"])
+  export_parser.add_argument("--chunk-size", type = int, default = 65536, help = "Rows read at once.")
+  export_parser.set_defaults(handler = export)
+
+  args = parser.parse_args(argv)
+  args.handler(args)
@@ -1,91 +1,202 @@
 ## Libraries
-import pulp
+import time
 import json
 import numpy as np
 import pandas as pd
 from visualize import plot_map
+from network_flow import min_cost_flow
+from utils import SiteIndex
+from instrumentation import instrumented, record, lp_size
+from dataset import as_frame, site_coordinates, site_labels, year_values
 
+@instrumented
 def RefineryLocator(demand_history,
                    depots_location,
                    distance_matrix,
                    years,
                    depot_apacity = 20000,
-                   refinery_apacity = 100000):
-  
+                   refinery_apacity = 100000,
+                   method = "milp",
+                   time_limit = None,
+                   n_candidates = None,
+                   warm_start = False,
+                   seed = 47,
+                   plot = False):
+    """
+    Locate the refineries serving the depots (capacitated p-median).
+
+    Parameters:
+      demand_history (pd.DataFrame or BiomassDataset): Biomass data of the harvesting sites.
+
+      depots_location (pd.DataFrame): Depot rows returned by DepotLocator.
+
+      distance_matrix (pd.DataFrame, DistanceStore or distance provider): The site distance matrix,
+                                                                          inf for the pairs that are not arcs.
+
+      years (array): Years whose biomass decides the plotted year.
+
+      depot_apacity (int): Yearly processing capacity of each depot.
+
+      refinery_apacity (int): Yearly processing capacity of each refinery.
+
+      method (str): "milp" solves the binary model with CBC, "heuristic" runs a greedy
+                    start followed by Teitz-Bart swaps within `time_limit`, stopping early
+                    after 20 restarts without improvement.
+
+      time_limit (float): Seconds given to CBC or to the swap search (None: no limit for CBC, 1s for the heuristic).
+                          With warm_start, the heuristic takes a quarter and CBC the rest.
+
+      n_candidates (int): Keep only the n_candidates nearest sites of every depot as
+                          possible refinery locations (None: every site).
+
+      warm_start (bool): Start CBC from the heuristic solution (method "milp" only).
+
+      seed (int): Seed of the swap order of the heuristic.
+
+      plot (bool or str): Draw the map of the depots and refineries. A file path saves it
+                          there (headless) instead of showing it.
+
+    Returns:
+      tuple: The refinery_location rows and the depot -> refinery allocation.
+    """
     ### Year with the maximum total biomass harvest
-    years_total_biomass = demand_history[years].sum().to_dict()
+    years_total_biomass = {x: year_values(demand_history, x).sum() for x in years}
     year = max(years_total_biomass, key=years_total_biomass.get)
 
-    demand_history["locationMap"] = demand_history["Latitude"].astype(str) + "_" + demand_history["Longitude"].astype(str)
-    latlong_idx = {y:x for (x,y) in demand_history["locationMap"].to_dict().items()}
+    ### Site index of every depot, snapped from the coordinates when DepotLocator did not provide it
+    if "source_index" in depots_location.columns:
+        rows_idx = depots_location["source_index"].to_numpy(dtype = np.int64)
+    else:
+        site_index = SiteIndex(*site_coordinates(demand_history))
+        rows_idx = site_labels(demand_history)[site_index.nearest(depots_location["Latitude"].to_numpy(),
+                                                                  depots_location["Longitude"].to_numpy())]
 
-    depots_location["locationMap"] = depots_location["Latitude"].astype(str) + "_" + depots_location["Longitude"].astype(str)
-    depots_location["loc_idx"] = depots_location["locationMap"].map(latlong_idx)
+    depots_distance = distance_matrix.iloc[rows_idx, :]
+    M = depots_distance.index.to_list()  # Depots points
+    distances = depots_distance.to_numpy(dtype = np.float64)  # Distance matrix, depots x sites
 
-    rows_idx = depots_location["loc_idx"].values
-    N = distance_matrix.iloc[rows_idx, :].columns.to_list()  # Possible refinery locations
-    M = distance_matrix.iloc[rows_idx, :].index.to_list()  # Depots points
-    d = distance_matrix.iloc[rows_idx, :].to_dict()         # Distance matrix
+    # Possible refinery locations: the sites with an arc from at least one depot. Every site of a
+    # dense matrix, only the plausible ones of a sparse distance provider (inf elsewhere).
+    candidates = np.flatnonzero(np.isfinite(distances).any(0))
+    if n_candidates is not None and n_candidates < len(candidates):
+        nearest = np.argpartition(distances[:, candidates], n_candidates - 1, axis = 1)[:, :n_candidates]
+        candidates = candidates[np.unique(nearest)]
+    N = depots_distance.columns[candidates].to_list()
+    distances = distances[:, candidates]
 
     thresh = int(refinery_apacity / depot_apacity)  # Threshold (Number of maximum depots that can be served by a refinery)
 
     p = int(np.ceil(len(M) / thresh)) # Number of facilities to locate
+    record(method = method, depots = len(M), candidates = len(N), refineries = p)
+
+    search_start = time.perf_counter()
+    if method == "heuristic" or warm_start:
+        # With warm_start the heuristic takes a quarter of the budget and CBC the rest
+        if time_limit is None:
+            search_limit = 1.0
+        else:
+            search_limit = time_limit if method == "heuristic" else time_limit / 4
+        open_pos, assigned_pos = _p_median_swap(distances, p, thresh, time_limit = search_limit, seed = seed)
+        if not np.isfinite(distances[np.arange(len(M)), assigned_pos]).all():
+            if method == "heuristic":
+                raise RuntimeError(f"No {p} refineries found serving every depot through the distance arcs.")
+            warm_start = False  # CBC starts from scratch
+
+    if method == "heuristic":
+        open_facilities = [N[i] for i in open_pos]
+        solDict = {N[i]: [M[j] for j in np.flatnonzero(assigned_pos == i)] for i in open_pos}
+        print("Minimum Cost Value:", distances[np.arange(len(M)), assigned_pos].sum())
+        record(cost = float(distances[np.arange(len(M)), assigned_pos].sum()))
+        return _refinery_output(demand_history, depots_location, years, year,
+                                open_facilities, solDict, plot)
+
+    if method != "milp":
+        raise ValueError(f"Unknown method {method!r}, expected 'milp' or 'heuristic'.")
+
+    import pulp
+
+    build_start = time.perf_counter()
+    d = distances.T  # d[i, j]: distance from refinery candidate i to depot j
 
     # Create a PuLP minimization problem
     prob = pulp.LpProblem("P_Median_Problem", pulp.LpMinimize)
     
+    # Arcs (facility, demand point) with a finite distance
+    arcs = [(ni, mj) for ni, mj in zip(*np.nonzero(np.isfinite(d)))]
+
     # Create binary variables x[i][j] and y[i]
-    x = {(i, j): pulp.LpVariable(f'x_{i}_{j}', cat=pulp.LpBinary) for i in N for j in M}
+    x = {(N[ni], M[mj]): pulp.LpVariable(f'x_{N[ni]}_{M[mj]}', cat=pulp.LpBinary) for ni, mj in arcs}
     y = {i: pulp.LpVariable(f'y_{i}', cat=pulp.LpBinary) for i in N}
     
     # Objective function: minimize total cost
-    prob += pulp.lpSum(d[i][j] * x[i, j] for i in N for j in M)
+    prob += pulp.lpSum(d[ni, mj] * x[N[ni], M[mj]] for ni, mj in arcs)
     
     # Constraints
     # Each demand point must be served by exactly one facility
     for j in M:
-        prob += pulp.lpSum(x[i, j] for i in N) == 1
+        prob += pulp.lpSum(x[i, j] for i in N if (i, j) in x) == 1
 
     # Each facility point must serve by exactly one facility
     for i in N:
-        prob += pulp.lpSum(x[i, j] for j in M) <= thresh 
+        prob += pulp.lpSum(x[i, j] for j in M if (i, j) in x) <= thresh 
     
     # Number of open facilities must be p
     prob += pulp.lpSum(y[i] for i in N) == p
     
     # If a facility is open, it must serve the associated demand points
-    for i in N:
-        for j in M:
-            prob += x[i, j] <= y[i]
+    for (i, j) in x:
+        prob += x[i, j] <= y[i]
+
+    if warm_start:
+        for ni, i in enumerate(N):
+            y[i].setInitialValue(int(ni in open_pos))
+        for ni, mj in arcs:
+            x[N[ni], M[mj]].setInitialValue(int(assigned_pos[mj] == ni))
     
     # Solve the problem
-    prob.solve()
+    solve_start = time.perf_counter()
+    if time_limit is not None:
+        time_limit = max(time_limit - (time.perf_counter() - search_start), 0.1)
+    prob.solve(pulp.PULP_CBC_CMD(timeLimit = time_limit, warmStart = warm_start))
+    record(build_time = solve_start - build_start, solve_time = time.perf_counter() - solve_start,
+           status = pulp.LpStatus[prob.status], cost = prob.objective.value(), **lp_size(prob))
     
     # Extract the solution
     solution = {
         i: {
-            j: x[i, j].varValue for j in M
+            j: x[i, j].varValue if (i, j) in x else 0 for j in M
         } for i in N
     }
     
     open_facilities = [i for i in N if y[i].varValue == 1]
 
-    idx_latlong = {key:value for (value,key) in latlong_idx.items()}
+    solDict = {}
+    for i in open_facilities:
+        solDict[i] = [j for j in M if solution[i][j] == 1]
+
+    return _refinery_output(demand_history, depots_location, years, year,
+                            open_facilities, solDict, plot)
+
 
+def _refinery_output(demand_history, depots_location, years, year,
+                     open_facilities, solDict, plot = False):
+    """
+    Build the refinery_location rows and the depot -> refinery allocation.
+    """
     refinery_location = pd.DataFrame()
     refinery_location["source_index"] = [int(x) for x in open_facilities]
-    refinery_location["Latitude"] = refinery_location["source_index"].apply(lambda x: float(idx_latlong[x].split("_")[0]))
-    refinery_location["Longitude"] = refinery_location["source_index"].apply(lambda x: float(idx_latlong[x].split("_")[1]))
+    latitude, longitude = site_coordinates(demand_history)
+    sites_pos = pd.Index(site_labels(demand_history)).get_indexer(refinery_location["source_index"])
+    refinery_location["Latitude"] = latitude[sites_pos]
+    refinery_location["Longitude"] = longitude[sites_pos]
     refinery_location["year"] = int(f"{years[0]}{years[1]}")
     refinery_location["data_type"] = "refinery_location"
     refinery_location["destination_index"] = 0
     refinery_location["value"] = 0
 
     print("Solution:")
-    solDict = {}
     for i in open_facilities:
-        print(f"Facility {i} - Demand Points: {', '.join(str(j) for j in M if solution[i][j] == 1)}")
-        solDict[i] = [j for j in M if solution[i][j] == 1]
+        print(f"Facility {i} - Demand Points: {', '.join(str(j) for j in solDict[i])}")
 
     print("Open Facilities:", open_facilities)
 
@@ -98,10 +209,114 @@ def RefineryLocator(demand_history,
       df_dict["destination_index"] = [*df_dict["destination_index"], *[int(key)]*len(val)]
     
 
-    plot_map(df = demand_history,
-        year = year,
-        depot_data = depots_location,
-        refinery_data = refinery_location,
-        cluster_col = "Clusters")
+    if plot:
+        frame = as_frame(demand_history)
+        plot_map(df = frame,
+            year = year,
+            depot_data = depots_location,
+            refinery_data = refinery_location,
+            cluster_col = "Clusters" if "Clusters" in frame.columns else None,
+            path = plot if isinstance(plot, str) else None)
         
-    return refinery_location, pd.DataFrame(df_dict)
\ No newline at end of file
+    return refinery_location, pd.DataFrame(df_dict)
+
+
+def _capacitated_assignment(distances, open_pos, thresh):
+    """
+    Assign every depot to one open facility, at most `thresh` depots per facility.
+
+    Returns the total distance and, for every depot, the position of its facility.
+    The distance is inf when some depot has no arc to an open facility with room.
+    """
+    flows = min_cost_flow(distances[:, open_pos], np.ones(len(distances)), np.full(len(open_pos), float(thresh)))
+    assigned = np.asarray(open_pos)[flows.argmax(1)]
+    if (flows.sum(1) < 0.5).any():
+        return np.inf, assigned
+    return distances[np.arange(len(distances)), assigned].sum(), assigned
+
+
+def _p_median_swap(distances, p, thresh, time_limit = 1.0, seed = 47, max_stall = 20):
+    """
+    Capacitated p-median heuristic: greedy start and Teitz-Bart swaps.
+
+    Swaps are screened with the uncapacitated cost (every depot to its nearest open
+    facility), computed for all candidates at once, and the best few are checked with
+    the capacitated assignment. Local optima are perturbed by moving one facility at
+    random, until `max_stall` restarts in a row did not improve the best solution or
+    `time_limit` seconds have passed; the best solution found is kept.
+
+    Parameters:
+      distances (np.ndarray): Depots x candidate sites distances, inf for the pairs that are not arcs.
+
+      p (int): Number of facilities to open.
+
+      thresh (int): Maximum number of depots per facility.
+
+      time_limit (float): Seconds given to the search (None: no limit).
+
+      max_stall (int): Restarts without improvement after which the search stops.
+
+    Returns:
+      tuple: Positions of the open candidates and, for every depot, the position of its facility.
+    """
+    start = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    n_depots, n_sites = distances.shape
+
+    # The screening prices missing arcs above any arc, so its sums stay finite and avoid them;
+    # the capacitated assignments only use the arcs.
+    finite = np.isfinite(distances)
+    screen = np.where(finite, distances, 10 * distances[finite].max(initial = 0) + 1)
+
+    # Greedy start: open the candidate that reduces the uncapacitated cost the most
+    open_pos = []
+    nearest = np.full(n_depots, np.inf)
+    for _ in range(p):
+        gain = np.minimum(nearest[:, None], screen).sum(0)
+        gain[open_pos] = np.inf
+        best = int(np.argmin(gain))
+        open_pos.append(best)
+        nearest = np.minimum(nearest, screen[:, best])
+
+    def timed_out():
+        return time_limit is not None and time.perf_counter() - start >= time_limit
+
+    best_cost, best_open, stall = None, None, 0
+
+    while True:
+        cost, assigned = _capacitated_assignment(distances, open_pos, thresh)
+
+        improved = True
+        while improved and not timed_out():
+            improved = False
+            for out in rng.permutation(p):
+                others = [f for pos, f in enumerate(open_pos) if pos != out]
+                base = screen[:, others].min(1) if others else np.full(n_depots, np.inf)
+                swap_cost = np.minimum(base[:, None], screen).sum(0)
+                swap_cost[open_pos] = np.inf
+
+                for candidate in np.argsort(swap_cost)[:5]:
+                    trial = others + [int(candidate)]
+                    trial_cost, trial_assigned = _capacitated_assignment(distances, trial, thresh)
+                    if trial_cost < cost - 1e-09:
+                        open_pos, cost, assigned = trial, trial_cost, trial_assigned
+                        improved = True
+                        break
+
+                if improved or timed_out():
+                    break
+
+        if best_cost is None or cost < best_cost - 1e-09:
+            best_cost, best_open, best_assigned, stall = cost, list(open_pos), assigned, 0
+        else:
+            stall += 1
+
+        if timed_out() or stall >= max_stall or n_sites <= p:
+            break
+
+        # Local optimum: restart the swaps from the best solution with one facility moved at random
+        open_pos = list(best_open)
+        free = np.setdiff1d(np.arange(n_sites), open_pos)
+        open_pos[rng.integers(p)] = int(rng.choice(free))
+
+    return np.asarray(best_open), best_assigned
@@ -0,0 +1,197 @@
+"""
+NAME
+    scorer.py
+
+DESCRIPTION
+    Cost of a submission: transport, underutilisation and forecast error
+    ============================================================
+
+    scorer.py computes the challenge cost of complete solutions from the
+    submission rows and the distance matrix:
+
+      - transport: distance x amount over the biomass and pellet flows,
+      - underutilisation: capacity left unused in the depots and refineries,
+      - forecast: absolute error of the biomass forecast (when the actual
+        biomass is known).
+
+    Every candidate is flattened into the same arrays and each component is
+    one gather on the distance matrix followed by one np.bincount over
+    (candidate, year), so many layouts are scored at once.
+
+PACKAGE LIST
+    numpy
+    pandas
+"""
+
+## Libraries
+import numpy as np
+import pandas as pd
+from test_constraint import DATA_TYPES
+
+
+# Weight of every component in the overall cost
+WEIGHTS = {"forecast": 1.0, "transport": 0.001, "underutilisation": 1.0}
+
+
+def pair_distances(distance_matrix, rows, cols):
+  """
+  Distance between rows[k] and cols[k] for every k.
+
+  Parameters:
+    distance_matrix (np.ndarray, pd.DataFrame, DistanceStore or distance provider): The site distance matrix.
+
+    rows (array): Site index of the sources.
+
+    cols (array): Site index of the destinations.
+
+  Returns:
+    np.ndarray
+  """
+  if hasattr(distance_matrix, "pairs"):
+    return np.asarray(distance_matrix.pairs(rows, cols), dtype = np.float64)
+
+  return np.asarray(distance_matrix, dtype = np.float64)[rows, cols]
+
+
+def data_type_codes(data_type):
+  """
+  Position of every data_type in DATA_TYPES (-1 for unknown types).
+
+  Integer arrays are taken as codes already, and categorical columns are re-coded
+  through their categories only, so a solution kept in compact form is not
+  compared string by string on every call.
+  """
+  if isinstance(getattr(data_type, "dtype", None), pd.CategoricalDtype):
+    mapping = pd.Index(DATA_TYPES).get_indexer(data_type.cat.categories)
+    return np.append(mapping, -1)[data_type.cat.codes.to_numpy()]
+
+  data_type = np.asarray(data_type)
+  if np.issubdtype(data_type.dtype, np.integer):
+    return data_type
+
+  return pd.Categorical(data_type, categories = DATA_TYPES).codes
+
+
+def score_batch(candidates,
+                distance_matrix,
+                actual = None,
+                years = [2018, 2019],
+                depot_capacity = 20000,
+                refinery_capacity = 100000,
+                weights = WEIGHTS,
+                by_year = False):
+  """
+  Score many candidate solutions at once.
+
+  Parameters:
+    candidates (list): Submissions, as DataFrames or as dicts of arrays with the submission
+                       columns (year, data_type, source_index, destination_index, value).
+                       data_type may be given as codes, positions in DATA_TYPES.
+
+    distance_matrix (np.ndarray, pd.DataFrame, DistanceStore or distance provider): The site distance
+                    matrix. A flow along a pair that is not an arc of a KNearestDistances graph
+                    costs inf.
+
+    actual (pd.DataFrame or np.ndarray): Actual biomass of every site, one column per year
+                                         ("2018", "2019", ...) or a (sites x years) array.
+                                         The forecast cost is 0 when None.
+
+    years (list): Years of the solution.
+
+    depot_capacity (int): Yearly processing capacity of each depot.
+
+    refinery_capacity (int): Yearly processing capacity of each refinery.
+
+    weights (dict): Weight of the "forecast", "transport" and "underutilisation" costs.
+
+    by_year (bool): One row per candidate and year instead of the sum over the years.
+
+  Returns:
+    dataframe: The forecast, transport and underutilisation costs and their weighted
+               sum "cost", one row per candidate (index "candidate").
+
+  Example:
+      >>> score_batch([submission, other_submission], DistanceMatrix)
+      Output:            forecast     transport  underutilisation          cost
+              candidate
+              0               0.0  2.985278e+08     254514.724128  553042.544317
+              1               0.0  2.686750e+08     393063.251715  661738.289885
+  """
+  n_candidates, n_years = len(candidates), len(years)
+
+  columns = {x: [] for x in ["year", "data_type", "source_index", "destination_index", "value"]}
+  candidate = []
+  for (c, solution) in enumerate(candidates):
+    for x in columns:
+      columns[x].append(data_type_codes(solution[x]) if x == "data_type" else np.asarray(solution[x]))
+    candidate.append(np.full(len(columns["value"][-1]), c))
+
+  candidate = np.concatenate(candidate)
+  code = np.concatenate(columns["data_type"])
+  year = pd.Index(years).get_indexer(np.concatenate(columns["year"]))
+  source = np.concatenate(columns["source_index"])
+  destination = np.concatenate(columns["destination_index"])
+  value = np.nan_to_num(np.concatenate(columns["value"]).astype(np.float64))
+
+  key = candidate * n_years + year
+  size = n_candidates * n_years
+  is_forecast, is_biomass, is_pellet = (code == 0) & (year >= 0), (code == 1) & (year >= 0), (code == 2) & (year >= 0)
+
+  # Transport: one gather along every flow, summed per (candidate, year)
+  flows = is_biomass | is_pellet
+  distances = pair_distances(distance_matrix, source[flows].astype(np.int64), destination[flows].astype(np.int64))
+  transport = np.bincount(key[flows], weights = distances * value[flows], minlength = size)
+
+  # Underutilisation: capacity of the facilities minus what reaches them
+  biomass_in = np.bincount(key[is_biomass], weights = value[is_biomass], minlength = size)
+  pellet_in = np.bincount(key[is_pellet], weights = value[is_pellet], minlength = size)
+  n_depots = np.bincount(candidate[code == 3], minlength = n_candidates)
+  n_refineries = np.bincount(candidate[code == 4], minlength = n_candidates)
+  underutilisation = (np.repeat(n_depots * depot_capacity + n_refineries * refinery_capacity, n_years)
+                      - biomass_in - pellet_in)
+
+  forecast = np.zeros(size)
+  if actual is not None:
+    if isinstance(actual, pd.DataFrame):
+      actual = actual[[f"{x}" for x in years]]
+    actual = np.asarray(actual, dtype = np.float64)
+    sites = source[is_forecast].astype(np.int64)
+    errors = np.abs(value[is_forecast] - actual[sites, year[is_forecast]])
+    forecast = np.bincount(key[is_forecast], weights = errors, minlength = size)
+
+  scores = pd.DataFrame({"candidate": np.repeat(np.arange(n_candidates), n_years),
+                         "year": np.tile(years, n_candidates),
+                         "forecast": forecast,
+                         "transport": transport,
+                         "underutilisation": underutilisation})
+  if not by_year:
+    scores = scores.drop(columns = "year").groupby("candidate").sum()
+  else:
+    scores = scores.set_index(["candidate", "year"])
+
+  scores["cost"] = sum(weights[x] * scores[x] for x in ["forecast", "transport", "underutilisation"])
+
+  return scores
+
+
+def score_submission(submission, distance_matrix, actual = None, **kwargs):
+  """
+  Cost components of one submission.
+
+  Parameters:
+    submission (pd.DataFrame or dict): Submission rows, see score_batch.
+
+    distance_matrix (np.ndarray, pd.DataFrame or DistanceStore): The full site distance matrix.
+
+    actual (pd.DataFrame or np.ndarray): Actual biomass of every site and year.
+
+    kwargs: Other score_batch parameters.
+
+  Returns:
+    dict: "forecast", "transport", "underutilisation" and "cost".
+
+  Example:
+      >>> score_submission(submission, DistanceMatrix)
+      Output: {'forecast': 0.0, 'transport': 298527820.19, 'underutilisation': 254514.72, 'cost': 553042.54}
+  """
+  return score_batch([submission], distance_matrix, actual, **kwargs).iloc[0].to_dict()
@@ -0,0 +1,470 @@
+"""
+NAME
+    service.py
+
+DESCRIPTION
+    Local what-if optimisation service over HTTP/JSON
+    ============================================================
+
+    The service loads the forecasts and opens the distance store once, then
+    answers what-if questions ("what if depot 1256 moves to 1300?", "what
+    if the 2019 biomass is 10% lower?") on localhost:
+
+      GET  /health      sites, years and forecast variants served
+      GET  /stats       cache hits, misses, coalesced requests and solves
+      POST /flows       site -> depot (and depot -> refinery) flows of one year
+                        for a given depot set, with their cost
+      POST /refineries  refinery locations and depot allocation for a depot set
+
+    The solves run in a process pool initialised as the sweep workers
+    (sweep.share_forecasts): the forecasts sit in shared memory and the
+    distance store is memory-mapped in every worker. Results are kept in an
+    LRU cache keyed by the normalised request (sorted facility sets, year,
+    capacities, biomass scaling), and identical requests arriving while the
+    first one is still solving wait for its result instead of solving again,
+    so repeated questions are answered in about a millisecond.
+
+    The server is a small HTTP/1.1 implementation on asyncio streams (one
+    request per connection), so it needs no web framework.
+
+PACKAGE LIST
+    numpy
+    pandas
+"""
+
+## Libraries
+import os
+import io
+import json
+import time
+import asyncio
+import contextlib
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from sweep import SUBMISSION_COLUMNS, _init_worker, _shared, share_forecasts
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+# Largest request body read, in bytes
+MAX_BODY = 1 << 20
+
+
+class RequestError(ValueError):
+  """
+  class RequestError()
+
+  Invalid request parameters, answered with a 400.
+  """
+
+
+## Solves, run in the worker processes
+
+def _what_if_demand(params):
+  """
+  Dataset of the forecast variant with the biomass of some years scaled.
+  """
+  from sweep import _demand
+  from dataset import year_values
+
+  demand = _demand(params["forecast"])
+  for (year, factor) in params["biomass_scale"].items():
+    demand = demand.with_years(year_values(demand, year) * factor, [int(year)])
+  return demand
+
+
+def _location_rows(indices, data_type, years):
+  return pd.DataFrame({"year": int(f"{years[0]}{years[-1]}"),
+                       "data_type": data_type,
+                       "source_index": indices,
+                       "destination_index": 0,
+                       "value": 0})
+
+
+def solve_flows(params):
+  """
+  Flows of one year for a depot set (and optionally a refinery set), with their cost.
+
+  Parameters:
+    params (dict): Normalised /flows request, see WhatIfService.normalise.
+
+  Returns:
+    dict: "status", "procured" (biomass sent to the depots), "depot_load" and
+          "refinery_load" (site index -> amount received), the scorer "transport",
+          "underutilisation" and "cost", and the submission "rows" when asked.
+  """
+  from network_flow import BiomassDemandSupplyFlow, PelletDemandSupplyFlow
+  from optimization_model import BiomassDemandSupply
+  from scorer import score_submission
+
+  store, year = _shared["store"], params["year"]
+  demand = _what_if_demand(params)
+  solver = BiomassDemandSupply if params["solver"] == "lp" else BiomassDemandSupplyFlow
+
+  with contextlib.redirect_stdout(io.StringIO()):
+    biomass = solver(demand, store.iloc[:, params["depots"]], year, params["depot_capacity"])
+  if biomass is None:
+    return {"status": "infeasible", "year": year}
+
+  parts = [biomass[SUBMISSION_COLUMNS], _location_rows(params["depots"], "depot_location", _shared["years"])]
+  refinery_load = {}
+  if params["refineries"]:
+    refineries = _location_rows(params["refineries"], "refinery_location", _shared["years"])
+    pellet = PelletDemandSupplyFlow(biomass, refineries, store, year, params["refinery_capacity"])
+    parts += [pellet[SUBMISSION_COLUMNS], refineries]
+    refinery_load = pellet.groupby("destination_index")["value"].sum()
+
+  submission = pd.concat(parts, ignore_index = True)
+  score = score_submission(submission, store, years = [year], depot_capacity = params["depot_capacity"],
+                           refinery_capacity = params["refinery_capacity"])
+  depot_load = biomass.groupby("destination_index")["value"].sum()
+
+  result = {"status": "optimal",
+            "year": year,
+            "procured": float(biomass["value"].sum()),
+            "depot_load": {int(k): float(v) for (k, v) in depot_load.items()},
+            "refinery_load": {int(k): float(v) for (k, v) in dict(refinery_load).items()},
+            "transport": score["transport"],
+            "underutilisation": score["underutilisation"],
+            "cost": score["cost"]}
+  if params["rows"]:
+    result["rows"] = submission[submission["data_type"].isin(["biomass_demand_supply", "pellet_demand_supply"])] \
+      .to_dict(orient = "list")
+  return result
+
+
+def solve_refineries(params):
+  """
+  Refinery locations and depot -> refinery allocation for a depot set.
+
+  Parameters:
+    params (dict): Normalised /refineries request, see WhatIfService.normalise.
+
+  Returns:
+    dict: "refineries" (site indices) and "allocation" (refinery -> depots).
+  """
+  from refinery_locator import RefineryLocator
+
+  demand = _what_if_demand(params)
+  with contextlib.redirect_stdout(io.StringIO()):
+    refineries, allocation = RefineryLocator(demand, pd.DataFrame({"source_index": params["depots"]}),
+                                             _shared["store"], [f"{x}" for x in params["years"]],
+                                             depot_apacity = params["depot_capacity"],
+                                             refinery_apacity = params["refinery_capacity"],
+                                             method = params["method"],
+                                             time_limit = params["time_limit"],
+                                             seed = params["seed"])
+
+  return {"refineries": [int(x) for x in refineries["source_index"]],
+          "allocation": {int(k): sorted(int(x) for x in v)
+                         for (k, v) in allocation.groupby("destination_index")["source_index"]}}
+
+
+SOLVERS = {"/flows": solve_flows, "/refineries": solve_refineries}
+
+
+## Service
+
+class WhatIfService():
+  """
+  class WhatIfService()
+
+  Example:
+      >>> service = WhatIfService({"default": DemandHistory}, "data/interim/Distance_Matrix.npy", n_jobs = 4)
+      >>> asyncio.run(service.serve("127.0.0.1", 8765))
+      Output: What-if service on http://127.0.0.1:8765 (2418 sites, 4 workers)
+
+      $ curl -s localhost:8765/flows -d '{"year": 2019, "depots": [1256, 1300, 2015], "biomass_scale": 0.9}'
+  """
+
+  def __init__(self,
+               forecasts,
+               store_path,
+               years = [2018, 2019],
+               n_jobs = None,
+               cache_size = 1024,
+               depot_capacity = 20000,
+               refinery_capacity = 100000,
+               refinery_method = "heuristic",
+               time_limit = 1.0,
+               seed = 47):
+    """
+    Parameters:
+      forecasts (dict): Forecast variant name -> biomass DataFrame or BiomassDataset with the
+                        history and forecast years (see sweep.run_sweep).
+
+      store_path (str): Path of the DistanceStore .npy file.
+
+      years (list): Years of the solution.
+
+      n_jobs (int): Number of worker processes (default: cpu_count).
+
+      cache_size (int): Results kept in the LRU cache.
+
+      depot_capacity, refinery_capacity, refinery_method, time_limit, seed: Defaults of
+        the request parameters.
+    """
+    from dataset import as_dataset
+
+    self.forecasts = forecasts
+    self.store_path = store_path
+    self.years = [int(x) for x in years]
+    self.n_jobs = n_jobs or os.cpu_count()
+    self.cache_size = cache_size
+    self.defaults = {"depot_capacity": depot_capacity, "refinery_capacity": refinery_capacity,
+                     "method": refinery_method, "time_limit": time_limit, "seed": seed,
+                     "forecast": next(iter(forecasts))}
+    self.n_sites = len(as_dataset(forecasts[self.defaults["forecast"]]))
+
+    self.cache = OrderedDict()
+    self.pending = {}
+    self.stats = {"requests": 0, "hits": 0, "misses": 0, "coalesced": 0, "errors": 0, "solve_time": 0.0}
+    self.pool = None
+    self.memory = None
+
+  def start(self):
+    """
+    Share the forecasts and start the worker pool (done by serve()).
+    """
+    if self.pool is not None:
+      return
+    self.memory, initargs = share_forecasts(self.forecasts, self.store_path, self.years)
+    self.pool = ProcessPoolExecutor(max_workers = self.n_jobs,
+                                    mp_context = multiprocessing.get_context("spawn"),
+                                    initializer = _init_worker, initargs = initargs)
+
+  def close(self):
+    """
+    Stop the workers and release the shared memory.
+    """
+    if self.pool is not None:
+      self.pool.shutdown(cancel_futures = True)
+      self.pool = None
+    if self.memory is not None:
+      self.memory.close()
+      self.memory.unlink()
+      self.memory = None
+
+  def _sites(self, values, name):
+    try:
+      sites = sorted({int(x) for x in values})
+    except (TypeError, ValueError):
+      raise RequestError(f"{name} must be a list of site indices.") from None
+    if sites and (sites[0] < 0 or sites[-1] >= self.n_sites):
+      raise RequestError(f"{name} must be site indices between 0 and {self.n_sites - 1}.")
+    return sites
+
+  def normalise(self, path, body):
+    """
+    Request parameters completed with the defaults, in a canonical form: the same
+    question asked with the facilities in another order gets the same cache key.
+
+    Returns:
+      dict
+    """
+    unknown = set(body) - {"depots", "refineries", "year", "years", "depot_capacity", "refinery_capacity",
+                           "solver", "method", "time_limit", "seed", "forecast", "biomass_scale", "rows"}
+    if unknown:
+      raise RequestError(f"Unknown parameters: {sorted(unknown)}")
+    if "depots" not in body:
+      raise RequestError("depots is required.")
+
+    params = {x: body.get(x, self.defaults[x]) for x in ["depot_capacity", "refinery_capacity", "forecast"]}
+    if params["forecast"] not in self.forecasts:
+      raise RequestError(f"Unknown forecast {params['forecast']!r}, served: {list(self.forecasts)}")
+    params["depots"] = self._sites(body["depots"], "depots")
+    if not params["depots"]:
+      raise RequestError("depots must not be empty.")
+
+    if path == "/flows":
+      params["year"] = int(body.get("year", self.years[0]))
+      years = [params["year"]]
+      params["refineries"] = self._sites(body.get("refineries", []), "refineries")
+      params["solver"] = body.get("solver", "flow")
+      if params["solver"] not in ("flow", "lp"):
+        raise RequestError('solver must be "flow" or "lp".')
+      params["rows"] = bool(body.get("rows", False))
+    else:
+      years = [int(x) for x in body.get("years", self.years)]
+      params["years"] = years
+      params.update({x: body.get(x, self.defaults[x]) for x in ["method", "time_limit", "seed"]})
+      if params["method"] not in ("milp", "heuristic"):
+        raise RequestError('method must be "milp" or "heuristic".')
+    if set(years) - set(self.years):
+      raise RequestError(f"Years must be among {self.years}.")
+
+    # A single factor scales every year of the request, a dict scales the years it names
+    scale = body.get("biomass_scale", 1.0)
+    scale = scale if isinstance(scale, dict) else {x: scale for x in years}
+    try:
+      scale = {str(int(k)): float(v) for (k, v) in scale.items()}
+    except (TypeError, ValueError):
+      raise RequestError("biomass_scale must be a number or a {year: factor} object.") from None
+    params["biomass_scale"] = {k: v for (k, v) in sorted(scale.items()) if v != 1.0 and int(k) in years}
+
+    return params
+
+  async def solve(self, path, params):
+    """
+    Result of a normalised request: from the cache, from the identical request being
+    solved, or solved in the pool.
+
+    Returns:
+      tuple: The result and where it came from ("hit", "coalesced" or "miss").
+    """
+    key = json.dumps([path, params], sort_keys = True)
+    if key in self.cache:
+      self.cache.move_to_end(key)
+      self.stats["hits"] += 1
+      return self.cache[key], "hit"
+    if key in self.pending:
+      self.stats["coalesced"] += 1
+      return await asyncio.shield(self.pending[key]), "coalesced"
+
+    self.stats["misses"] += 1
+    future = asyncio.get_running_loop().create_future()
+    self.pending[key] = future
+    start = time.perf_counter()
+    try:
+      result = await asyncio.get_running_loop().run_in_executor(self.pool, SOLVERS[path], params)
+    except BaseException as error:
+      future.set_exception(error)
+      # Retrieved here, so a failure nobody else waited for is not reported as unhandled
+      future.exception()
+      raise
+    finally:
+      del self.pending[key]
+      self.stats["solve_time"] += time.perf_counter() - start
+
+    future.set_result(result)
+    self.cache[key] = result
+    if len(self.cache) > self.cache_size:
+      self.cache.popitem(last = False)
+    return result, "miss"
+
+  async def respond(self, method, path, body):
+    """
+    Status and json payload of one HTTP request.
+    """
+    self.stats["requests"] += 1
+    if path == "/health":
+      return 200, {"status": "ok", "sites": self.n_sites, "years": self.years, "forecasts": list(self.forecasts),
+                   "workers": self.n_jobs}
+    if path == "/stats":
+      return 200, dict(self.stats, cached = len(self.cache), solving = len(self.pending))
+    if path not in SOLVERS:
+      return 404, {"error": f"Unknown path {path}, use /flows, /refineries, /health or /stats."}
+    if method != "POST":
+      return 405, {"error": f"{path} takes a POST with a json body."}
+
+    start = time.perf_counter()
+    try:
+      body = json.loads(body or b"{}")
+      if not isinstance(body, dict):
+        raise RequestError("The body must be a json object.")
+      params = self.normalise(path, body)
+      result, source = await self.solve(path, params)
+    except (RequestError, json.JSONDecodeError) as error:
+      self.stats["errors"] += 1
+      return 400, {"error": str(error)}
+    except Exception as error:
+      self.stats["errors"] += 1
+      return 500, {"error": f"{type(error).__name__}: {error}"}
+
+    return 200, dict(result, cache = source, elapsed_ms = 1000 * (time.perf_counter() - start))
+
+  async def handle(self, reader, writer):
+    """
+    Read one HTTP/1.1 request from the connection and write the json response.
+    """
+    try:
+      request_line = (await reader.readline()).decode("latin-1").split()
+      headers = {}
+      while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+          break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+      if len(request_line) < 2:
+        status, payload = 400, {"error": "Malformed request line."}
+      elif int(headers.get("content-length", 0)) > MAX_BODY:
+        status, payload = 413, {"error": f"Bodies are limited to {MAX_BODY} bytes."}
+      else:
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+        method, path = request_line[0].upper(), request_line[1].split("?")[0].rstrip("/") or "/"
+        status, payload = await self.respond(method, path, body)
+
+      content = json.dumps(payload, default = _json_default).encode()
+      writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                   f"Content-Type: application/json\r\n"
+                   f"Content-Length: {len(content)}\r\n"
+                   f"Connection: close\r\n\r\n".encode() + content)
+      await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+      pass
+    finally:
+      writer.close()
+
+  async def serve(self, host = "127.0.0.1", port = 8765, ready = None):
+    """
+    Start the workers and serve until cancelled.
+
+    Parameters:
+      host (str): Interface to listen on, localhost by default.
+
+      port (int): Port to listen on (0 picks a free one).
+
+      ready (callable): Called with the bound port once the server listens.
+    """
+    self.start()
+    try:
+      server = await asyncio.start_server(self.handle, host, port)
+      port = server.sockets[0].getsockname()[1]
+      print(f"What-if service on http://{host}:{port} ({self.n_sites} sites, {self.n_jobs} workers)")
+      if ready is not None:
+        ready(port)
+      async with server:
+        await server.serve_forever()
+    finally:
+      self.close()
+
+
+def _json_default(value):
+  if isinstance(value, np.integer):
+    return int(value)
+  if isinstance(value, np.floating):
+    return float(value)
+  if isinstance(value, np.ndarray):
+    return value.tolist()
+  return str(value)
+
+
+def request(path, payload = None, host = "127.0.0.1", port = 8765, timeout = 60):
+  """
+  Call the service: a POST of `payload` as json, a GET when it is None.
+
+  Returns:
+    dict: The decoded json response (the error message for 4xx and 5xx answers).
+
+  Example:
+      >>> request("/flows", {"year": 2019, "depots": depots, "refineries": refineries})["cost"]
+      Output: 139269.5
+  """
+  from urllib import request as urllib_request
+  from urllib.error import HTTPError
+
+  data = None if payload is None else json.dumps(payload, default = _json_default).encode()
+  query = urllib_request.Request(f"http://{host}:{port}{path}", data = data,
+                                 headers = {"Content-Type": "application/json"})
+  try:
+    with urllib_request.urlopen(query, timeout = timeout) as response:
+      return json.loads(response.read())
+  except HTTPError as error:
+    return json.loads(error.read())
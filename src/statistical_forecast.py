@@ -0,0 +1,539 @@
+"""
+NAME
+    statistical_forecast.py
+
+DESCRIPTION
+    Closed-form per-site forecasts of the yearly biomass, batched over all sites
+    ============================================================
+
+    Fast alternatives to the K-fold LightGBM of forecast_model.py. Every model
+    fits the 2418 series at once with NumPy array operations, without features
+    or training files:
+
+      LagRidge    per-site autoregression on the last n_lags years, a ridge
+                  regression shrunk towards the autoregression of all sites;
+      SpatialAR   the same autoregression fitted on the windows of the
+                  n_neighbors nearest sites (spatially pooled);
+      HoltLinear  Holt's linear (damped) trend exponential smoothing, with the
+                  smoothing weights picked from a grid by one-step-ahead error;
+      LastValue   the last observed year, as naive reference.
+
+    The series are scaled by their mean, so the coefficients and the ridge
+    penalty do not depend on the size of a site, and forecasts are clipped at 0.
+
+    Every model forecasts from several origins in one call (forecast_origins):
+    the regression models mask the windows after each origin and solve all the
+    (origins x sites) systems in one batched np.linalg.solve, Holt runs its
+    recursion once and reads its state at every origin. backtest() uses it for
+    a rolling-origin comparison with the LightGBM baseline (LightGBMBaseline,
+    retrained on the years before every origin), and out_of_sample_errors() for
+    the one-step-ahead residuals the robust plan draws its scenarios from.
+
+PACKAGE LIST
+    numpy
+    pandas
+    scipy
+    sklearn (SpatialAR, for the nearest sites)
+"""
+
+## Libraries
+import time
+import numpy as np
+import pandas as pd
+from config import PARAMS
+from dataset import as_dataset, data_years, site_labels, year_matrix
+
+
+def _scales(values, origins):
+  """
+  (origins x sites) mean of every series over the years before each origin, 1 for empty series.
+  """
+  totals = np.cumsum(values, axis = 1)[:, np.asarray(origins) - 1].T
+  scales = totals / np.asarray(origins)[:, None]
+  return np.where(scales > 0, scales, 1.0)
+
+
+def _lag_windows(values, n_lags):
+  """
+  Design of the autoregression: [1, y(t - n_lags) .. y(t - 1)] and the target y(t) of every
+  (site, target year t >= n_lags).
+
+  Returns:
+    tuple: (sites x windows x (n_lags + 1)) design, (sites x windows) targets.
+  """
+  from numpy.lib.stride_tricks import sliding_window_view
+
+  windows = sliding_window_view(values, n_lags + 1, axis = 1)
+  design = np.concatenate([np.ones(windows.shape[:2] + (1,)), windows[..., :n_lags]], axis = 2)
+  return design, windows[..., n_lags]
+
+
+def _normal_equations(values, origins, n_lags):
+  """
+  Normal equations of the scaled autoregression of every site, from the windows before every origin.
+
+  The raw Gram matrices are summed once with an (origins x windows) mask, then rescaled by
+  the mean of every series at every origin: the lags are divided by the scale, the intercept
+  column is kept.
+
+  Returns:
+    tuple: (origins x sites x q x q) Gram matrices, (origins x sites x q) right-hand sides
+           and (origins x sites) scales, with q = n_lags + 1.
+  """
+  design, target = _lag_windows(values, n_lags)
+  origins = np.asarray(origins)
+  # window j predicts year n_lags + j, usable when that year is before the origin
+  mask = (np.arange(design.shape[1])[None] < (origins - n_lags)[:, None]).astype(np.float64)
+
+  gram = np.einsum("oj,sjk,sjl->oskl", mask, design, design, optimize = True)
+  rhs = np.einsum("oj,sjk,sj->osk", mask, design, target, optimize = True)
+
+  scales = _scales(values, origins)
+  inverse = np.ones(scales.shape + (n_lags + 1,))
+  inverse[..., 1:] = 1 / scales[..., None]
+  gram *= inverse[..., :, None] * inverse[..., None, :]
+  rhs *= inverse / scales[..., None]
+  return gram, rhs, scales
+
+
+def _pooled_coefficients(gram, rhs, ridge = 1e-6):
+  """
+  (origins x q) autoregression of all the sites together, from the summed normal equations.
+  """
+  pooled_gram, pooled_rhs = gram.sum(1), rhs.sum(1)
+  penalty = ridge * np.trace(pooled_gram, axis1 = 1, axis2 = 2)[:, None, None] * np.eye(gram.shape[-1])
+  return np.linalg.solve(pooled_gram + penalty, pooled_rhs[..., None])[..., 0]
+
+
+def _roll(coefficients, values, origins, scales, horizon):
+  """
+  Recursive forecast of the scaled autoregression from every origin.
+
+  Parameters:
+    coefficients (np.ndarray): (origins x sites x q) intercept and lag coefficients.
+
+  Returns:
+    np.ndarray: (origins x sites x horizon) forecasts in biomass units.
+  """
+  n_lags = coefficients.shape[-1] - 1
+  columns = np.asarray(origins)[:, None] - n_lags + np.arange(n_lags)
+  window = np.moveaxis(values[:, columns], 0, 1) / scales[..., None]
+
+  forecast = np.empty(scales.shape + (horizon,))
+  for step in range(horizon):
+    forecast[..., step] = np.maximum(coefficients[..., 0] + np.einsum("osk,osk->os", coefficients[..., 1:], window), 0)
+    window = np.concatenate([window[..., 1:], forecast[..., step:step + 1]], axis = 2)
+  return forecast * scales[..., None]
+
+
+def _check_origins(values, origins, first):
+  origins = np.asarray(origins, dtype = np.int64)
+  if origins.min() < first or origins.max() > values.shape[1]:
+    raise ValueError(f"Origins must leave {first} to {values.shape[1]} past years, got {origins.tolist()}.")
+  return origins
+
+
+class LagRidge():
+  """
+  class LagRidge()
+
+  Per-site AR(n_lags) of the scaled series, y(t) / s = c + sum_k b_k y(t - k) / s, solved
+  as a ridge regression whose penalty alpha pulls the coefficients of every site towards
+  the autoregression of all sites (alpha = 0: free per-site fit, large: one shared model).
+
+  Example:
+      >>> LagRidge(n_lags = 3, alpha = 10.0).forecast(year_matrix(DemandHistory, range(2010, 2018)), horizon = 2).shape
+      Output: (2418, 2)
+  """
+
+  def __init__(self, n_lags = 3, alpha = 10.0):
+    self.n_lags = n_lags
+    self.alpha = alpha
+
+  def coefficients(self, values, origins):
+    """
+    (origins x sites x (n_lags + 1)) intercept and lag coefficients fitted before every origin.
+    """
+    gram, rhs, scales = _normal_equations(values, origins, self.n_lags)
+    pooled = _pooled_coefficients(gram, rhs)
+    penalty = self.alpha * np.eye(self.n_lags + 1)
+    coefficients = np.linalg.solve(gram + penalty, (rhs + self.alpha * pooled[:, None])[..., None])[..., 0]
+    return coefficients, scales
+
+  def forecast_origins(self, values, origins, horizon = 1, coordinates = None):
+    """
+    Forecast of the `horizon` years following every origin.
+
+    Parameters:
+      values (np.ndarray): (sites x years) biomass, oldest year first.
+
+      origins (list): Number of years known at every origin (the forecast starts at values[:, origin]).
+
+      horizon (int): Years forecasted from every origin.
+
+      coordinates (np.ndarray): Unused, for a common signature with SpatialAR.
+
+    Returns:
+      np.ndarray: (origins x sites x horizon) forecasts.
+    """
+    values = np.asarray(values, dtype = np.float64)
+    origins = _check_origins(values, origins, self.n_lags + 1)
+    coefficients, scales = self.coefficients(values, origins)
+    return _roll(coefficients, values, origins, scales, horizon)
+
+  def forecast(self, values, horizon = 1, coordinates = None):
+    """
+    (sites x horizon) forecast of the years following `values`.
+    """
+    return self.forecast_origins(values, [np.shape(values)[1]], horizon, coordinates)[0]
+
+
+class SpatialAR(LagRidge):
+  """
+  class SpatialAR()
+
+  Autoregression of the scaled series fitted on the windows of the n_neighbors nearest
+  sites (the site itself included), then shrunk by alpha towards the autoregression of
+  all sites. The neighbourhoods pool the few windows a single site has.
+
+  Example:
+      >>> SpatialAR(n_neighbors = 16).forecast(values, horizon = 2, coordinates = coordinates).shape
+      Output: (2418, 2)
+  """
+
+  def __init__(self, n_lags = 3, n_neighbors = 16, alpha = 2.0):
+    super().__init__(n_lags, alpha)
+    self.n_neighbors = n_neighbors
+
+  def neighbours(self, coordinates):
+    """
+    (sites x sites) sparse matrix averaging the n_neighbors nearest sites of every site.
+    """
+    from scipy import sparse
+    from utils import SiteIndex
+
+    coordinates = np.asarray(coordinates, dtype = np.float64)
+    n_sites = len(coordinates)
+    k = min(self.n_neighbors, n_sites)
+    _, positions = SiteIndex(coordinates[:, 0], coordinates[:, 1]).query(coordinates[:, 0], coordinates[:, 1], k = k)
+    return sparse.csr_matrix((np.full(n_sites * k, 1 / k), (np.repeat(np.arange(n_sites), k), positions.reshape(-1))),
+                             shape = (n_sites, n_sites))
+
+  def coefficients(self, values, origins, coordinates = None):
+    if coordinates is None:
+      raise ValueError("SpatialAR needs the (sites x 2) latitude and longitude of the sites.")
+    gram, rhs, scales = _normal_equations(values, origins, self.n_lags)
+    pooled = _pooled_coefficients(gram, rhs)
+
+    average = self.neighbours(coordinates)
+    n_origins, n_sites, q = rhs.shape
+    # One sparse product per origin sums the normal equations of every neighbourhood
+    gram = np.stack([average @ x.reshape(n_sites, -1) for x in gram]).reshape(gram.shape)
+    rhs = np.stack([average @ x for x in rhs])
+
+    penalty = self.alpha * np.eye(q)
+    coefficients = np.linalg.solve(gram + penalty, (rhs + self.alpha * pooled[:, None])[..., None])[..., 0]
+    return coefficients, scales
+
+  def forecast_origins(self, values, origins, horizon = 1, coordinates = None):
+    values = np.asarray(values, dtype = np.float64)
+    origins = _check_origins(values, origins, self.n_lags + 1)
+    coefficients, scales = self.coefficients(values, origins, coordinates)
+    return _roll(coefficients, values, origins, scales, horizon)
+
+
+class HoltLinear():
+  """
+  class HoltLinear()
+
+  Holt's linear trend smoothing with damping phi:
+
+    level(t) = a y(t) + (1 - a) (level(t - 1) + phi trend(t - 1))
+    trend(t) = b (level(t) - level(t - 1)) + (1 - b) phi trend(t - 1)
+    forecast(t + h) = level(t) + (phi + ... + phi^h) trend(t)
+
+  Every (a, b) pair of the grid is run on every site at once. `selection` = "global"
+  keeps the pair with the lowest scaled one-step-ahead error over all sites,
+  "site" the best pair of every site.
+
+  Example:
+      >>> HoltLinear(damping = 0.5).forecast(values, horizon = 2).shape
+      Output: (2418, 2)
+  """
+
+  def __init__(self,
+               levels = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+               trends = (0.0, 0.05, 0.1, 0.2, 0.3),
+               damping = 0.5,
+               selection = "global"):
+    if selection not in ("global", "site"):
+      raise ValueError(f"selection must be 'global' or 'site', got {selection!r}.")
+    self.levels = levels
+    self.trends = trends
+    self.damping = damping
+    self.selection = selection
+
+  def states(self, values):
+    """
+    Level, trend and cumulated squared one-step error of every grid pair after every year.
+
+    Returns:
+      tuple: Three (years x pairs x sites) arrays, and the (pairs x 2) grid.
+    """
+    grid = np.array([(a, b) for a in self.levels for b in self.trends], dtype = np.float64)
+    a, b = grid[:, :1], grid[:, 1:]
+    phi = self.damping
+    n_sites, n_years = values.shape
+
+    levels = np.empty((n_years, len(grid), n_sites))
+    trends = np.empty_like(levels)
+    errors = np.zeros_like(levels)
+    levels[0], trends[0] = values[:, 0], 0.0
+    if n_years > 1:
+      levels[1], trends[1] = values[:, 1], values[:, 1] - values[:, 0]
+
+    for t in range(2, n_years):
+      predicted = levels[t - 1] + phi * trends[t - 1]
+      errors[t] = errors[t - 1] + (values[:, t] - predicted) ** 2
+      levels[t] = a * values[:, t] + (1 - a) * predicted
+      trends[t] = b * (levels[t] - levels[t - 1]) + (1 - b) * phi * trends[t - 1]
+
+    return levels, trends, errors, grid
+
+  def forecast_origins(self, values, origins, horizon = 1, coordinates = None):
+    """
+    Forecast of the `horizon` years following every origin, see LagRidge.forecast_origins.
+    """
+    values = np.asarray(values, dtype = np.float64)
+    origins = _check_origins(values, origins, 2)
+    levels, trends, errors, _ = self.states(values)
+
+    last = origins - 1
+    error = errors[last]
+    if self.selection == "global":
+      scaled = (error / _scales(values, origins)[:, None] ** 2).sum(2)
+      best = np.broadcast_to(scaled.argmin(1)[:, None], (len(origins), values.shape[0]))
+    else:
+      best = error.argmin(1)
+
+    sites = np.arange(values.shape[0])
+    level = levels[last[:, None], best, sites]
+    trend = trends[last[:, None], best, sites]
+    damped = np.cumsum(self.damping ** np.arange(1, horizon + 1))
+    return np.maximum(level[..., None] + trend[..., None] * damped, 0)
+
+  def forecast(self, values, horizon = 1, coordinates = None):
+    return self.forecast_origins(values, [np.shape(values)[1]], horizon, coordinates)[0]
+
+
+class LastValue():
+  """
+  class LastValue()
+
+  Naive forecast: the last known year, repeated.
+  """
+
+  def forecast_origins(self, values, origins, horizon = 1, coordinates = None):
+    values = np.asarray(values, dtype = np.float64)
+    origins = _check_origins(values, origins, 1)
+    return np.repeat(values[:, origins - 1].T[..., None], horizon, axis = 2)
+
+  def forecast(self, values, horizon = 1, coordinates = None):
+    return self.forecast_origins(values, [np.shape(values)[1]], horizon, coordinates)[0]
+
+
+MODELS = {"ridge": LagRidge, "spatial_ar": SpatialAR, "holt": HoltLinear, "last": LastValue}
+
+
+class LightGBMBaseline():
+  """
+  class LightGBMBaseline()
+
+  The K-fold LightGBM of forecast_model.py, retrained on the windows before every
+  origin and rolled with forecast_horizon, as baseline of backtest(). The fold models
+  are cached in `model_dir` like those of the pipeline.
+  """
+
+  def __init__(self,
+               window_size = 3,
+               params = PARAMS.lgb_params,
+               n_splits = PARAMS.n_splits,
+               seed = PARAMS.SEED,
+               model_dir = "models",
+               cache_dir = "data/interim"):
+    self.window_size = window_size
+    self.params = params
+    self.n_splits = n_splits
+    self.seed = seed
+    self.model_dir = model_dir
+    self.cache_dir = cache_dir
+
+  def forecast_origins(self, values, origins, horizon = 1, coordinates = None):
+    from utils import create_train_data
+    from forecast_model import train_forecast_models, forecast_horizon
+    from dataset import BiomassDataset
+
+    values = np.asarray(values, dtype = np.float64)
+    origins = _check_origins(values, origins, self.window_size + 1)
+    if coordinates is None:
+      raise ValueError("LightGBMBaseline needs the (sites x 2) latitude and longitude of the sites.")
+
+    data = BiomassDataset(coordinates[:, 0], coordinates[:, 1], values, range(values.shape[1]))
+    forecast = np.empty((len(origins), values.shape[0], horizon))
+    for (i, origin) in enumerate(origins):
+      train = create_train_data(data, window_size = self.window_size, years = list(range(origin)))
+      features = [x for x in train.columns if x not in ["Latitude", "Longitude", "Target"]]
+      models, _ = train_forecast_models(train, features = features, params = self.params,
+                                        n_splits = self.n_splits, seed = self.seed,
+                                        model_dir = self.model_dir, cache_dir = self.cache_dir)
+      rows = forecast_horizon(data, models, range(origin, origin + horizon), self.window_size)
+      forecast[i] = rows["value"].to_numpy().reshape(horizon, -1).T
+    return forecast
+
+
+def _history_values(demand_history, before = None):
+  """
+  (sites x years) float64 biomass of the consecutive years of `demand_history` (before `before`),
+  the first year and the (sites x 2) coordinates.
+  """
+  data = as_dataset(demand_history)
+  years = sorted(int(x) for x in data_years(demand_history) if before is None or int(x) < before)
+  if years != list(range(years[0], years[-1] + 1)):
+    raise ValueError(f"The history years must be consecutive, got {years}.")
+  return year_matrix(data, years), years[0], data.coordinates
+
+
+def statistical_forecast(demand_history, years, model = "ridge", **params):
+  """
+  Forecast of every site over consecutive years with one of the closed-form models.
+
+  Parameters:
+    demand_history (pd.DataFrame or BiomassDataset): Biomass data with every year before years[0].
+
+    years (list): Consecutive years to forecast, starting the year after the history.
+
+    model (str or object): "ridge", "spatial_ar", "holt", "last", or a model instance.
+
+    params: Parameters of the model class (n_lags, alpha, n_neighbors, damping, ...).
+
+  Returns:
+    dataframe: The biomass_forecast rows of every year, as forecast_model.forecast_horizon.
+
+  Example:
+      >>> forecast = statistical_forecast(DemandHistory, [2018, 2019], model = "ridge")
+      >>> forecast.groupby("year")["value"].sum().round()
+      Output: year
+              2018    358559.0
+              2019    345549.0
+  """
+  years = [int(x) for x in years]
+  if model in MODELS:
+    model = MODELS[model](**params)
+  elif isinstance(model, str):
+    raise ValueError(f"Unknown model {model!r}, use one of {sorted(MODELS)}.")
+
+  values, _, coordinates = _history_values(demand_history, before = years[0])
+  forecast = model.forecast(values, horizon = len(years), coordinates = coordinates)
+
+  return pd.DataFrame({"year": np.repeat(years, len(values)),
+                       "data_type": "biomass_forecast",
+                       "source_index": np.tile(site_labels(demand_history), len(years)),
+                       "destination_index": 0,
+                       "value": forecast.T.reshape(-1)})
+
+
+def out_of_sample_errors(demand_history, model = "ridge", origins = None, before = None, **params):
+  """
+  One-step-ahead errors of a model refitted before every origin year, the residuals
+  forecast_model.forecast_scenarios draws around the forecast of that model.
+
+  Parameters:
+    demand_history (pd.DataFrame or BiomassDataset): Biomass history.
+
+    model (str or object): "ridge", "spatial_ar", "holt", "last", or a model instance.
+
+    origins (list): Forecasted years (default: the second half of the history, after
+                    the n_lags years an autoregression needs).
+
+    before (int): Only the years before it are used, e.g. the first forecasted year.
+
+    params: Parameters of the model class.
+
+  Returns:
+    tuple: (residuals, predictions) of every site and origin, residuals = biomass - prediction.
+
+  Example:
+      >>> residuals, predictions = out_of_sample_errors(DemandHistory, "ridge", n_lags = 3)
+      >>> residuals.shape, np.abs(residuals).mean().round(2)
+      Output: ((9672,), 40.42)
+  """
+  if model in MODELS:
+    model = MODELS[model](**params)
+  elif isinstance(model, str):
+    raise ValueError(f"Unknown model {model!r}, use one of {sorted(MODELS)}.")
+
+  values, first_year, coordinates = _history_values(demand_history, before = before)
+  n_years = values.shape[1]
+  if origins is None:
+    positions = np.arange(max(n_years // 2, getattr(model, "n_lags", 1) + 1), n_years)
+  else:
+    positions = np.array([int(x) - first_year for x in origins])
+
+  predictions = model.forecast_origins(values, positions, 1, coordinates)[..., 0]
+  return (values[:, positions].T - predictions).reshape(-1), predictions.reshape(-1)
+
+
+def backtest(demand_history, models = None, origins = None, horizon = 1):
+  """
+  Rolling-origin backtest: every model is fitted on the years before each origin year and
+  forecasts the `horizon` following years, scored by the mean absolute error over the sites.
+
+  Parameters:
+    demand_history (pd.DataFrame or BiomassDataset): Biomass history.
+
+    models (dict): Name -> model (default: one instance of every model of MODELS).
+                   Add LightGBMBaseline() to compare with LightGBM.
+
+    origins (list): First forecasted year of every fold (default: the last 3 years
+                    leaving `horizon` years to score).
+
+    horizon (int): Years forecasted from every origin.
+
+  Returns:
+    dataframe: model, origin, step (years ahead, from 1), mae and seconds (time of the model
+               over all the origins).
+
+  Example:
+      >>> models = {"ridge": LagRidge(), "holt": HoltLinear(), "lightgbm": LightGBMBaseline()}
+      >>> backtest(DemandHistory, models, horizon = 2).pivot_table(index = "model", columns = "step", values = "mae")
+      Output: step          1      2
+              model
+              holt      38.28  44.19
+              lightgbm  45.19  50.36
+              ridge     41.57  39.17
+  """
+  values, first_year, coordinates = _history_values(demand_history)
+  n_years = values.shape[1]
+  if origins is None:
+    origins = [first_year + x for x in range(max(1, n_years - horizon - 2), n_years - horizon + 1)]
+  positions = np.array([int(x) - first_year for x in origins])
+  if positions.max() + horizon > n_years:
+    raise ValueError(f"Origins {list(origins)} leave less than {horizon} years to score.")
+
+  if models is None:
+    models = {name: cls() for (name, cls) in MODELS.items()}
+
+  truth = np.stack([values[:, x:x + horizon] for x in positions])
+  rows = []
+  for (name, model) in models.items():
+    start = time.perf_counter()
+    forecast = model.forecast_origins(values, positions, horizon, coordinates)
+    seconds = time.perf_counter() - start
+
+    mae = np.abs(forecast - truth).mean(1)
+    for (i, origin) in enumerate(origins):
+      for step in range(horizon):
+        rows.append({"model": name, "origin": int(origin), "step": step + 1,
+                     "mae": mae[i, step], "seconds": seconds})
+
+  return pd.DataFrame(rows)
@@ -0,0 +1,397 @@
+"""
+NAME
+    submission_io.py
+
+DESCRIPTION
+    Compact columnar submissions: streaming writer, chunked reader, csv export
+    ============================================================
+
+    A submission built with pd.concat and written with to_csv keeps the
+    data_type as strings and every number in 64 bits. The files written here
+    keep the same five columns in compact form:
+
+      year               int32 (location rows use 20182019)
+      data_type          dictionary (int8 codes of DATA_TYPES)
+      source_index       int16 (int32 above 32767 sites)
+      destination_index  int16 (int32 above 32767 sites)
+      value              float64 (float32 on demand)
+
+    Blank cells of the official csv (destination_index and value of the
+    location rows) are stored as nulls, read back as pandas nullable integers
+    or NaN, and written back as blanks by export_csv.
+
+    as Parquet (.parquet, one row group per write) or Arrow IPC (.arrow /
+    .feather, one record batch per write).
+
+    SubmissionWriter appends the stage outputs as they are produced, so a
+    solution is never concatenated in memory. iter_submission reads a file
+    back in chunks, validate_submission feeds them to constraintsSummary
+    one at a time and export_csv streams the official csv schema.
+
+    float32 values round a 20,000 t flow by up to 1e-3 t, the tolerance of
+    constraint 8, so a file that must pass the validator keeps the default
+    value_dtype = np.float64; float32 only suits files that are not validated.
+
+PACKAGE LIST
+    numpy
+    pandas
+    pyarrow
+"""
+
+## Libraries
+import os
+import numpy as np
+import pandas as pd
+from test_constraint import DATA_TYPES, constraintsSummary
+
+SUBMISSION_COLUMNS = ['year', 'data_type', 'source_index', 'destination_index', 'value']
+
+
+def _file_format(path):
+  """
+  "parquet" or "arrow", from the file extension.
+  """
+  extension = os.path.splitext(path)[1].lower()
+  if extension == ".parquet":
+    return "parquet"
+  if extension in (".arrow", ".feather", ".ipc"):
+    return "arrow"
+  raise ValueError(f"Unknown submission format {extension!r}, use .parquet or .arrow.")
+
+
+def index_dtype(n_sites = 2418):
+  """
+  Smallest integer type holding every site index: int16 up to 32767 sites, int32 above.
+  """
+  return np.int16 if n_sites <= np.iinfo(np.int16).max + 1 else np.int32
+
+
+def _integers(values, dtype, name):
+  """
+  `values` as `dtype`, refusing values the cast would change (fractional or out of range).
+  Missing values (NaN, blank csv cells) give a nullable pandas array of `dtype`.
+  """
+  values = np.asarray(values)
+  missing = pd.isna(values) if values.dtype.kind in "fO" else np.zeros(len(values), dtype = bool)
+  if missing.any():
+    values = np.where(missing, 0, values).astype(np.float64)
+  compact = values.astype(dtype)
+  if not np.array_equal(compact[~missing], values[~missing]):
+    raise ValueError(f"{name} does not fit {np.dtype(dtype).name} losslessly, validate the submission "
+                     "before compacting it.")
+  return pd.arrays.IntegerArray(compact, missing) if missing.any() else compact
+
+
+def _arrow_integers(values, arrow_type):
+  """
+  Arrow array of integer values, the missing ones (nullable pandas array) as nulls.
+  """
+  import pyarrow as pa
+
+  if isinstance(values, pd.api.extensions.ExtensionArray):
+    return pa.array(values.to_numpy(dtype = arrow_type.to_pandas_dtype(), na_value = 0),
+                    mask = np.asarray(values.isna()), type = arrow_type)
+  return pa.array(np.asarray(values), type = arrow_type)
+
+
+def _numpy_integers(column):
+  """
+  Integer column of a record batch: a NumPy array, or a nullable pandas array when it has nulls.
+  """
+  if column.null_count == 0:
+    return column.to_numpy()
+  return pd.arrays.IntegerArray(column.fill_null(0).to_numpy(), column.is_null().to_numpy(zero_copy_only = False))
+
+
+def to_compact(submission, n_sites = 2418, value_dtype = np.float64):
+  """
+  Submission rows in compact dtypes: categorical data_type, int32 year, int16 indices, float64 value.
+
+  Parameters:
+    submission (pd.DataFrame): Submission rows (year, data_type, source_index, destination_index, value).
+
+    n_sites (int): Number of harvesting sites, sets the index dtype.
+
+    value_dtype (np.dtype): Type of the values.
+
+  Returns:
+    dataframe: The same rows and index. Unknown data types become NaN, blank indices
+               nullable integers (pd.NA) and blank values NaN.
+
+  Example:
+      >>> to_compact(submission).memory_usage(deep = True).sum() / submission.memory_usage(deep = True).sum()
+      Output: 0.22
+  """
+  indices = index_dtype(n_sites)
+  data_type = submission["data_type"]
+  if not (isinstance(data_type.dtype, pd.CategoricalDtype) and list(data_type.cat.categories) == DATA_TYPES):
+    data_type = pd.Categorical(data_type, categories = DATA_TYPES)
+
+  return pd.DataFrame({"year": _integers(submission["year"], np.int32, "year"),
+                       "data_type": data_type,
+                       "source_index": _integers(submission["source_index"], indices, "source_index"),
+                       "destination_index": _integers(submission["destination_index"], indices, "destination_index"),
+                       "value": pd.to_numeric(submission["value"]).to_numpy(dtype = value_dtype, na_value = np.nan)},
+                      index = submission.index)
+
+
+def _schema(n_sites, value_dtype):
+  import pyarrow as pa
+
+  indices = pa.from_numpy_dtype(index_dtype(n_sites))
+  return pa.schema([("year", pa.int32()),
+                    ("data_type", pa.dictionary(pa.int8(), pa.string())),
+                    ("source_index", indices),
+                    ("destination_index", indices),
+                    ("value", pa.from_numpy_dtype(np.dtype(value_dtype)))])
+
+
+class SubmissionWriter():
+  """
+  class SubmissionWriter()
+
+  Streaming writer of a compact submission file. Every write() appends its rows
+  as one Parquet row group or Arrow record batch.
+
+  Example:
+      >>> with SubmissionWriter("data/output/Submission.parquet") as writer:
+      ...   writer.write(depots[SUBMISSION_COLUMNS])
+      ...   writer.write(refineries[SUBMISSION_COLUMNS])
+      ...   for year in [2018, 2019]:
+      ...     writer.write(BiomassDemandSupplyFlow(demand, depots_distance, year)[SUBMISSION_COLUMNS])
+      >>> writer.rows
+      Output: 9742
+  """
+
+  def __init__(self, path, n_sites = 2418, value_dtype = np.float64):
+    """
+    Parameters:
+      path (str): .parquet or .arrow file, replaced when it exists.
+
+      n_sites (int): Number of harvesting sites, sets the index dtype.
+
+      value_dtype (np.dtype): np.float64 (default) or np.float32, for files that are not validated.
+    """
+    import pyarrow as pa
+
+    self.path = path
+    self.format = _file_format(path)
+    self.n_sites = n_sites
+    self.value_dtype = value_dtype
+    self.schema = _schema(n_sites, value_dtype)
+    self.rows = 0
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+    # Written next to the target and renamed on close, so a failed run leaves no partial file
+    self._tmp_path = f"{path}.{os.getpid()}.tmp"
+    if self.format == "parquet":
+      import pyarrow.parquet as pq
+      self._writer = pq.ParquetWriter(self._tmp_path, self.schema, compression = "zstd")
+    else:
+      self._sink = pa.OSFile(self._tmp_path, "wb")
+      self._writer = pa.ipc.new_file(self._sink, self.schema,
+                                     options = pa.ipc.IpcWriteOptions(compression = "zstd"))
+
+  def write(self, submission):
+    """
+    Append submission rows (a DataFrame with the submission columns, any dtypes).
+
+    Returns:
+      dataframe: The rows as stored (to_compact), e.g. to validate what was written.
+    """
+    import pyarrow as pa
+
+    compact = to_compact(submission, self.n_sites, self.value_dtype)
+    if len(compact) == 0:
+      return compact
+
+    codes = compact["data_type"].cat.codes.to_numpy().astype(np.int8)
+    data_type = pa.DictionaryArray.from_arrays(pa.array(codes, mask = codes < 0), pa.array(DATA_TYPES))
+    table = pa.Table.from_arrays([_arrow_integers(compact["year"].array, self.schema.field("year").type),
+                                  data_type,
+                                  _arrow_integers(compact["source_index"].array, self.schema.field("source_index").type),
+                                  _arrow_integers(compact["destination_index"].array,
+                                                  self.schema.field("destination_index").type),
+                                  pa.array(compact["value"].to_numpy(), from_pandas = True)],
+                                 schema = self.schema)
+    self._writer.write_table(table)
+    self.rows += len(compact)
+    return compact
+
+  def close(self):
+    """
+    Finish the file (also done when leaving a `with` block without error).
+    """
+    if self._writer is None:
+      return
+    self._writer.close()
+    if self.format == "arrow":
+      self._sink.close()
+    self._writer = None
+    os.replace(self._tmp_path, self.path)
+
+  def abort(self):
+    """
+    Drop the partial file.
+    """
+    if self._writer is None:
+      return
+    try:
+      self._writer.close()
+      if self.format == "arrow":
+        self._sink.close()
+    finally:
+      self._writer = None
+      if os.path.exists(self._tmp_path):
+        os.remove(self._tmp_path)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, error_type, error, traceback):
+    if error_type is None:
+      self.close()
+    else:
+      self.abort()
+
+
+def write_submission(submission, path, n_sites = 2418, value_dtype = np.float64):
+  """
+  Write a whole submission (a DataFrame or a list of parts) to a compact file.
+
+  Returns:
+    str: `path`.
+
+  Example:
+      >>> write_submission([biomass, pellet, forecast, refineries, depots], "data/output/Submission.parquet")
+  """
+  parts = submission if isinstance(submission, (list, tuple)) else [submission]
+  with SubmissionWriter(path, n_sites, value_dtype) as writer:
+    for part in parts:
+      writer.write(part)
+  return path
+
+
+def _batch_frame(batch, start):
+  """
+  Compact DataFrame of one record batch, its rows labelled from `start`.
+  """
+  data_type = batch.column("data_type")
+  dictionary = data_type.dictionary.to_pylist()
+  codes = data_type.indices.to_numpy(zero_copy_only = False)
+  codes = np.where(data_type.is_null().to_numpy(zero_copy_only = False), -1, codes)
+  # Re-coded through the dictionary of the batch, written by other tools in any order
+  codes = np.append(pd.Index(DATA_TYPES).get_indexer(dictionary), -1)[codes]
+
+  frame = {x: _numpy_integers(batch.column(x)) for x in ["year", "source_index", "destination_index"]}
+  frame["value"] = batch.column("value").to_numpy(zero_copy_only = False)
+  frame["data_type"] = pd.Categorical.from_codes(codes, categories = DATA_TYPES)
+  return pd.DataFrame(frame, columns = SUBMISSION_COLUMNS,
+                      index = pd.RangeIndex(start, start + batch.num_rows))
+
+
+def iter_submission(path, chunk_size = 65536):
+  """
+  Read a compact submission file in chunks.
+
+  Parameters:
+    path (str): .parquet or .arrow file.
+
+    chunk_size (int): Rows per chunk. Arrow files are read one record batch at a time,
+                      split to `chunk_size` rows.
+
+  Returns:
+    generator: Compact DataFrames, their index numbering the rows of the whole file.
+
+  Example:
+      >>> sum(len(x) for x in iter_submission("data/output/Submission.parquet", chunk_size = 1000))
+      Output: 9742
+  """
+  if _file_format(path) == "parquet":
+    import pyarrow.parquet as pq
+    batches = pq.ParquetFile(path).iter_batches(batch_size = chunk_size)
+  else:
+    import pyarrow as pa
+    reader = pa.ipc.open_file(pa.memory_map(path, "r"))
+    batches = (batch.slice(offset, chunk_size)
+               for batch in (reader.get_batch(i) for i in range(reader.num_record_batches))
+               for offset in range(0, batch.num_rows, chunk_size))
+
+  start = 0
+  for batch in batches:
+    yield _batch_frame(batch, start)
+    start += batch.num_rows
+
+
+def read_submission(path):
+  """
+  Whole compact submission file as one compact DataFrame.
+  """
+  chunks = list(iter_submission(path, chunk_size = 1 << 20))
+  if not chunks:
+    return pd.DataFrame({"year": np.array([], dtype = np.int32),
+                         "data_type": pd.Categorical([], categories = DATA_TYPES),
+                         "source_index": np.array([], dtype = np.int16),
+                         "destination_index": np.array([], dtype = np.int16),
+                         "value": np.array([], dtype = np.float32)})
+  return pd.concat(chunks)
+
+
+def validate_submission(path, years = [2018, 2019], n_sites = 2418, chunk_size = 65536):
+  """
+  Constraint aggregates of a submission file, read one chunk at a time.
+
+  Parameters:
+    path (str): .parquet, .arrow or official .csv submission.
+
+    years (list): Years of the solution.
+
+    n_sites (int): Number of harvesting sites.
+
+    chunk_size (int): Rows read at once.
+
+  Returns:
+    constraintsSummary: Call .report() for the checks, as constraintsTest.report().
+
+  Example:
+      >>> validate_submission("data/output/Submission.parquet").report()["passed"]
+      Output: True
+  """
+  summary = constraintsSummary(years, n_sites)
+  if os.path.splitext(path)[1].lower() == ".csv":
+    chunks = pd.read_csv(path, chunksize = chunk_size)
+  else:
+    chunks = iter_submission(path, chunk_size)
+
+  for chunk in chunks:
+    summary.update(chunk)
+  return summary
+
+
+def export_csv(path, output, chunk_size = 65536):
+  """
+  Write a compact submission file as the official csv (year, data_type, source_index,
+  destination_index, value with data_type as text and nulls as blank cells), one chunk at a time.
+
+  Returns:
+    str: `output`.
+
+  Example:
+      >>> export_csv("data/output/Submission.parquet", "data/output/Submission.csv")
+  """
+  os.makedirs(os.path.dirname(output) or ".", exist_ok = True)
+  tmp_path = f"{output}.{os.getpid()}.tmp"
+  try:
+    with open(tmp_path, "w", newline = "") as f:
+      header = True
+      for chunk in iter_submission(path, chunk_size):
+        chunk.astype({"data_type": object}).to_csv(f, index = False, header = header)
+        header = False
+      if header:
+        pd.DataFrame(columns = SUBMISSION_COLUMNS).to_csv(f, index = False)
+    os.replace(tmp_path, output)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+  return output
@@ -0,0 +1,337 @@
+"""
+NAME
+    sweep.py
+
+DESCRIPTION
+    Parallel scenario sweep over capacities, seeds and forecast variants
+    ============================================================
+
+    sweep.py runs depots -> refineries -> flows -> validation -> score for
+    every combination of a parameter grid, in a process pool.
+
+    The workers do not receive pickled copies of the inputs: the forecasted
+    biomass of every forecast variant is placed once in shared memory, and the
+    distance matrix is the memory-mapped DistanceStore, opened by path in
+    every worker. A worker reads each variant into one immutable
+    BiomassDataset, shared by all its scenarios without copies.
+
+    One csv row is appended per finished scenario, keyed by a hash of its
+    parameters, so an interrupted sweep resumes with the missing and the
+    failed scenarios only.
+    With `submissions_dir`, the parts of every solution are streamed to a
+    compact <scenario_id>.parquet file (submission_io.py) as they are solved.
+
+PACKAGE LIST
+    numpy
+    pandas
+"""
+
+## Libraries
+import os
+import io
+import json
+import time
+import hashlib
+import itertools
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+
+# Parameters a scenario can set, with their default values
+SCENARIO_DEFAULTS = {"depot_method": "kmeans",
+                     "depot_capacity": 20000,
+                     "refinery_method": "heuristic",
+                     "refinery_capacity": 100000,
+                     "flow_solver": "flow",
+                     "seed": 47,
+                     "time_limit": 1.0,
+                     "forecast": "default"}
+
+SUBMISSION_COLUMNS = ['year', 'data_type', 'source_index', 'destination_index', 'value']
+
+# Columns of the results csv
+RESULT_COLUMNS = ["scenario_id", *SCENARIO_DEFAULTS, "passed", "failed_checks", "n_depots", "n_refineries",
+                  "transport", "underutilisation", "cost", "runtime", "error"]
+
+# Inputs shared with the worker processes, set by _init_worker
+_shared = {}
+
+
+def expand_grid(grid, defaults = SCENARIO_DEFAULTS):
+  """
+  Every combination of the grid values, completed with the default parameters.
+
+  Parameters:
+    grid (dict): Parameter name -> list of values (or a single value).
+
+    defaults (dict): Value of the parameters missing from the grid.
+
+  Returns:
+    list: One dict per scenario, with its "scenario_id".
+
+  Example:
+      >>> len(expand_grid({"refinery_capacity": [80000, 100000], "seed": [1, 2, 3]}))
+      Output: 6
+  """
+  unknown = set(grid) - set(SCENARIO_DEFAULTS)
+  if unknown:
+    raise ValueError(f"Unknown sweep parameters: {sorted(unknown)}")
+
+  names = list(grid)
+  values = [x if isinstance(x, (list, tuple)) else [x] for x in grid.values()]
+
+  scenarios = []
+  for combination in itertools.product(*values):
+    scenario = dict(SCENARIO_DEFAULTS, **defaults)
+    scenario.update(zip(names, combination))
+    content = json.dumps(scenario, sort_keys = True, default = str)
+    scenario["scenario_id"] = hashlib.sha1(content.encode()).hexdigest()[:12]
+    scenarios.append(scenario)
+
+  return scenarios
+
+
+def _init_worker(shm_name, shape, variants, coordinates, index, columns, years, store_path, submissions_dir = None):
+  """
+  Attach the worker to the shared forecasts and open the distance store.
+  """
+  from distance_store import DistanceStore
+
+  memory = shared_memory.SharedMemory(name = shm_name)
+  _shared["memory"] = memory
+  _shared["biomass"] = np.ndarray(shape, dtype = np.float64, buffer = memory.buf)
+  _shared["variants"] = variants
+  _shared["coordinates"] = coordinates
+  _shared["index"] = index
+  _shared["columns"] = columns
+  _shared["years"] = years
+  _shared["store"] = DistanceStore(store_path)
+  _shared["submissions_dir"] = submissions_dir
+  _shared["datasets"] = {}
+
+
+def share_forecasts(forecasts, store_path, years, submissions_dir = None):
+  """
+  Place the forecast variants in shared memory for a pool initialised with _init_worker.
+
+  Parameters:
+    forecasts (dict): Forecast variant name -> biomass DataFrame or BiomassDataset, all with
+                      the same sites and years.
+
+    store_path (str): Path of the DistanceStore .npy file.
+
+    years (list): Years of the solution.
+
+    submissions_dir (str): Folder of the scenario submissions (see run_sweep).
+
+  Returns:
+    tuple: The SharedMemory block (to close and unlink once the pool is done) and the
+           _init_worker arguments.
+  """
+  from dataset import data_years, site_coordinates, site_labels, year_matrix
+
+  variants = list(forecasts)
+  first = forecasts[variants[0]]
+  columns = data_years(first)
+  biomass = np.stack([year_matrix(forecasts[x], columns) for x in variants])
+
+  memory = shared_memory.SharedMemory(create = True, size = max(biomass.nbytes, 1))
+  np.ndarray(biomass.shape, dtype = np.float64, buffer = memory.buf)[:] = biomass
+  initargs = (memory.name, biomass.shape, variants, np.column_stack(site_coordinates(first)),
+              site_labels(first), columns, list(years), store_path, submissions_dir)
+
+  return memory, initargs
+
+
+def _demand(variant):
+  """
+  BiomassDataset of one forecast variant, read from the shared array on first use.
+  """
+  from dataset import BiomassDataset
+
+  if variant not in _shared["datasets"]:
+    biomass = _shared["biomass"][_shared["variants"].index(variant)]
+    _shared["datasets"][variant] = BiomassDataset(_shared["coordinates"][:, 0], _shared["coordinates"][:, 1],
+                                                  biomass, _shared["columns"], _shared["index"])
+  return _shared["datasets"][variant]
+
+
+def run_scenario(scenario):
+  """
+  Depots, refineries, flows, validation and score of one scenario (in a worker).
+
+  The depot and refinery capacities of the scenario are used for the validation and for
+  the underutilisation cost, so scenarios of different capacities can be compared.
+
+  Returns:
+    dict: The scenario parameters with the validation result, the cost components,
+          the number of facilities, the runtime and the error message if it failed.
+  """
+  from depot_locator import DepotLocator, CapacitatedDepotLocator
+  from refinery_locator import RefineryLocator
+  from network_flow import BiomassDemandSupplyFlow, PelletDemandSupplyFlow
+  from optimization_model import BiomassDemandSupply
+  from test_constraint import constraintsSummary
+  from scorer import score_submission
+  from dataset import year_values
+  from submission_io import SubmissionWriter
+
+  start = time.time()
+  result = dict(scenario)
+  store, years = _shared["store"], _shared["years"]
+  year_cols = [f"{x}" for x in years]
+  writer, summary = None, None
+  score = dict.fromkeys(["forecast", "transport", "underutilisation", "cost"], 0.0)
+
+  # The parts are validated and scored one at a time (every cost component is a sum over
+  # the rows) and, when saved, streamed to the file: the submission is never concatenated.
+  def add(part):
+    if writer is not None:
+      part = writer.write(part)  # the rows as stored
+    summary.update(part)
+    for (component, value) in score_submission(part, store, years = years,
+                                               depot_capacity = scenario["depot_capacity"],
+                                               refinery_capacity = scenario["refinery_capacity"]).items():
+      score[component] += value
+
+  try:
+    # The locators report their progress on stdout, which would interleave across workers
+    with contextlib.redirect_stdout(io.StringIO()):
+      demand = _demand(scenario["forecast"])
+      summary = constraintsSummary(years, n_sites = len(demand))
+      if _shared.get("submissions_dir"):
+        writer = SubmissionWriter(os.path.join(_shared["submissions_dir"], f"{scenario['scenario_id']}.parquet"),
+                                  n_sites = len(demand))
+
+      if scenario["depot_method"] == "capacitated":
+        depots = CapacitatedDepotLocator(demand, year_cols, scenario["depot_capacity"],
+                                         distance_matrix = store, seed = scenario["seed"],
+                                         time_limit = scenario["time_limit"])
+      else:
+        depots = DepotLocator(demand, year_cols, scenario["depot_capacity"], seed = scenario["seed"])
+
+      refineries, _ = RefineryLocator(demand, depots, store, year_cols,
+                                      depot_apacity = scenario["depot_capacity"],
+                                      refinery_apacity = scenario["refinery_capacity"],
+                                      method = scenario["refinery_method"],
+                                      time_limit = scenario["time_limit"],
+                                      seed = scenario["seed"])
+
+      depots_distance = store.iloc[:, depots["source_index"].to_numpy()]
+      add(depots[SUBMISSION_COLUMNS])
+      add(refineries[SUBMISSION_COLUMNS])
+      for year in years:
+        solver = BiomassDemandSupply if scenario["flow_solver"] == "lp" else BiomassDemandSupplyFlow
+        biomass_supply = solver(demand, depots_distance, year, scenario["depot_capacity"])
+        if biomass_supply is None:
+          raise RuntimeError(f"The depots cannot process the {year} biomass.")
+        add(biomass_supply[SUBMISSION_COLUMNS])
+        add(PelletDemandSupplyFlow(biomass_supply, refineries, store, year,
+                                   scenario["refinery_capacity"])[SUBMISSION_COLUMNS])
+        add(pd.DataFrame({"year": year,
+                          "data_type": "biomass_forecast",
+                          "source_index": demand.index,
+                          "destination_index": 0,
+                          "value": year_values(demand, year)}))
+
+    # Checks 3 and 4 hold the flows to the capacities of the scenario
+    report = summary.report(scenario["depot_capacity"], scenario["refinery_capacity"])
+    result.update({"passed": report["passed"],
+                   "failed_checks": json.dumps([x["check"] for x in report["checks"] if not x["passed"]]),
+                   "n_depots": len(depots),
+                   "n_refineries": len(refineries),
+                   "transport": score["transport"],
+                   "underutilisation": score["underutilisation"],
+                   "cost": score["cost"],
+                   "error": ""})
+    if writer is not None:
+      writer.close()
+  except Exception as error:
+    if writer is not None:
+      writer.abort()
+    result.update({"passed": False, "error": f"{type(error).__name__}: {error}"})
+
+  result["runtime"] = time.time() - start
+  return result
+
+
+def run_sweep(scenarios,
+              forecasts,
+              store_path,
+              output,
+              years = [2018, 2019],
+              n_jobs = None,
+              submissions_dir = None):
+  """
+  Run the scenarios in a process pool and append one csv row per finished scenario.
+
+  Parameters:
+    scenarios (list): Scenarios from expand_grid.
+
+    forecasts (dict): Forecast variant name -> biomass DataFrame (or BiomassDataset) with Latitude,
+                      Longitude and one column per year, history and forecast. All variants share
+                      the same sites and year columns.
+
+    store_path (str): Path of the DistanceStore .npy file.
+
+    output (str): Csv file of the results. Scenarios already in it are skipped, unless they failed.
+
+    years (list): Years of the solution.
+
+    n_jobs (int): Number of worker processes (default: cpu_count).
+
+    submissions_dir (str): Folder where the submission of every scenario is saved as a compact
+                           <scenario_id>.parquet file, validated as stored. Not saved when None.
+
+  Returns:
+    dataframe: Every result in `output`, the previous runs included.
+
+  Example:
+      >>> scenarios = expand_grid({"refinery_capacity": [80000, 100000], "seed": [1, 2]})
+      >>> run_sweep(scenarios, {"default": DemandHistory}, "data/interim/Distance_Matrix.npy",
+                    "data/output/sweep.csv")
+      Output: [1/4] 3f2c9a1b7e40 cost 553042.5 (2.1s)
+              ...
+  """
+  done, started = set(), False
+  if os.path.exists(output) and os.path.getsize(output) > 0:
+    previous = pd.read_csv(output, usecols = ["scenario_id", "error"], dtype = str, keep_default_na = False)
+    # Scenarios that failed are run again
+    done, started = set(previous.loc[previous["error"] == "", "scenario_id"]), True
+  pending = [x for x in scenarios if x["scenario_id"] not in done]
+  print(f"{len(done)} scenarios already done, {len(pending)} to run")
+
+  variants = list(forecasts)
+  missing = {x["forecast"] for x in pending} - set(variants)
+  if missing:
+    raise ValueError(f"Unknown forecast variants: {sorted(missing)}")
+
+  memory, initargs = share_forecasts(forecasts, store_path, years, submissions_dir)
+  try:
+    os.makedirs(os.path.dirname(output) or ".", exist_ok = True)
+    write_header = not started
+
+    with open(output, "a", newline = "") as f, \
+         ProcessPoolExecutor(max_workers = n_jobs or os.cpu_count(),
+                             mp_context = multiprocessing.get_context("spawn"),
+                             initializer = _init_worker, initargs = initargs) as pool:
+      jobs = [pool.submit(run_scenario, x) for x in pending]
+      for (count, job) in enumerate(as_completed(jobs), 1):
+        result = job.result()
+        pd.DataFrame([result]).reindex(columns = RESULT_COLUMNS).to_csv(f, index = False, header = write_header)
+        write_header = False
+        f.flush()
+
+        status = f"cost {result['cost']:.1f}" if not result["error"] else result["error"]
+        print(f"[{count}/{len(pending)}] {result['scenario_id']} {status} ({result['runtime']:.1f}s)")
+  finally:
+    memory.close()
+    memory.unlink()
+
+  # The last row of a scenario run again replaces its failed ones
+  return pd.read_csv(output).drop_duplicates("scenario_id", keep = "last")
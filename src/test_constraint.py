@@ -14,190 +14,286 @@ DESCRIPTION
     
     test_constraint.py is a python file that checks if a submission file
     meets the competition requirements.
+
+    constraintsTest.report() returns the checks as a dictionary (pass/fail,
+    violating indices, slack of every depot and refinery) built from one
+    grouping of the submission, so it can be called inside optimisation loops.
+    constraints_check() prints the same report.
     
 INPUT
     - Submission File (pandas.DataFrame)
     
 PACKAGE LIST
     Pandas
+    Numpy
 """
 
 
 
 # Module List
+import numpy as np
 import pandas as pd
-import math
+from instrumentation import instrumented, record
+
+DATA_TYPES = ["biomass_forecast", "biomass_demand_supply", "pellet_demand_supply", "depot_location", "refinery_location"]
+
+# Printed messages of every check: (passed, violated). "{year}" is filled for the yearly checks.
+MESSAGES = {
+  1: ("Constraint 1 Passed Successfuly: All values are greater than or equal to zero",
+      "Constraint 1 violated: All values are not greater than or equal to zero"),
+  2: ("Constraint 2 Passed Successfuly for year {year}: Amount of biomass from each harvesting site is <= to the site’s forecasted biomass.",
+      "Constraint 2 violated for year {year}: Amount of biomass from each harvesting site is > to the site’s forecasted biomass."),
+  3: ("Constraint 3 Passed Successfuly for year {year}: Total biomass reaching each depot is <= 20,000.",
+      "Constraint 3 violated for year {year}: Total biomass reaching each depot is > 20,000."),
+  4: ("Constraint 4 Passed Successfuly for year {year}: Total pellets reaching each refinery is <= 100,000.",
+      "Constraint 4 violated for year {year}: Total pellets reaching each refinery is > 100,000."),
+  5: ("Constraint 5 Passed Successfuly: Number of depots is <= to 25",
+      "Constraint 5 violated: Number of depots is > 25"),
+  6: ("Constraint 6 Passed Successfuly: Number of refineries is <= to 5",
+      "Constraint 6 violated: Number of refineries is > 5"),
+  7: ("Constraint 7 Passed Successfuly for year {year}: 80% of the total forecasted biomass was processed by refineries",
+      "Constraint 7 violated for year {year}: 80% of the total forecasted biomass was not processed by refineries"),
+  8: ("Constraint 8 Passed Successfuly for year {year}: Biomass entering depot == Pellete exiting depot",
+      "Constraint 8 violated for year {year}: Biomass entering depot != Pellete exiting depot"),
+  9: (None, "Index Error 9: Harvesting site location index should be an integer value between 0 and 2417"),
+  10: (None, "Index Error 10: Depot location index must be an integer value between 0 and 2417"),
+  11: (None, "Index Error 11: Biorefinery location index must be an integer value between 0 and 2417"),
+  12: (None, "Index Error 12: Harvesting site location index out of bound in biomass demand-supply matrix"),
+  13: (None, "Index Error 13: Depot location index out of bound in biomass demand-supply matrix"),
+  14: (None, "Index Error 14: Depot location index out of bound in pellet demand-supply matrix"),
+  15: (None, "Index Error 15: Biorefinery location index out of bound in pellet demand-supply matrix"),
+  16: (None, "Index Error 16 for {year}: You can only specify one value of biomass forecast per location. Multiple found."),
+  17: (None, "Index Error 17: You can only place one depot per location. Multiple found."),
+  18: (None, "Index Error 18: You can only place one biorefinery per location. Multiple found."),
+}
+
+# Index checks of every data type: (check on source_index, check on destination_index, integer source required)
+_INDEX_CHECKS = {
+  "biomass_forecast": (9, None, True),
+  "depot_location": (10, None, True),
+  "refinery_location": (11, None, True),
+  "biomass_demand_supply": (12, 13, False),
+  "pellet_demand_supply": (14, 15, False),
+}
+
+
+class constraintsSummary():
+  """
+  class constraintsSummary()
+
+  Additive aggregates of a submission: per-site sums of every data type and year,
+  location counts and the row labels breaking a value or index rule. All the
+  constraints are evaluated from these aggregates, so update() can be fed
+  consecutive chunks of one submission.
+
+  Example:
+      >>> summary = constraintsSummary()
+      >>> summary.update(submission)
+      >>> summary.report()["passed"]
+      Output: True
+  """
+
+  def __init__(self, years = [2018, 2019], n_sites = 2418):
+    self.years = list(years)
+    self.n_sites = n_sites
+
+    shape = (len(self.years), n_sites)
+    self.forecast = np.zeros(shape)
+    self.forecast_count = np.zeros(shape, dtype = np.int64)
+    self.procured = np.zeros(shape)       # biomass leaving every site
+    self.depot_in = np.zeros(shape)       # biomass reaching every depot
+    self.depot_out = np.zeros(shape)      # pellets leaving every depot
+    self.refinery_in = np.zeros(shape)    # pellets reaching every refinery
+    self.depot_count = np.zeros(n_sites, dtype = np.int64)
+    self.refinery_count = np.zeros(n_sites, dtype = np.int64)
+
+    self.negative_rows = []
+    self.index_rows = {check: [] for check in range(9, 16)}
+
+  def _valid(self, values):
+    """
+    Mask of the integral indices between 0 and n_sites - 1, and the indices as int64.
+    """
+    values = pd.to_numeric(pd.Series(values), errors = "coerce").to_numpy(dtype = np.float64)
+    valid = (values == np.floor(values)) & (values >= 0) & (values < self.n_sites)
+    return valid, np.where(valid, values, 0).astype(np.int64)
+
+  @instrumented
+  def update(self, df):
+    """
+    Add the rows of `df` (a whole submission or one chunk of it) to the aggregates.
+    """
+    record(rows = len(df))
+    data_type = pd.Categorical(df["data_type"], categories = DATA_TYPES).codes
+    year = pd.Index(self.years).get_indexer(df["year"])
+    groups = pd.DataFrame({"data_type": data_type, "year": year}).groupby(["data_type", "year"]).indices
+
+    labels = df.index.to_numpy()
+    source_col, destination_col, value_col = (df[x].to_numpy() for x in ["source_index", "destination_index", "value"])
+    source_is_int = pd.api.types.is_integer_dtype(df["source_index"])
+
+    for (code, y), rows in groups.items():
+      if code < 0:
+        continue
+      name = DATA_TYPES[code]
+      source_check, destination_check, int_required = _INDEX_CHECKS[name]
+
+      source_ok, source = self._valid(source_col[rows])
+      if int_required and not source_is_int:
+        source_ok[:] = False
+      self.index_rows[source_check].append(labels[rows[~source_ok]])
+
+      if name == "depot_location":
+        self.depot_count += np.bincount(source[source_ok], minlength = self.n_sites)
+        continue
+      if name == "refinery_location":
+        self.refinery_count += np.bincount(source[source_ok], minlength = self.n_sites)
+        continue
+
+      values = value_col[rows].astype(np.float64)
+      self.negative_rows.append(labels[rows[~(values >= 0)]])
+
+      ok = source_ok
+      if destination_check is not None:
+        destination_ok, destination = self._valid(destination_col[rows])
+        self.index_rows[destination_check].append(labels[rows[~destination_ok]])
+        ok = ok & destination_ok
+      if y < 0:
+        continue
+
+      source, values = source[ok], np.nan_to_num(values[ok])
+      if name == "biomass_forecast":
+        self.forecast[y] += np.bincount(source, weights = values, minlength = self.n_sites)
+        self.forecast_count[y] += np.bincount(source, minlength = self.n_sites)
+      elif name == "biomass_demand_supply":
+        self.procured[y] += np.bincount(source, weights = values, minlength = self.n_sites)
+        self.depot_in[y] += np.bincount(destination[ok], weights = values, minlength = self.n_sites)
+      else:
+        self.depot_out[y] += np.bincount(source, weights = values, minlength = self.n_sites)
+        self.refinery_in[y] += np.bincount(destination[ok], weights = values, minlength = self.n_sites)
+
+    return self
+
+  @instrumented
+  def report(self,
+             depot_capacity = 20000,
+             refinery_capacity = 100000,
+             max_depots = 25,
+             max_refineries = 5,
+             min_processed_ratio = 0.8,
+             tolerance = 1e-03):
+    """
+    Evaluate the competition constraints on the aggregates.
+
+    Returns:
+      dict: "passed" (bool), "errors" (input errors), "checks" (one dict per check and
+            year with "check", "year", "passed" and the violating "violations": site
+            indices for the constraints, row labels for index errors 9-15), and
+            "depot_slack" / "refinery_slack" (year -> pd.Series of remaining capacity
+            indexed by facility).
+    """
+    checks = []
+
+    def add(check, violations, year = None, passed = None):
+      violations = np.asarray(violations)
+      checks.append({"check": check,
+                     "year": year,
+                     "passed": bool(len(violations) == 0) if passed is None else bool(passed),
+                     "violations": violations})
+
+    add(1, np.concatenate(self.negative_rows) if self.negative_rows else [])
+    for (y, year) in enumerate(self.years):
+      add(2, np.flatnonzero(self.procured[y] > self.forecast[y]), year)
+    for (y, year) in enumerate(self.years):
+      add(3, np.flatnonzero(self.depot_in[y] > depot_capacity), year)
+    for (y, year) in enumerate(self.years):
+      add(4, np.flatnonzero(self.refinery_in[y] > refinery_capacity), year)
+    add(5, [], passed = self.depot_count.sum() <= max_depots)
+    add(6, [], passed = self.refinery_count.sum() <= max_refineries)
+    for (y, year) in enumerate(self.years):
+      add(7, [], year, passed = self.procured[y].sum() >= min_processed_ratio * self.forecast[y].sum())
+    for (y, year) in enumerate(self.years):
+      add(8, np.flatnonzero(np.abs(self.depot_in[y] - self.depot_out[y]) > tolerance), year)
+
+    for check in range(9, 16):
+      add(check, np.concatenate(self.index_rows[check]) if self.index_rows[check] else [])
+    for (y, year) in enumerate(self.years):
+      add(16, np.flatnonzero(self.forecast_count[y] > 1), year)
+    add(17, np.flatnonzero(self.depot_count > 1))
+    add(18, np.flatnonzero(self.refinery_count > 1))
+
+    depots = np.flatnonzero((self.depot_count > 0) | self.depot_in.any(0) | self.depot_out.any(0))
+    refineries = np.flatnonzero((self.refinery_count > 0) | self.refinery_in.any(0))
+    record(failed_checks = sorted({x["check"] for x in checks if not x["passed"]}))
+
+    return {"passed": all(x["passed"] for x in checks),
+            "errors": [],
+            "checks": checks,
+            "depot_slack": {year: pd.Series(depot_capacity - self.depot_in[y, depots], index = depots)
+                            for (y, year) in enumerate(self.years)},
+            "refinery_slack": {year: pd.Series(refinery_capacity - self.refinery_in[y, refineries], index = refineries)
+                               for (y, year) in enumerate(self.years)}}
+
 
 class constraintsTest():
   """
   class constraintsTest()
   """
 
-  def __init__(self, df):
+  def __init__(self, df, n_sites = 2418):
     self.df = df
+    self.n_sites = n_sites
     self.years = [2018, 2019]
     self.yearly_depot_capacity = 20000
     self.yearly_refinery_capacity = 100000
     self.sub_columns = ['year', 'data_type', 'source_index', 'destination_index', 'value']
 
-  def constraints_check(self):
+  @instrumented
+  def report(self):
+    """
+    Check the submission without printing.
 
-    # Check if the input is a DataFrame
+    Returns:
+      dict: See constraintsSummary.report. Input errors (not a DataFrame, empty,
+            missing columns) are listed in "errors" and no check is run.
+    """
+    errors = []
     if not isinstance(self.df, pd.DataFrame):
-      print("Error: Input is not a DataFrame.")
-      return False
-
-    # Check if the DataFrame is empty
-    if self.df.empty:
-      print("Error: The DataFrame is empty.")
-      return False
-
-    # Check if the DataFrame contains all necessary columns
-    missCol = [x for x in self.sub_columns if x not in self.df.columns]
-    if len(missCol) > 0:
-      print(f"Missing Columns Error: The following columns, {missCol} are missing in the submission file.")
-      return False
-
-    # Check constraint 1: All values (forecasted biomass, biomass demand-supply, pellet demand-supply
-    # must be greater than or equal to zero.
-    print("="*20)
-    constraint1Col = ["biomass_demand_supply","biomass_forecast","pellet_demand_supply"]
-    if (self.df[self.df["data_type"].isin(constraint1Col)]["value"] >= 0).all():
-        print("Constraint 1 Passed Successfuly: All values are greater than or equal to zero")
+      errors.append("Error: Input is not a DataFrame.")
+    elif self.df.empty:
+      errors.append("Error: The DataFrame is empty.")
     else:
-        print("Constraint 1 violated: All values are not greater than or equal to zero")
-
-    # Check constraint 2: The amount of biomass procured for processing from each harvesting site ′𝑖′
-    # must be less than or equal to that site’s forecasted biomass.
-    print("="*20)
-    for year in self.years:
-      tempDf = pd.DataFrame()
-      tempDf['biomass_procured'] = self.df[self.df["data_type"].eq("biomass_demand_supply") & self.df["year"].eq(year)].groupby("source_index")["value"].sum().values
-      tempDf['forecasted_biomass'] = self.df[self.df["data_type"].eq("biomass_forecast") & self.df["year"].eq(year)]["value"].values
-      site_forecast_check = tempDf['biomass_procured'] <= tempDf['forecasted_biomass']
-
-      if site_forecast_check.all():
-        print(f"Constraint 2 Passed Successfuly for year {year}: Amount of biomass from each harvesting site is <= to the site’s forecasted biomass.")
-      else:
-        print(f"Constraint 2 violated for year {year}: Amount of biomass from each harvesting site is > to the site’s forecasted biomass.")
-
-    # Check constraint 3: Total biomass reaching each preprocessing depot ′𝑗′ must
-    # be less than or equal to its yearly processing capacity (20,000).
-    print("="*20)
-    for year in self.years:
-      biomass_supply_check = (self.df[self.df["data_type"].eq("biomass_demand_supply") & self.df["year"].eq(year)].groupby("destination_index")["value"].sum() <= self.yearly_depot_capacity)
-      if biomass_supply_check.all():
-        print(f"Constraint 3 Passed Successfuly for year {year}: Total biomass reaching each depot is <= 20,000.")
-      else:
-        print(f"Constraint 3 violated for year {year}: Total biomass reaching each depot is > 20,000.")
-
-    # Check constraint 4: Total pellets reaching each refinery ′𝑘′ must
-    # be less than or equal to its yearly processing capacity (100,000).
-    print("="*20)
-    for year in self.years:
-      pellets_supply_check = (self.df[self.df["data_type"].eq("pellet_demand_supply") & self.df["year"].eq(year)].groupby("destination_index")["value"].sum() <= self.yearly_refinery_capacity)
-      if pellets_supply_check.all():
-        print(f"Constraint 4 Passed Successfuly for year {year}: Total pellets reaching each refinery is <= 100,000.")
-      else:
-        print(f"Constraint 4 violated for year {year}: Total pellets reaching each refinery is > 100,000.")
+      missCol = [x for x in self.sub_columns if x not in self.df.columns]
+      if len(missCol) > 0:
+        errors.append(f"Missing Columns Error: The following columns, {missCol} are missing in the submission file.")
 
-    # Constraint 5: Number of depots should be less than or equal to 25.
-    print("="*20)
-    if (self.df["data_type"].value_counts()["depot_location"] <= 25):
-        print("Constraint 5 Passed Successfuly: Number of depots is <= to 25")
-    else:
-        print("Constraint 5 violated: Number of depots is > than or equal to 25")
+    if errors:
+      return {"passed": False, "errors": errors, "checks": [], "depot_slack": {}, "refinery_slack": {}}
 
-    # Constraint 6: Number of refineries should be less than or equal to 5.
-    print("="*20)
-    if (self.df["data_type"].value_counts()["refinery_location"] <= 5):
-        print("Constraint 6 Passed Successfuly: Number of refineries is <= to 5")
-    else:
-        print("Constraint 6 violated: Number of refineries is > than or equal to 5")
-
-    # Constrain 7: At least 80% of the total forecasted biomass must be processed by refineries each year
-    print("="*20)
-    for year in self.years:
-      yearly_biomass = self.df[self.df["data_type"].eq("biomass_forecast") & self.df["year"].eq(year)]["value"].sum()
-      processed_biomass = self.df[self.df["data_type"].eq("biomass_demand_supply") & self.df["year"].eq(year)]["value"].sum()
-      if processed_biomass >= 0.8*yearly_biomass:
-        print(f"Constraint 7 Passed Successfuly for year {year}: 80% of the total forecasted biomass was processed by refineries")
-      else:
-        print(f"Constraint 7 violated for year {year}: 80% of the total forecasted biomass was not processed by refineries")
+    return constraintsSummary(self.years, self.n_sites).update(self.df).report(self.yearly_depot_capacity,
+                                                                 self.yearly_refinery_capacity)
 
-    # Constrain 8: Total amount of biomass entering each preprocessing depot is equal to the total amount of pellets exiting that depot (within tolerance limit of 1e-03).
-    print("="*20)
-    for year in self.years:
-      biomass_entering_depot = self.df[self.df["data_type"].eq("biomass_demand_supply") & self.df["year"].eq(year)]["value"].sum()
-      pellete_exiting_depot = self.df[self.df["data_type"].eq("pellet_demand_supply") & self.df["year"].eq(year)]["value"].sum()
+  @instrumented
+  def constraints_check(self):
+    """
+    Print the result of every check.
 
-      if (math.isclose(biomass_entering_depot, pellete_exiting_depot, abs_tol = 1e-03)):
-        print(f"Constraint 8 Passed Successfuly for year {year}: Biomass entering depot == Pellete exiting depot")
-      else:
-        print(f"Constraint 8 violated for year {year}: Biomass entering depot != Pellete exiting depot")
-
-    #### INDEX ERROR
-
-    # Index error 9: Harvesting site location index 𝑖𝑖 should be an integer value between 0 and 2417
-    notInRange = len([x for x in self.df[self.df["data_type"].eq("biomass_forecast")]["source_index"].values.tolist() if x not in range(2418)])
-    notInt = len([x for x in self.df[self.df["data_type"].eq("biomass_forecast")]["source_index"].values.tolist() if type(x) != int])
-    if (notInRange or notInt):
-      print("="*20)
-      print(f"Index Error 9: Harvesting site location index should be an integer value between 0 and 2417")
-
-    # Index error 10: Depot location index 𝑗𝑗 must be an integer value between 0 and 2417
-    notInRange = len([x for x in self.df[self.df["data_type"].eq("depot_location")]["source_index"].values.tolist() if x not in range(2418)])
-    notInt = len([x for x in self.df[self.df["data_type"].eq("depot_location")]["source_index"].values.tolist() if type(x) != int])
-    if (notInRange or notInt):
-      print("="*20)
-      print(f"Index Error 10: Depot location index must be an integer value between 0 and 2417")
-
-    # Index error 11: Biorefinery location index 𝑘𝑘 must be an integer value between 0 and 2417
-    notInRange = len([x for x in self.df[self.df["data_type"].eq("refinery_location")]["source_index"].values.tolist() if x not in range(2418)])
-    notInt = len([x for x in self.df[self.df["data_type"].eq("refinery_location")]["source_index"].values.tolist() if type(x) != int])
-    if (notInRange or notInt):
-      print("="*20)
-      print(f"Index Error 11: Biorefinery location index must be an integer value between 0 and 2417")
-
-    # Index error 12: : Harvesting site location index 𝑖𝑖 out of bound in biomass demand-supply matrix
-    notInRange = len([x for x in self.df[self.df["data_type"].eq("biomass_demand_supply")]["source_index"].values.tolist() if x not in range(2418)])
-    if (notInRange):
-      print("="*20)
-      print(f"Index Error 12: Harvesting site location index out of bound in biomass demand-supply matrix")
-
-    # Index error 13: : Depot location index 𝑗𝑗 out of bound in biomass demand-supply matrix
-    notInRange = len([x for x in self.df[self.df["data_type"].eq("biomass_demand_supply")]["destination_index"].values.tolist() if x not in range(2418)])
-    if (notInRange):
-      print("="*20)
-      print(f"Index Error 13: Depot location index out of bound in biomass demand-supply matrix")
-
-    # Index error 14: : Depot location index 𝑗𝑗 out of bound in pellet demand-supply matrix
-    notInRange = len([x for x in self.df[self.df["data_type"].eq("pellet_demand_supply")]["source_index"].values.tolist() if x not in range(2418)])
-    if (notInRange):
-      print("="*20)
-      print(f"Index Error 14: Depot location index out of bound in pellet demand-supply matrix")
-
-    # Index error 15: : Biorefinery location index 𝑘𝑘 out of bound in pellet demand-supply matrix
-    notInRange = len([x for x in self.df[self.df["data_type"].eq("pellet_demand_supply")]["destination_index"].values.tolist() if x not in range(2418)])
-    if (notInRange):
-      print("="*20)
-      print(f"Index Error 15: Biorefinery location index out of bound in pellet demand-supply matrix")
-
-    # Index error 16: You can only specify one value of biomass forecast per location. Multiple found.
-    for year in self.years:
-      uniqueIdx = self.df[self.df["data_type"].eq("biomass_forecast") & self.df["year"].eq(year)]["source_index"].value_counts().values
-      if ((uniqueIdx > 1).all()):
+    Returns:
+      bool: True when the submission meets every constraint.
+    """
+    report = self.report()
+    for error in report["errors"]:
+      print(error)
+
+    previous = None
+    for check in report["checks"]:
+      passed_msg, violated_msg = MESSAGES[check["check"]]
+      message = passed_msg if check["passed"] else violated_msg
+      if message is None:
+        continue
+      if check["check"] != previous or check["check"] > 8:
         print("="*20)
-        print(f"Index Error 16 for {year}: You can only specify one value of biomass forecast per location. Multiple found.")
-
-    # Index error 17: You can only place one depot per location. Multiple found.
-    uniqueIdx = self.df[self.df["data_type"].eq("depot_location")]["source_index"].value_counts().values
-    if ((uniqueIdx > 1).any()):
-      print("="*20)
-      print(f"Index Error 17: You can only place one depot per location. Multiple found.")
-
-    # Index error 18: You can only place one biorefinery per location. Multiple found.
-    uniqueIdx = self.df[self.df["data_type"].eq("drefinery_location")]["source_index"].value_counts().values
-    if ((uniqueIdx > 1).any()):
-      print("="*20)
-      print(f"Index Error 18: You can only place one biorefinery per location. Multiple found.")
+      previous = check["check"]
+      print(message.format(year = check["year"]))
+
+    return report["passed"]
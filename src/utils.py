@@ -1,41 +1,63 @@
 # Libraries
-import math
+import numpy as np
 import pandas as pd
-from sklearn.cluster import KMeans
+from numpy.lib.stride_tricks import sliding_window_view
+from instrumentation import instrumented
+from dataset import data_years, site_coordinates, year_matrix
 
-def cluster_data(df, n_clusters = 4):
+@instrumented
+def cluster_data(df, n_clusters = 4, random_state = 42):
   """
+  KMeans cluster of every harvesting site, on its longitude and latitude.
 
+  Parameters:
+    df (pd.DataFrame or BiomassDataset): Sites with Latitude and Longitude.
+
+    n_clusters (int): Number of clusters.
+
+    random_state (int): Seed of the KMeans initialisations.
+
+  Returns:
+    np.ndarray: Cluster label of every site.
   """
+  from sklearn.cluster import KMeans
+
   kmeans_kwargs = {
       "init": "random",
       "n_init": n_clusters,
       "max_iter": 300,
-      "random_state": 42}
+      "random_state": random_state}
 
   kmeans1 = KMeans(n_clusters=n_clusters, **kmeans_kwargs)
 
-  kmeans1.fit(df[["Longitude","Latitude"]])
+  latitude, longitude = site_coordinates(df)
+  X = np.column_stack([longitude, latitude])
+  kmeans1.fit(X)
 
-  return kmeans1.predict(df[["Longitude","Latitude"]])
+  return kmeans1.predict(X)
 
 
 def haversine_distance(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance in kilometers.
+
+    Works on scalars and on NumPy arrays, which are broadcast against each other.
+    """
     # Earth radius in kilometers
     earth_radius = 6371.0
 
     # Convert latitude and longitude from degrees to radians
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
+    lat1_rad = np.radians(lat1)
+    lon1_rad = np.radians(lon1)
+    lat2_rad = np.radians(lat2)
+    lon2_rad = np.radians(lon2)
 
     # Haversine formula
     d_lat = lat2_rad - lat1_rad
     d_lon = lon2_rad - lon1_rad
 
-    a = math.sin(d_lat / 2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(d_lon / 2)**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    a = np.sin(d_lat / 2)**2 + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(d_lon / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
 
     # Calculate the distance
     distance = earth_radius * c
@@ -43,43 +65,201 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     return distance
 
 
+def haversine_one_to_many(lat, lon, latitudes, longitudes):
+  """
+  Distances (km) from one point to every point of `latitudes`/`longitudes`.
+  """
+  return haversine_distance(lat, lon, np.asarray(latitudes), np.asarray(longitudes))
+
+
+def haversine_pairwise(latitudes1, longitudes1, latitudes2 = None, longitudes2 = None):
+  """
+  Matrix of distances (km) between two sets of points, or within one set.
+
+  Returns:
+    np.ndarray: Array of shape (len(latitudes1), len(latitudes2)).
+  """
+  if latitudes2 is None:
+    latitudes2, longitudes2 = latitudes1, longitudes1
+
+  return haversine_distance(np.asarray(latitudes1)[:, None], np.asarray(longitudes1)[:, None],
+                            np.asarray(latitudes2)[None, :], np.asarray(longitudes2)[None, :])
+
+
+class SiteIndex():
+  """
+  class SiteIndex()
+
+  Ball tree (haversine metric) over the harvesting sites, built once and queried
+  in O(log n) to snap any coordinate to its nearest site.
+
+  Example:
+      >>> site_index = SiteIndex(df["Latitude"], df["Longitude"])
+      >>> site_index.nearest(24.66818, 71.33144)
+      Output: 0
+  """
+
+  def __init__(self, latitude, longitude):
+    from sklearn.neighbors import BallTree
+
+    self.latitude = np.asarray(latitude, dtype = np.float64)
+    self.longitude = np.asarray(longitude, dtype = np.float64)
+    self.tree = BallTree(np.radians(np.column_stack([self.latitude, self.longitude])), metric = "haversine")
+
+  def __len__(self):
+    return len(self.latitude)
+
+  def query(self, latitude, longitude, k = 1):
+    """
+    The k nearest sites of every point.
+
+    Returns:
+      tuple: Distances in km and site positions, both of shape (n_points, k).
+    """
+    points = np.radians(np.column_stack([np.atleast_1d(latitude), np.atleast_1d(longitude)]))
+    distances, positions = self.tree.query(points, k = k)
+    return distances * 6371.0, positions
+
+  def nearest(self, latitude, longitude):
+    """
+    Position of the nearest site of every point (an int for a single point).
+    """
+    _, positions = self.query(latitude, longitude, k = 1)
+    positions = positions[:, 0]
+    return int(positions[0]) if np.ndim(latitude) == 0 else positions
+
+
+@instrumented
 def create_train_data(df,
-                      window_size):
+                      window_size,
+                      target_year = None,
+                      years = None):
   """
+  Sliding-window features for the biomass forecast model.
+
+  Every window of `window_size` consecutive years gives the features year1..yearN
+  (oldest first), their mean and standard deviation, and the relative change and
+  difference between every pair of years. All windows are read at once from the
+  (sites x years) array with sliding_window_view and the features are written into
+  a single float32 block, so the cost grows linearly with sites and years.
+
+  Parameters:
+    df (pd.DataFrame or BiomassDataset): Biomass data with Latitude, Longitude and one column per year.
+
+    window_size (int): Number of past years used as features.
+
+    target_year (int): When given, the inference features of that year are returned,
+                       built from the `window_size` years before it, e.g. 2018 uses
+                       2015, 2016 and 2017. When None, every training window of `years`
+                       is returned with its "Target" year.
+
+    years (list): Year columns used for the training windows, in chronological order.
+                  Defaults to every year column of `df`.
 
+  Returns:
+    dataframe: Latitude, Longitude, year1..yearN, Target (training only), year_avg,
+               year_std and the yearJ_yearI_change / yearJ_yearI_diff columns.
+               Training rows are ordered window by window, every window listing all sites.
 
+  Example:
+      >>> train = create_train_data(DemandHistory, window_size = 3)
+      >>> train.shape
+      Output: (12090, 14)
+      >>> test_2018 = create_train_data(DemandHistory, window_size = 3, target_year = 2018)
+      >>> test_2018.shape
+      Output: (2418, 13)
   """
-  latitude = df["Latitude"]
-  longitude = df["Longitude"]
+  if target_year is not None:
+    years = [target_year - window_size + x for x in range(window_size)]
+    windows = year_matrix(df, years, dtype = np.float32)[None]
+  else:
+    if years is None:
+      years = data_years(df)
+    values = year_matrix(df, years, dtype = np.float32)
+    # (sites, n_windows, window_size + 1) view, moved to window-major order
+    windows = sliding_window_view(values, window_size + 1, axis = 1).transpose(1, 0, 2)
 
-  df = df[[f"201{x}" for x in range(8)]]
-  year_len = df.shape[1]
+  n_windows, n_sites, _ = windows.shape
+  past = windows[..., :window_size].reshape(-1, window_size)
+  target = windows[..., window_size].reshape(-1) if target_year is None else None
+  features, columns = window_features(past, target)
 
-  final_df = pd.DataFrame()
-  test = pd.DataFrame()
+  coordinates = np.tile(np.column_stack(site_coordinates(df)), (n_windows, 1))
 
-  for idx in range(year_len - window_size):
+  return pd.concat([pd.DataFrame(coordinates, columns = ["Latitude", "Longitude"]),
+                    pd.DataFrame(features, columns = columns)], axis = 1)
 
-    selected_dates = [f"201{idx+x}" for x in range(window_size)]
-    temp_df = pd.DataFrame()
-    temp_df["Latitude"] = latitude
-    temp_df["Longitude"] = longitude
-    temp_df[[f"year{x}" for x in range(1,window_size+1)]] = df[selected_dates]
-    temp_df["Target"] = df[f"201{idx+window_size}"]
 
-    final_df = pd.concat([final_df, temp_df]).reset_index(drop=True)
+def window_features(past, target = None):
+  """
+  Feature matrix of create_train_data for windows already laid out as rows.
+
+  Parameters:
+    past (np.ndarray): Array of shape (n_rows, window_size), oldest year first.
+
+    target (array): Target of every row, written in the "Target" column when given.
+
+  Returns:
+    tuple: (float32 array of shape (n_rows, n_features), list of column names)
+  """
+  n_rows, window_size = past.shape
+  year_cols = [f"year{x}" for x in range(1, window_size + 1)]
+  base, other = np.triu_indices(window_size, k = 1)
+
+  columns = year_cols + (["Target"] if target is not None else []) + ["year_avg", "year_std"]
+  for (i, j) in zip(base, other):
+    columns += [f"{year_cols[j]}_{year_cols[i]}_change", f"{year_cols[j]}_{year_cols[i]}_diff"]
 
-    ## Aggregate Features
-  final_df["year_avg"] = final_df[[f"year{x}" for x in range(1, window_size+1)]].mean(1)
-  final_df["year_std"] = final_df[[f"year{x}" for x in range(1, window_size+1)]].std(1)
+  features = np.empty((n_rows, len(columns)), dtype = np.float32)
+  n_cols = len(columns) - 2 * len(base)
 
-  years = [f"year{x}" for x in range(1,window_size+1)]
+  features[:, :window_size] = past
+  if target is not None:
+    features[:, window_size] = target
+  features[:, n_cols - 2] = past.mean(1)
+  features[:, n_cols - 1] = past.std(1, ddof = 1) if window_size > 1 else np.nan
 
-  for index in range(len(years) -1):
-    base_year = years[index]
-    other_years  = years[index+1:]
-    for yr_col in other_years:
-      final_df[f"{yr_col}_{base_year}_change"] = (final_df[yr_col] - final_df[base_year]) / final_df[base_year]
-      final_df[f"{yr_col}_{base_year}_diff"] = final_df[yr_col] - final_df[base_year]
+  if len(base) == 0:  # a single year has no pair
+    return features, columns
+
+  # change and diff of every pair, interleaved as in the column names
+  pairs = features[:, n_cols:].reshape(-1, len(base), 2)
+  np.subtract(past[:, other], past[:, base], out = pairs[..., 1])
+  with np.errstate(divide = "ignore", invalid = "ignore"):
+    np.divide(pairs[..., 1], past[:, base], out = pairs[..., 0])
+
+  return features, columns
+
+def flows_to_frame(flows,
+                   source_idx,
+                   destination_idx,
+                   year,
+                   data_type,
+                   tolerance = 1e-05):
+  """
+  Convert a dense (sources x destinations) flow matrix into submission rows.
+
+  Only the positive flows are kept, sorted by source, and `tolerance` is taken off
+  every value so the rounded flows stay within the capacities.
+
+  Parameters:
+    flows (np.ndarray): Flow matrix, rows are sources and columns destinations.
+
+    source_idx (array): Site index of every row.
+
+    destination_idx (array): Site index of every column.
+
+    year (int): Year of the flows.
+
+    data_type (str): "biomass_demand_supply" or "pellet_demand_supply".
+
+  Returns:
+    dataframe: Rows with year, source_index, destination_index, data_type and value.
+  """
+  sources, destinations = np.nonzero(flows > 1e-09)
 
-  return final_df
\ No newline at end of file
+  return pd.DataFrame({"year":year,
+              "source_index": np.asarray(source_idx)[sources],
+              "destination_index": np.asarray(destination_idx)[destinations],
+              "data_type": data_type,
+              "value": np.maximum(flows[sources, destinations] - tolerance, 0)})
@@ -1,29 +1,47 @@
 """
-Created on: 
-@author   : 
+Created on:
+@author   :
 
 NAME
   visualize.py
-    
+
 DESCRIPTION
     Visualizes Longitude, Latitude and Biomass demand data
-    ============================================================    
-    
+    ============================================================
+
+    plot_map shows the map in a notebook, or renders it headless (Agg canvas,
+    no pyplot state, nothing to close) to a PNG/SVG file when a path is given.
+    The "density" mode bins the harvesting sites into hexagons weighted by
+    their biomass, which stays fast for large site grids.
+
 PACKAGE LIST
+  numpy
   pandas
   matplotlib
 """
 
 ## Libraries
+import os
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+from dataset import as_frame
+
+colorList = [
+    'b', 'g', 'r', 'c', 'm', 'y', 'k', 'w', 'navy', 'purple', 'teal', 'lime', 'aqua',
+    'fuchsia', 'olive', 'maroon', 'silver', 'gray', 'lightgray', 'darkgray', 'coral']
+
 
 def plot_map(df,
              year,
              depot_data = None,
              refinery_data = None,
-             cluster_col = None):
-  
+             cluster_col = None,
+             path = None,
+             mode = "scatter",
+             figsize = (16, 10),
+             gridsize = 60,
+             dpi = 100):
+
   """
   Plotting biomass harvesting points and depot points.
 
@@ -31,43 +49,90 @@ def plot_map(df,
   and depot points and generates a plot to visualize their locations on a map.
 
   Parameters:
-      dataframe (pd.DataFrame): A pandas DataFrame containing the following columns:
+      dataframe (pd.DataFrame or BiomassDataset): A pandas DataFrame containing the following columns:
                                   - 'Latitude': Latitude values of the points.
                                   - 'Longitude': Longitude values of the points.
                                   - Yearly Biomass demand
+
+      year (int): Year whose biomass sizes the harvesting points.
+
+      depot_data (pd.DataFrame): Depot locations (Latitude, Longitude).
+
+      refinery_data (pd.DataFrame): Refinery locations (Latitude, Longitude).
+
+      cluster_col (str): Column colouring the harvesting points by cluster (scatter mode).
+
+      path (str): File the map is saved to, the format following its extension (.png, .svg, ...).
+                  The map is shown with pyplot when None.
+
+      mode (str): "scatter" draws every harvesting point (rasterised in vector files),
+                  "density" a hexagonal binning of the biomass.
+
+      figsize (tuple): Figure size in inches. Marker and font sizes follow its width.
+
+      gridsize (int): Number of hexagons along the longitude (density mode).
+
+      dpi (int): Resolution of the saved image.
+
   Returns:
-    None
+    str: `path`, or None when the map is shown.
+
+  Example:
+      >>> plot_map(DemandHistory, 2018, depot_data = depots, path = "reports/figures/depots.png", mode = "density")
+      Output: 'reports/figures/depots.png'
   """
+  df = as_frame(df)
+  if path is None:
+    import matplotlib.pyplot as plt
+    fig = plt.figure(figsize = figsize)
+  else:
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize = figsize)
+    FigureCanvasAgg(fig)
+  ax = fig.add_subplot()
+
+  # Sizes were tuned on a 50 inch wide figure
+  scale = figsize[0] / 50
+  area, fontsize = scale ** 2, 35 * scale
+
   title = "Harvesting, "
-  plt.figure(figsize = (50,30))
-
-  colorList = [
-      'b', 'g', 'r', 'c', 'm', 'y', 'k', 'w', 'navy', 'purple', 'teal', 'lime', 'aqua',
-      'fuchsia', 'olive', 'maroon', 'silver', 'gray', 'lightgray', 'darkgray', 'coral']
-
-  if cluster_col:
-    n_clusters = df[cluster_col].unique()
-    for cluster in n_clusters:
-      DemandSize = df[df[cluster_col].eq(cluster)][f"{year}"]
-      plt.scatter(df[df[cluster_col].eq(cluster)]["Longitude"], df[df[cluster_col].eq(cluster)]["Latitude"],
-                  label = f"Harvesting Points cluster {cluster}", marker ="*", color = colorList[cluster], s = DemandSize)
+  longitude, latitude = df["Longitude"].to_numpy(), df["Latitude"].to_numpy()
+  biomass = df[f"{year}"].to_numpy(dtype = np.float64)
+
+  if mode == "density":
+    hexbin = ax.hexbin(longitude, latitude, C = biomass, reduce_C_function = np.sum,
+                       gridsize = gridsize, cmap = "YlGn", mincnt = 1)
+    fig.colorbar(hexbin, ax = ax, label = f"Biomass {year}")
+  elif mode != "scatter":
+    raise ValueError(f"Unknown mode {mode!r}, expected 'scatter' or 'density'.")
+  elif cluster_col:
+    for cluster, group in df.groupby(cluster_col):
+      ax.scatter(group["Longitude"], group["Latitude"], label = f"Harvesting Points cluster {cluster}", marker ="*",
+                 color = colorList[int(cluster) % len(colorList)], s = group[f"{year}"] * area, rasterized = True)
   else:
-    DemandSize = df[f"{year}"]
-    plt.scatter(df["Longitude"], df["Latitude"], label = f"Harvesting Points", marker ="*", 
-                color = "b", s = DemandSize)
-    
+    ax.scatter(longitude, latitude, label = f"Harvesting Points", marker ="*",
+               color = "b", s = biomass * area, rasterized = True)
+
   if isinstance(depot_data, pd.DataFrame):
-    plt.scatter(depot_data["Longitude"], depot_data["Latitude"], label = "Depots Points", marker ="s",color = "green", s = 1000)
+    ax.scatter(depot_data["Longitude"], depot_data["Latitude"], label = "Depots Points", marker ="s",color = "green", s = 1000 * area)
     title += "Depots, "
 
   if isinstance(refinery_data, pd.DataFrame):
-    plt.scatter(refinery_data["Longitude"], refinery_data["Latitude"], label = "Refinery Points", marker ="o",color = "red", s = 1500)
+    ax.scatter(refinery_data["Longitude"], refinery_data["Latitude"], label = "Refinery Points", marker ="o",color = "red", s = 1500 * area)
     title += "Rifineries, "
 
   title += "Locations"
-  plt.legend()
-  plt.title(title, fontsize = 35)
-  plt.xlabel("Longitude", fontsize = 35)
-  plt.ylabel("Latitude", fontsize = 35)
+  if ax.get_legend_handles_labels()[0]:
+    ax.legend()
+  ax.set_title(title, fontsize = fontsize)
+  ax.set_xlabel("Longitude", fontsize = fontsize)
+  ax.set_ylabel("Latitude", fontsize = fontsize)
+
+  if path is None:
+    plt.show()
+    return None
 
-  plt.show()
\ No newline at end of file
+  os.makedirs(os.path.dirname(path) or ".", exist_ok = True)
+  fig.savefig(path, dpi = dpi)
+  return path